@@ -0,0 +1,699 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""A GitHub API client which keeps many requests in flight on a single thread, alongside the blocking client of
+`mini_github3`.
+
+Python 2 has no asyncio, so requests are made over non-blocking sockets driven by an `asyncore` event loop, and
+their outcomes are delivered through `Future`s. The resources are the same `RemoteObject`s as with the blocking
+client. A resource is looked up the usual way, with `Issues.by_repository`, `Comments.by_issue` and the like, which
+don't make a request until the resource is delivered, and then delivered by `AsyncGitHub` rather than by itself.
+
+"""
+
+from collections import deque
+import asyncore
+import errno
+import heapq
+import httplib2
+import json
+import socket
+import ssl
+import sys
+import time
+import urlparse
+
+from remoteobjects.http import omit_nulls
+
+# Chunked transfer encoding states.
+CHUNKED = -1
+TRAILER = -2
+
+
+class Future(object):
+    """The outcome of an operation which completes as `loop` runs.
+
+    Like the `AsyncResult` of a `ThreadPool`, `ready` tells whether it has completed, and `get` waits for the result
+    or raises the exception it failed with, running the loop in the meantime.
+
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """Fail with the exception described by `exc_info`, as returned by `sys.exc_info`."""
+
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        if self._done:
+            return
+        self._done = True
+        self._result = result
+        self._exc_info = exc_info
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def done(self):
+        return self._done
+
+    def ready(self):
+        """Handle whatever the loop has ready, without waiting, and return True if this has completed."""
+
+        if not self._done:
+            self.loop.run_once(0)
+        return self._done
+
+    def result(self):
+        """Return the result of this completed future, or raise the exception it failed with."""
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def get(self):
+        self.loop.run_until_complete(self)
+        return self.result()
+
+    def then(self, function):
+        """Return a future of `function` applied to the result of this one. If `function` returns a future, that
+        future's result is used.
+
+        """
+
+        future = Future(self.loop)
+
+        def completed(self):
+            try:
+                result = function(self.result())
+            except Exception:
+                future.set_exception(sys.exc_info())
+                return
+
+            if isinstance(result, Future):
+                result.add_done_callback(lambda result: future._finish(result._result, result._exc_info))
+            else:
+                future.set_result(result)
+
+        self.add_done_callback(completed)
+        return future
+
+
+def resolved(loop, result):
+    """Return a future which has already completed with `result`."""
+
+    future = Future(loop)
+    future.set_result(result)
+    return future
+
+
+def gather(loop, futures):
+    """Return a future of the list of results of `futures`, which fails as soon as one of them does."""
+
+    futures = list(futures)
+    gathered = Future(loop)
+    remaining = [len(futures)]
+
+    def completed(future):
+        if future._exc_info is not None:
+            gathered.set_exception(future._exc_info)
+            return
+        remaining[0] -= 1
+        if not remaining[0]:
+            gathered.set_result([future.result() for future in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(completed)
+    return gathered
+
+
+class EventLoop(object):
+    """An `asyncore` loop over sockets of its own, with timers."""
+
+    def __init__(self, clock=time.time):
+        self.map = {}
+        self.clock = clock
+        self._timers = []
+        self._timers_added = 0
+
+    def call_later(self, delay, callback):
+        self._timers_added += 1
+        heapq.heappush(self._timers, (self.clock() + delay, self._timers_added, callback))
+
+    def run_once(self, timeout=None):
+        """Handle whatever is ready, waiting up to `timeout` seconds, or until the next timer is due, for something
+        to be.
+
+        """
+
+        if self._timers:
+            until_timer = max(0, self._timers[0][0] - self.clock())
+            timeout = until_timer if timeout is None else min(timeout, until_timer)
+
+        if self.map:
+            asyncore.loop(timeout=timeout if timeout is not None else 30, use_poll=True, map=self.map, count=1)
+        elif timeout:
+            time.sleep(timeout)
+
+        now = self.clock()
+        while self._timers and self._timers[0][0] <= now:
+            at, n, callback = heapq.heappop(self._timers)
+            callback()
+
+    def run_until_complete(self, future):
+        while not future.done():
+            if not self.map and not self._timers:
+                raise RuntimeError("Nothing left to run, but %r hasn't completed." % future)
+            self.run_once()
+        return future
+
+
+class Request(object):
+    def __init__(self, uri, method, body, headers, future):
+        self.uri = uri
+        self.method = method
+        self.body = body
+        self.headers = headers or {}
+        self.future = future
+        self.retried = False
+
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(uri)
+        host, _, port = netloc.partition(':')
+        self.address = (scheme, host, int(port) if port else (443 if scheme == 'https' else 80))
+        self.target = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+
+    def encode(self):
+        headers = dict((name.lower(), value) for name, value in self.headers.items())
+        headers.setdefault('host', self.address[1])
+        headers.setdefault('user-agent', 'CappBot')
+        body = self.body or ''
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+        if body or self.method in ('POST', 'PATCH', 'PUT'):
+            headers['content-length'] = str(len(body))
+
+        head = '%s %s HTTP/1.1\r\n%s\r\n' % (self.method, self.target, ''.join('%s: %s\r\n' % item for item in sorted(headers.items())))
+        if isinstance(head, unicode):
+            head = head.encode('latin-1')
+        return head + body
+
+
+class HttpConnection(asyncore.dispatcher):
+    """A keep-alive HTTP/1.1 connection of `pool` to the server at `address`, a `(scheme, host, port)` tuple, over
+    which requests are made one at a time. An https connection is made over TLS.
+
+    """
+
+    def __init__(self, pool, address):
+        asyncore.dispatcher.__init__(self, map=pool.loop.map)
+        self.pool = pool
+        self.loop = pool.loop
+        self.address = address
+        self.reusable = True
+        self.requests_made = 0
+
+        self._request = None
+        self._out = ''
+        self._in = ''
+        self._received = False
+        self._response = None
+        self._tls = address[0] == 'https'
+        self._handshaking = False
+        self._want_write = False
+        self._activity_at = None
+
+        scheme, host, port = address
+        family, socktype, proto, canonname, sockaddr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        self.create_socket(family, socktype)
+        try:
+            self.connect(sockaddr)
+        except:
+            self.close()
+            raise
+
+    def send_request(self, request):
+        self._request = request
+        self.requests_made += 1
+        self._received = False
+        self._out = request.encode()
+        self._activity()
+        self.loop.call_later(self.pool.timeout, lambda: self._check_timeout(request))
+
+        if self.connected and not self._handshaking:
+            self._send()
+
+    def _activity(self):
+        self._activity_at = self.loop.clock()
+
+    def _check_timeout(self, request):
+        if self._request is not request:
+            return
+        idle = self.loop.clock() - self._activity_at
+        if idle < self.pool.timeout:
+            self.loop.call_later(self.pool.timeout - idle, lambda: self._check_timeout(request))
+            return
+        try:
+            raise socket.timeout('timed out after %ds requesting %s %s' % (self.pool.timeout, request.method, request.uri))
+        except socket.timeout:
+            self._fail(sys.exc_info())
+
+    def readable(self):
+        return self.connected or self.connecting
+
+    def writable(self):
+        if not self.connected:
+            return self.connecting
+        if self._handshaking:
+            return self._want_write
+        return bool(self._out)
+
+    def handle_connect(self):
+        if self._tls:
+            self.socket = self.pool.ssl_context.wrap_socket(self.socket, server_hostname=self.address[1], do_handshake_on_connect=False)
+            self._handshaking = True
+            self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._want_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self._want_write = True
+            return
+
+        self._handshaking = False
+        self._want_write = False
+        self._send()
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+        else:
+            self._send()
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+        else:
+            self._receive()
+
+    def _send(self):
+        while self._out:
+            try:
+                # A TLS write which can't be completed yet has to be retried with the same data.
+                sent = self.socket.send(self._out[:65536])
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self._out = self._out[sent:]
+            self._activity()
+
+    def _receive(self):
+        closed = False
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                closed = True
+                break
+            self._in += data
+            self._received = True
+            self._activity()
+
+        if closed:
+            self.reusable = False
+            if self._request is not None:
+                # The response may have arrived along with the end of the connection.
+                self._parse()
+                if self._request is None:
+                    return
+            self.handle_close()
+        elif self._request is None:
+            # Nothing was asked for.
+            self.reusable = False
+            self.handle_close()
+        else:
+            self._parse()
+
+    def _parse(self):
+        if self._response is None:
+            end = self._in.find('\r\n\r\n')
+            if end < 0:
+                return
+            head, self._in = self._in[:end], self._in[end + 4:]
+
+            lines = head.split('\r\n')
+            version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+            if status.startswith('1'):
+                # Informational, like 100 Continue. The actual response follows.
+                return self._parse()
+
+            headers = {'status': status}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                name, value = name.strip().lower(), value.strip()
+                headers[name] = headers[name] + ', ' + value if name in headers else value
+
+            response = httplib2.Response(headers)
+            response.reason = reason
+            response.version = 11 if version == 'HTTP/1.1' else 10
+            if response.version != 11 or 'close' in headers.get('connection', '').lower():
+                self.reusable = False
+
+            if self._request.method == 'HEAD' or response.status in (204, 304):
+                self._length = 0
+            elif 'chunked' in headers.get('transfer-encoding', '').lower():
+                self._length = CHUNKED
+                self._chunk = None
+                self._chunks = []
+            elif 'content-length' in headers:
+                self._length = int(headers['content-length'])
+            else:
+                # The body lasts until the connection is closed.
+                self._length = None
+                self.reusable = False
+            self._response = response
+
+        if self._length == CHUNKED:
+            self._parse_chunks()
+        elif self._length is not None and len(self._in) >= self._length:
+            content, self._in = self._in[:self._length], self._in[self._length:]
+            self._complete(content)
+
+    def _parse_chunks(self):
+        while True:
+            if self._chunk is None:
+                end = self._in.find('\r\n')
+                if end < 0:
+                    return
+                line, self._in = self._in[:end], self._in[end + 2:]
+                self._chunk = int(line.split(';')[0].strip(), 16) or TRAILER
+
+            if self._chunk == TRAILER:
+                end = self._in.find('\r\n')
+                if end < 0:
+                    return
+                line, self._in = self._in[:end], self._in[end + 2:]
+                if not line:
+                    self._complete(''.join(self._chunks))
+                    return
+                continue
+
+            if len(self._in) < self._chunk + 2:
+                return
+            self._chunks.append(self._in[:self._chunk])
+            self._in = self._in[self._chunk + 2:]
+            self._chunk = None
+
+    def _complete(self, content):
+        request, response = self._request, self._response
+        self._request = self._response = None
+        if self._in:
+            # More than was asked for.
+            self.reusable = False
+        if not self.reusable:
+            self.close()
+        self.pool._completed(self, request, response, content)
+
+    def _fail(self, exc_info):
+        request = self._request
+        self._request = self._response = None
+        self.reusable = False
+        self.close()
+        self.pool._failed(self, request, exc_info)
+
+    def handle_close(self):
+        if self._request is None:
+            self.reusable = False
+            self.close()
+            self.pool._failed(self, None, None)
+        elif self._response is not None and self._length is None:
+            self.reusable = False
+            self._complete(self._in)
+        else:
+            try:
+                raise socket.error(errno.ECONNRESET, 'connection closed requesting %s %s' % (self._request.method, self._request.uri))
+            except socket.error:
+                self._fail(sys.exc_info())
+
+    def handle_error(self):
+        exc_info = sys.exc_info()
+        if self._request is None:
+            self.handle_close()
+        else:
+            self._fail(exc_info)
+
+    def is_stale(self):
+        """Return True if the request failed on a connection the server had closed while it was idle, and so can
+        be made again on a new one.
+
+        """
+
+        return self.requests_made > 1 and not self._received
+
+
+class AsyncHttp(object):
+    """Non-blocking HTTP requests over at most `max_connections` keep-alive connections at a time, driven by `loop`.
+
+    Requests beyond that wait for a connection to become available. Connections time out after `timeout` seconds
+    without any progress.
+
+    """
+
+    def __init__(self, loop, max_connections=100, timeout=30, ssl_context=None):
+        self.loop = loop
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+        self._connections = set()
+        self._idle = {}
+        self._waiting = deque()
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        """Return a `Future` of the `(response, content)` of the request, as `httplib2.Http.request` would return."""
+
+        future = Future(self.loop)
+        self._waiting.append(Request(uri, method, body, headers, future))
+        self._dispatch()
+        return future
+
+    def close(self):
+        for connection in list(self._connections):
+            connection.close()
+        self._connections.clear()
+        self._idle.clear()
+
+    def _dispatch(self):
+        while self._waiting:
+            request = self._waiting[0]
+            idle = self._idle.get(request.address)
+            if idle:
+                connection = idle.pop()
+            elif len(self._connections) < self.max_connections or self._close_idle():
+                try:
+                    connection = HttpConnection(self, request.address)
+                except Exception:
+                    self._waiting.popleft()
+                    request.future.set_exception(sys.exc_info())
+                    continue
+                self._connections.add(connection)
+            else:
+                return
+
+            self._waiting.popleft()
+            connection.send_request(request)
+
+    def _close_idle(self):
+        """Close an idle connection to make room for one to another server. Return False if there is none."""
+
+        for idle in self._idle.values():
+            if idle:
+                connection = idle.pop(0)
+                connection.close()
+                self._connections.discard(connection)
+                return True
+        return False
+
+    def _discard(self, connection):
+        self._connections.discard(connection)
+        idle = self._idle.get(connection.address, [])
+        if connection in idle:
+            idle.remove(connection)
+
+    def _completed(self, connection, request, response, content):
+        if connection.reusable:
+            self._idle.setdefault(connection.address, []).append(connection)
+        else:
+            self._discard(connection)
+        self._dispatch()
+        request.future.set_result((response, content))
+
+    def _failed(self, connection, request, exc_info):
+        self._discard(connection)
+        retry = request is not None and request.method == 'GET' and connection.is_stale() and not request.retried
+        if retry:
+            request.retried = True
+            self._waiting.appendleft(request)
+        self._dispatch()
+        if request is not None and not retry:
+            request.future.set_exception(exc_info)
+
+
+class AsyncGitHub(object):
+    """Deliver the resources of the blocking `github` client without blocking, keeping up to `max_connections`
+    requests in flight at a time. The response cache and rate limit budget of `github` are shared.
+
+    """
+
+    def __init__(self, github, max_connections=100, timeout=30, loop=None, ssl_context=None):
+        self.github = github
+        self.loop = loop or EventLoop()
+        self.http = AsyncHttp(self.loop, max_connections=max_connections, timeout=timeout, ssl_context=ssl_context)
+
+    def close(self):
+        self.http.close()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        """Return a `Future` of the `(response, content)` of a request, made like the `GitHubHttp` of `github`
+        makes it.
+
+        """
+
+        github_http = self.github.http
+        future = Future(self.loop)
+
+        def start():
+            request_headers, cached = github_http.prepare(uri, method, headers)
+            self.http.request(uri, method, body, request_headers).then(
+                lambda (response, content): github_http.complete(uri, method, cached, response, content)
+            ).add_done_callback(lambda done: future._finish(done._result, done._exc_info))
+
+        delay = github_http.rate_limit.reserve() if github_http.is_budgeted(uri) else 0
+        if delay > 0:
+            self.loop.call_later(delay, start)
+        else:
+            start()
+        return future
+
+    def deliver(self, resource):
+        """Return a `Future` of `resource` once delivered. It's an undelivered resource like the listing returned
+        by `Issues.by_repository`.
+
+        """
+
+        if resource._delivered:
+            return resolved(self.loop, resource)
+
+        request = resource.get_request(**resource._get_kwargs)
+
+        def update((response, content)):
+            resource.update_from_response(request['uri'], response, content)
+            return resource
+
+        return self.request(**request).then(update)
+
+    def deliver_all(self, listing):
+        """Return a `Future` of `listing` once delivered with the entries of all its pages, like a listing
+        retrieved with `all_pages`.
+
+        When the listing says how many pages there are, the remaining ones are all requested at once. Otherwise
+        they are followed one at a time.
+
+        """
+
+        cls = type(listing)
+
+        def extend(pages):
+            for page in pages:
+                listing.entries.extend(page.entries)
+            # The pages have all been followed.
+            listing._next_page_url = None
+            return listing
+
+        def follow(page):
+            next_page_url = getattr(page, '_next_page_url', None)
+            if not next_page_url:
+                return extend([])
+
+            def followed(next_page):
+                listing.entries.extend(next_page.entries)
+                return follow(next_page)
+
+            return self.deliver(cls.get(next_page_url)).then(followed)
+
+        def delivered(listing):
+            page_count = listing.get_page_count() if getattr(listing, '_last_page_url', None) else None
+            if not page_count:
+                return follow(listing)
+
+            urls = [cls.page_url(listing._last_page_url, page=page) for page in range(2, page_count + 1)]
+            return gather(self.loop, [self.deliver(cls.get(url)) for url in urls]).then(extend)
+
+        return self.deliver(listing).then(delivered)
+
+    def patch(self, resource, **kwargs):
+        """Return a `Future` of `resource` once altered with `kwargs`, like `resource.patch(**kwargs)`."""
+
+        location = getattr(resource, 'url', None) or getattr(resource, '_location', None)
+        request = resource.get_request(url=location, method='PATCH', body=json.dumps(kwargs), headers={'content-type': resource.content_types[0]})
+
+        def update((response, content)):
+            resource.update_from_response(location, response, content)
+            return resource
+
+        return self.request(**request).then(update)
+
+    def post(self, listing, resource):
+        """Return a `Future` of `resource` once added to `listing`, like `listing.post(resource)`."""
+
+        request = resource.get_request(url=listing._location, method='POST', body=json.dumps(resource.to_dict(), default=omit_nulls), headers={'content-type': listing.content_types[0]})
+
+        def update((response, content)):
+            resource.update_from_response(listing._location, response, content)
+            return resource
+
+        return self.request(**request).then(update)
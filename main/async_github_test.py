@@ -0,0 +1,294 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from mock import patch
+import BaseHTTPServer
+import SocketServer
+import json
+import logbook
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import unittest
+
+from async_github import AsyncGitHub, EventLoop, gather
+from http_cache import ResponseCache
+from mini_github3 import GitHub
+
+CERTIFICATE = os.path.join(os.path.dirname(__file__), 'test_fixtures', 'localhost.pem')
+
+
+def load_fixture(name):
+    with open(os.path.join(os.path.dirname(__file__), 'test_fixtures', name), 'rb') as inf:
+        return json.load(inf)
+
+
+class FakeGitHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.fake.connections.append(self.connection)
+
+    def do_GET(self):
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        self.server.fake.requests.append((self.command, self.path, dict(self.headers), body, self.client_address[1]))
+        status, headers, content = self.server.fake.respond(self.command, self.path, self.headers, body)
+
+        self.send_response(status)
+        headers = dict({'Content-Type': 'application/json; charset=utf-8'}, **headers)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if headers.get('Transfer-Encoding') == 'chunked':
+            self.end_headers()
+            for n in range(0, len(content), 10):
+                self.wfile.write('%x\r\n%s\r\n' % (len(content[n:n + 10]), content[n:n + 10]))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    do_PATCH = do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGitHubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Such as a client closing its connection without saying so. Tests find out about anything else.
+        pass
+
+
+class FakeGitHub(object):
+    """A stand-in for the GitHub API, serving `routes` from a path to a `(status, headers, content)` tuple, or a
+    function of the request returning one.
+
+    """
+
+    def __init__(self, tls=False):
+        self.routes = {}
+        self.requests = []
+        self.connections = []
+        self.server = FakeGitHubServer(('127.0.0.1', 0), FakeGitHubHandler)
+        self.server.fake = self
+        if tls:
+            self.server.socket = ssl.wrap_socket(self.server.socket, certfile=CERTIFICATE, server_side=True)
+        self.endpoint = '%s://localhost:%d/' % ('https' if tls else 'http', self.server.server_address[1])
+
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # Let go of the connections clients keep alive, so that the threads serving them finish.
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def respond(self, method, path, headers, body):
+        route = self.routes.get(path)
+        if route is None:
+            return 404, {}, json.dumps({'message': 'Not Found'})
+        if callable(route):
+            return route(method, headers, body)
+        status, headers, content = route
+        return status, headers, content if isinstance(content, str) else json.dumps(content)
+
+
+class TestAsyncGitHub(unittest.TestCase):
+    def setUp(self):
+        self.log_handler = logbook.TestHandler()
+        self.log_handler.push_thread()
+
+        self.fake = FakeGitHub()
+        self.endpoint = patch.object(GitHub, 'endpoint', self.fake.endpoint)
+        self.endpoint.start()
+
+        self.directory = tempfile.mkdtemp()
+        self.github = GitHub('sekrit', response_cache=ResponseCache(self.directory))
+        self.client = AsyncGitHub(self.github, max_connections=100, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.endpoint.stop()
+        self.fake.close()
+        shutil.rmtree(self.directory)
+        self.log_handler.pop_thread()
+
+    def test_deliver(self):
+        self.fake.routes['/repos/alice_tester/blox/issues/1'] = (200, {}, load_fixture('issues.json')[0])
+
+        issue = self.client.deliver(self.github.Issue.by_number('alice_tester', 'blox', 1)).get()
+
+        self.assertEquals(issue.title, load_fixture('issues.json')[0]['title'])
+        method, path, headers, body, port = self.fake.requests[0]
+        self.assertEquals(headers['authorization'], 'token sekrit')
+        # The issue makes its own requests through the same client as usual.
+        self.assertTrue(issue._github is self.github)
+
+    def test_not_found(self):
+        future = self.client.deliver(self.github.Issue.by_number('alice_tester', 'blox', 2))
+        self.assertRaises(self.github.Issue.NotFound, future.get)
+
+    def test_connection_refused(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        future = self.client.request('http://127.0.0.1:%d/' % port)
+        self.assertRaises(socket.error, future.get)
+
+    def test_closed_after_response(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def serve():
+            connection, address = listener.accept()
+            connection.recv(65536)
+            # The whole response and the end of the connection, which the client may well read all at once.
+            connection.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok')
+            connection.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+        response, content = self.client.request('http://127.0.0.1:%d/' % listener.getsockname()[1]).get()
+        thread.join(5)
+        listener.close()
+
+        self.assertEquals(response.status, 200)
+        self.assertEquals(content, 'ok')
+
+    def test_deliver_all(self):
+        labels = load_fixture('labels.json')
+        url = '/repos/alice_tester/blox/labels?per_page=2'
+        link = '<%srepos/alice_tester/blox/labels?page=%%d&per_page=2>; rel="%%s"' % self.fake.endpoint
+        pages = [labels[n:n + 2] for n in range(0, len(labels), 2)]
+        self.fake.routes[url] = (200, {'Link': ', '.join([link % (2, 'next'), link % (len(pages), 'last')])}, pages[0])
+        for n, page in enumerate(pages[1:], 2):
+            self.fake.routes['/repos/alice_tester/blox/labels?page=%d&per_page=2' % n] = (200, {}, page)
+
+        listing = self.client.deliver_all(self.github.Labels.by_repository('alice_tester', 'blox', per_page=2)).get()
+
+        self.assertEquals([label.name for label in listing.entries], [label['name'] for label in labels])
+        self.assertEquals(len(self.fake.requests), len(pages))
+
+        # Without a rel="last" link, the pages are followed one at a time.
+        self.fake.routes[url] = (200, {'Link': link % (2, 'next')}, pages[0])
+        for n, page in enumerate(pages[1:-1], 2):
+            self.fake.routes['/repos/alice_tester/blox/labels?page=%d&per_page=2' % n] = (200, {'Link': link % (n + 1, 'next')}, page)
+
+        listing = self.client.deliver_all(self.github.Labels.by_repository('alice_tester', 'blox', per_page=2)).get()
+
+        self.assertEquals([label.name for label in listing.entries], [label['name'] for label in labels])
+
+    def test_many_in_flight(self):
+        in_flight = [0]
+        all_arrived = threading.Condition()
+        count = 50
+
+        def respond(method, headers, body):
+            # Only respond once every request has arrived, which they can only do if they're all in flight at once.
+            with all_arrived:
+                in_flight[0] += 1
+                all_arrived.notify_all()
+                while in_flight[0] < count:
+                    all_arrived.wait(5)
+            return 200, {}, '[]'
+
+        issues = load_fixture('issues.json')
+        issues = [self.github.Issue.from_dict(dict(issues[n % len(issues)], number=n, comments=1, url='%srepos/alice_tester/blox/issues/%d' % (self.fake.endpoint, n))) for n in range(count)]
+        for issue in issues:
+            self.fake.routes['/repos/alice_tester/blox/issues/%d/comments?per_page=100' % issue.number] = respond
+
+        comments = gather(self.client.loop, [self.client.deliver_all(self.github.Comments.by_issue(issue, per_page=100)) for issue in issues]).get()
+
+        self.assertEquals(len(comments), count)
+        self.assertEquals(in_flight[0], count)
+
+    def test_keep_alive(self):
+        self.client = AsyncGitHub(self.github, max_connections=2, loop=EventLoop())
+        self.fake.routes['/repos/alice_tester/blox/labels'] = (200, {}, load_fixture('labels.json'))
+
+        labels = [self.client.deliver(self.github.Labels.by_repository('alice_tester', 'blox')) for n in range(10)]
+        gather(self.client.loop, labels).get()
+
+        self.assertEquals(len(self.fake.requests), 10)
+        self.assertTrue(len(set(port for method, path, headers, body, port in self.fake.requests)) <= 2)
+
+    def test_chunked(self):
+        self.fake.routes['/repos/alice_tester/blox/milestones?state=open'] = (200, {'Transfer-Encoding': 'chunked'}, load_fixture('milestones.json'))
+
+        milestones = self.client.deliver(self.github.Milestones.by_repository('alice_tester', 'blox')).get()
+
+        self.assertEquals([milestone.title for milestone in milestones.entries], [milestone['title'] for milestone in load_fixture('milestones.json')])
+
+    def test_conditional_requests(self):
+        self.fake.routes['/repos/alice_tester/blox/labels'] = (200, {'ETag': '"abc"'}, load_fixture('labels.json'))
+        self.client.deliver(self.github.Labels.by_repository('alice_tester', 'blox')).get()
+
+        self.fake.routes['/repos/alice_tester/blox/labels'] = lambda method, headers, body: (304, {}, '') if headers.get('if-none-match') == '"abc"' else (500, {}, '')
+        response, content = self.client.request(self.github.Labels.by_repository('alice_tester', 'blox')._location).get()
+
+        self.assertTrue(response.fromcache)
+        self.assertEquals(json.loads(content), load_fixture('labels.json'))
+
+    def test_patch_and_post(self):
+        data = load_fixture('issues.json')[0]
+        issue_url = '/repos/alice_tester/blox/issues/%d' % data['number']
+        data['url'] = self.fake.endpoint + issue_url[1:]
+        self.fake.routes[issue_url] = lambda method, headers, body: (200, {}, json.dumps(dict(data, **json.loads(body))))
+        self.fake.routes[issue_url + '/comments'] = lambda method, headers, body: (201, {'Location': data['url'] + '/comments/5'}, json.dumps(dict(json.loads(body), id=5)))
+        issue = self.github.Issue.from_dict(data)
+
+        self.client.patch(issue, state='closed').get()
+        comments = self.github.Comments.for_issue(issue)
+        comment = self.client.post(comments, self.github.Comment.from_dict({'body': 'Closed.'})).get()
+
+        self.assertEquals(issue.state, 'closed')
+        self.assertEquals(comment.id, 5)
+        self.assertEquals([(method, json.loads(body)) for method, path, headers, body, port in self.fake.requests], [('PATCH', {'state': 'closed'}), ('POST', {'body': 'Closed.'})])
+
+
+class TestAsyncGitHubTls(unittest.TestCase):
+    def test_deliver(self):
+        fake = FakeGitHub(tls=True)
+        try:
+            with patch.object(GitHub, 'endpoint', fake.endpoint):
+                fake.routes['/repos/alice_tester/blox/labels'] = (200, {}, load_fixture('labels.json'))
+                github = GitHub('sekrit')
+                client = AsyncGitHub(github, ssl_context=ssl.create_default_context(cafile=CERTIFICATE))
+
+                labels = client.deliver(github.Labels.by_repository('alice_tester', 'blox')).get()
+                client.close()
+        finally:
+            fake.close()
+
+        self.assertEquals(len(labels.entries), len(load_fixture('labels.json')))
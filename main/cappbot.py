@@ -55,31 +55,43 @@ Perform various automation and paper trail functionality on GitHub issues to aug
 #
 # We also need to check user permissions so that not just anyone can change issues.
 
+from collections import deque
+from functools import partial
 from operator import attrgetter
 import argparse
+import copy
 import datetime
 import imp
-import json
+import itertools
 import logbook
 import os
 import re
+import signal
+import socket
 import sys
+import threading
 import time
-import shutil
 
 import iso8601
 
-from mini_github3 import GitHub
-
-ADD_LABEL_REGEX = re.compile(r'^\+([-\w\d _#]*[-\w\d_#]+)$|^(#[-\w\d _#]*[-\w\d_#]+)$')
-REMOVE_LABEL_REGEX = re.compile(r'^-([-\w\d _#]*[-\w\d_#]+)$')
-SET_MILESTONE_REGEX = re.compile(r'^milestone=(.*)$')  # Assume pretty much any character is valid in a milestone title.
-SET_ASSIGNEE_REGEX = re.compile(r'^assignee=([-\w\d_#]*)$')
-
-VOTE_REGEX = re.compile(r'^[-\+][01]$')
+from async_github import AsyncGitHub, resolved
+from catalog import RepositoryCatalog
+from comment_commands import ADD_LABEL, REMOVE_LABEL, SET_ASSIGNEE, SET_MILESTONE, VOTE, scan_commands
+from http_cache import ResponseCache
+from label_rules import LabelRules
+from mini_github3 import GitHub, Gone, Issue, LabelSummary, RateLimitBudget
+from multiprocessing.pool import ThreadPool
+from repositories import RepositoryScheduler, get_repository_settings
+from sharding import ShardCoordinator, SqliteLeases
+from store import JsonStore, LazyStore, migrate, open_store
+from webhook import WebhookServer
+from write_queue import RECORD, WritePacer, WriteQueue
 
 TITLE_VOTE_REGEX = re.compile(r' \[[-+]\d+\]$')
 
+# The YYYY-MM-DDTHH:MM:SSZ format GitHub uses for timestamps like updated_at.
+GITHUB_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
 
 def is_issue_new(issue):
     """Return True if an issue hasn't been manually configured before CappBot got to it."""
@@ -97,16 +109,129 @@ def get_user_login(user):
     return user.login if user else None
 
 
+def load_settings(path):
+    """Load the settings file at `path` as a module of its own, leaving any settings loaded before untouched even if
+    it fails to load.
+
+    """
+
+    settings = imp.new_module('settings')
+    settings.__file__ = path
+    execfile(path, settings.__dict__)
+    return settings
+
+
+def get_mtime(path):
+    """Return the modification time of the file at `path`, or None if it can't be found, such as while it's being
+    replaced.
+
+    """
+
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def create_github(settings):
+    """Create a GitHub API client as configured by `settings`."""
+
+    response_cache = ResponseCache(settings.RESPONSE_CACHE, settings.RESPONSE_CACHE_MAX_SIZE) if settings.RESPONSE_CACHE else None
+    rate_limit = RateLimitBudget(cycle=settings.RUN_INTERVAL) if settings.AVOID_RATE_LIMIT else None
+    return GitHub(api_token=settings.GITHUB_TOKEN, response_cache=response_cache, pool_size=settings.HTTP_POOL_SIZE, timeout=settings.HTTP_TIMEOUT, rate_limit=rate_limit)
+
+
+def shut_down(cappbots, coordinator, stores, timeout):
+    """Stop writing, give up the leases of `coordinator`, if any, and save and close `stores`, in that order.
+
+    A write being made is waited for, up to `timeout` seconds, before the leases are given up, since whoever takes
+    over a repository resumes the writes which are still pending. If it doesn't finish in time, the leases are left
+    to run out instead.
+
+    """
+
+    stopped = all([cappbot.writes.stop(timeout) for cappbot in cappbots])
+    if coordinator is not None:
+        if stopped:
+            coordinator.release_all()
+        else:
+            logbook.warning(u"Still making a write. Leaving the leases to run out rather than giving them up.")
+    for store in stores:
+        store.save()
+        store.close()
+
+
+class CommentBatch(object):
+    """The comments of up to `size` issues, retrieved together by `retrieve`, on one of `workers`, as soon as the
+    batch is full or the comments of one of its issues are needed, whichever comes first.
+
+    Like the `AsyncResult` of a single retrieval, `ready` tells whether the comments are in and `get` waits for them.
+
+    """
+
+    def __init__(self, retrieve, workers, size):
+        self.retrieve = retrieve
+        self.workers = workers
+        self.size = size
+        self.issues = []
+        self._result = None
+
+    @property
+    def sent(self):
+        return self._result is not None
+
+    def add(self, issue):
+        self.issues.append(issue)
+        if len(self.issues) >= self.size:
+            self.send()
+        return self
+
+    def send(self):
+        if self._result is None:
+            self._result = self.workers.apply_async(self.retrieve, (self.issues,))
+
+    def ready(self):
+        return self._result is not None and self._result.ready()
+
+    def get(self):
+        self.send()
+        return self._result.get()
+
+
 class CappBot(object):
-    def __init__(self, settings, database, dry_run=False, memorise_forgotten=False, ignore=None):
-        self.settings = settings
-        self.github = GitHub(api_token=settings.GITHUB_TOKEN)
-        self.repo_user, self.repo_name = settings.GITHUB_REPOSITORY.split("/")
-        self.database = database
+    def __init__(self, settings, store, dry_run=False, memorise_forgotten=False, ignore=None, github=None, pacer=None):
+        # A client shared with the CappBots of other repositories, if any, rather than one created from the settings,
+        # along with the pacing of writes, since GitHub limits how quickly content is created per user.
+        self.shared_github = github
+        self.configure(settings)
+        self.store = store
+        self.writes = WriteQueue(store, self.perform_write, min_interval=settings.UPDATE_DELAY, pacer=pacer)
+        # The id of the first write made to the issue being handled, if any.
+        self._change = None
         self.dry_run = dry_run
         self.memorise_forgotten = memorise_forgotten
         self.ignore = set(ignore) if ignore else set()
 
+    def configure(self, settings):
+        """Start using `settings`, which may replace previously used settings."""
+
+        self.settings = settings
+        self.github = self.shared_github or create_github(settings)
+        if getattr(self, 'async_github', None):
+            self.async_github.close()
+        self.async_github = AsyncGitHub(self.github, max_connections=settings.ASYNC_REQUESTS, timeout=settings.HTTP_TIMEOUT) if settings.ASYNC_REQUESTS else None
+        self.repo_user, self.repo_name = settings.GITHUB_REPOSITORY.split("/")
+        self.label_rules = LabelRules.from_settings(settings)
+
+        if getattr(self, 'writes', None):
+            self.writes.pacer.min_interval = settings.UPDATE_DELAY
+
+        # Anything derived from the previous settings has to be loaded again.
+        self.catalog = None
+        self._current_user = None
+        self._repository_metadata_loaded_at = None
+        self._next_events_poll = None
+
     def get_current_user(self):
         if not getattr(self, '_current_user', None):
             self._current_user = self.github.current_user()
@@ -116,9 +241,7 @@ class CappBot(object):
     def has_seen_issue(self, issue):
         """Return true if the issue is in our database."""
 
-        db = self.database
-
-        return 'issues' in db and db['issues'].get(unicode(issue.id)) is not None
+        return self.store.get_issue(issue.id) is not None
 
     def last_seen_issue_update(self, issue):
         """Return the last seen updated_at time in YYYY-MM-DDTHH:MM:SSZ string format.
@@ -127,23 +250,180 @@ class CappBot(object):
 
         """
 
-        if not self.has_seen_issue(issue):
+        record = self.store.get_issue(issue.id)
+        if record is None:
             return None
-        return self.database['issues'][unicode(issue.id)].get('updated_at')
+        return record.get('updated_at')
 
     def get_first_run_date(self):
-        if not self.database.get('first_run'):
-            self.database['first_run'] = datetime.datetime.now().isoformat()
-        return iso8601.parse_date(self.database['first_run'])
+        if not self.store.get('first_run'):
+            self.store.set('first_run', datetime.datetime.now().isoformat())
+        return iso8601.parse_date(self.store.get('first_run'))
     first_run_date = property(get_first_run_date)
 
-    def record_issue(self, issue):
-        """Record the information we need to detect whether an issue has been changed."""
+    def is_full_scan_due(self):
+        """Return True if every issue should be listed this run rather than just the recently updated ones."""
+
+        last_full_scan = self.store.get('last_full_scan')
+        if not self.settings.FULL_SCAN_INTERVAL or not last_full_scan or not self.store.get('newest_listed_update'):
+            return True
+
+        elapsed = datetime.datetime.utcnow() - datetime.datetime.strptime(last_full_scan, GITHUB_DATE_FORMAT)
+        return elapsed.total_seconds() >= self.settings.FULL_SCAN_INTERVAL
 
-        db = self.database
+    def list_issues(self):
+        """List the issues which might have changed since the last run.
 
-        if not 'issues' in db:
-            db['issues'] = {}
+        Only issues updated since the newest update seen in a previous listing are requested, so the cost of a
+        run scales with activity rather than with the size of the repository. Every FULL_SCAN_INTERVAL seconds all
+        issues are listed instead to catch any changes which did not bump an issue's updated_at.
+
+        With POLL_EVENTS the repository's events are consulted first, and issues are only listed when the events
+        can't tell which issues have changed.
+
+        Listed issues are returned as an iterator, which yields the issues of each page of the listing as soon as
+        that page has arrived.
+
+        """
+
+        self._newest_event_id = None
+        self._listed_by_events = False
+        self._held_back = False
+        if self.settings.POLL_EVENTS:
+            issues = self.list_issues_by_events()
+            if issues is not None:
+                self._full_scan_started = None
+                self._listed_by_events = True
+                return issues
+
+        if self.is_full_scan_due():
+            self._full_scan_started = datetime.datetime.utcnow().strftime(GITHUB_DATE_FORMAT)
+            logbook.debug("Listing all issues.")
+            return self.github.IssueSummaries.by_repository(self.repo_user, self.repo_name, state='all', per_page=100).iter_all()
+
+        self._full_scan_started = None
+        since = self.store.get('newest_listed_update')
+        logbook.debug("Listing issues updated since %s." % since)
+        return self.github.IssueSummaries.by_repository_since(self.repo_user, self.repo_name, since, per_page=100).iter_all()
+
+    def list_issues_by_events(self):
+        """Return the issues named by the repository events since the newest event seen in a previous run, or
+        None if the issues have to be listed instead.
+
+        The events are requested with the ETag of the previous response, so when nothing has happened the answer
+        is a "not modified" which doesn't count against the rate limit. GitHub's X-Poll-Interval is honoured: until
+        it has passed no issues are returned at all.
+
+        """
+
+        if self._next_events_poll and time.time() < self._next_events_poll:
+            logbook.debug("Not polling events again until %s." % time.ctime(self._next_events_poll))
+            return []
+
+        newest_seen = self.store.get('newest_event_id')
+        events = self.github.Events.by_repository_since(self.repo_user, self.repo_name, newest_seen, per_page=100)
+        if events is None:
+            # More has happened than the feed holds. Remember where the feed starts now and look at everything.
+            logbook.info("Missed some events, falling back to a full scan.")
+            events = self.github.Events.by_repository(self.repo_user, self.repo_name, per_page=100)
+            self.store.set('last_full_scan', None)
+            newest_seen = None
+
+        # Deliver the events before asking for the poll interval, which comes with them.
+        if len(events):
+            self._newest_event_id = int(events[0].id)
+        if events.get_poll_interval():
+            self._next_events_poll = time.time() + events.get_poll_interval()
+
+        # With nothing to compare against, the events can't say what has changed.
+        if newest_seen is None or self.is_full_scan_due():
+            return None
+
+        numbers = set()
+        for event in events:
+            # Comments count too, since that's where commands and votes are.
+            if event.type in ('IssuesEvent', 'IssueCommentEvent'):
+                numbers.add(int(event.payload['issue']['number']))
+            elif event.type == 'PullRequestEvent':
+                numbers.add(int(event.payload['number']))
+
+        logbook.debug("%d new event(s) name %d issue(s)." % (len(events), len(numbers)))
+        return self.get_issues_by_number(sorted(numbers))
+
+    def get_issues_by_number(self, numbers):
+        """Return the issues with the given numbers, leaving out those which are no longer in the repository."""
+
+        issues = []
+        for number in numbers:
+            issue = self.github.Issue.by_number(self.repo_user, self.repo_name, number)
+            try:
+                # Retrieve it now rather than once it's looked at, so that an issue which is gone can be left out.
+                issue.state
+            except (Issue.NotFound, Gone):
+                # Deleted or transferred to another repository since.
+                logbook.info(u"Skipping issue %d, which is no longer in the repository." % number)
+                continue
+            issues.append(issue)
+        return issues
+
+    def list_issues_to_recheck(self):
+        """Yield the issues whose changes were dropped in the previous run, so that they're looked at again even
+        though they may not be listed.
+
+        """
+
+        numbers = self.store.get('recheck_numbers') or []
+        if numbers:
+            logbook.info(u"Looking at %d issue(s) again since changes to them were dropped." % len(numbers))
+        for issue in self.get_issues_by_number(numbers):
+            yield issue
+
+    def recheck_dropped_changes(self):
+        """Have the issues whose changes were dropped since the last call looked at again by the next run, in
+        place of those which were to be looked at again by this one.
+
+        """
+
+        numbers = set()
+        for write in self.writes.take_dropped():
+            if write.get('issue_number') is None:
+                continue
+            numbers.add(write['issue_number'])
+            # The record of the issue was left as it was before the change, but an issue which hasn't been updated
+            # since would still be taken to be unchanged.
+            record = self.store.get_issue(write['issue_id'])
+            if record is not None:
+                record['updated_at'] = None
+                self.store.put_issue(write['issue_id'], record)
+        self.store.set('recheck_numbers', sorted(numbers))
+
+    def record_listed_issues(self, newest_update):
+        """Record `newest_update`, the newest update among the listed issues, which have now all been processed,
+        so that the next run only needs to list issues updated after it.
+
+        """
+
+        if self._held_back:
+            # Issues left alone until their pending changes have been made have to be listed again.
+            return
+
+        if self._newest_event_id is not None:
+            self.store.set('newest_event_id', self._newest_event_id)
+
+        # Issues named by events may not be all the issues updated before the newest of them, so they can't
+        # advance the listing's starting point.
+        if self._listed_by_events:
+            return
+
+        # The timestamps all have the same format so they can be compared as strings.
+        if newest_update and newest_update > self.store.get('newest_listed_update'):
+            self.store.set('newest_listed_update', newest_update)
+
+        if self._full_scan_started:
+            self.store.set('last_full_scan', self._full_scan_started)
+
+    def record_issue(self, issue):
+        """Record the information we need to detect whether an issue has been changed."""
 
         db_issue = {
             'id': int(issue.id),
@@ -154,15 +434,16 @@ class CappBot(object):
             'labels': sorted(label.name for label in issue.labels),
             'updated_at': issue.updated_at  # (as a string)
         }
+        if getattr(issue, '_comments_seen_at', None):
+            # Comments are retrieved from here on next time, so that any added or edited while they weren't being
+            # retrieved are still seen.
+            db_issue['comments_seen_at'] = issue._comments_seen_at
 
-        # Note we need to use string keys for our JSON database's sake.
-        key = unicode(issue.id)
-        if key in db['issues']:
-            db['issues'][key].update(db_issue)
-        else:
-            db_issue['votes'] = None
-            db_issue['latest_seen_comment_id'] = None
-            db['issues'][key] = db_issue
+        record = self.store.get_issue(issue.id)
+        if record is None:
+            record = {'votes': None, 'latest_seen_comment_id': None}
+        record.update(db_issue)
+        self.store.put_issue(issue.id, record)
 
     def record_latest_seen_comment(self, issue):
         """Record the id of the newest comment so we can recognise new comments in the future,
@@ -170,15 +451,28 @@ class CappBot(object):
 
         """
 
-        db = self.database
+        record = self.store.get_issue(issue.id)
+        if not issue._comments_since:
+            record['latest_seen_comment_id'] = issue._comments[-1].id if issue._comments else None
+        elif issue._comments:
+            # Only comments updated since were retrieved, which may be older ones which were edited, so the latest
+            # seen one only ever moves forward.
+            record['latest_seen_comment_id'] = max(record['latest_seen_comment_id'], issue._comments[-1].id)
+        self.store.put_issue(issue.id, record)
 
-        db['issues'][unicode(issue.id)]['latest_seen_comment_id'] = issue._comments[-1].id if issue._comments else None
+    def record_commented(self, issue):
+        """Remember that we have commented on the issue, which can't be told from only its newest comments."""
+
+        record = self.store.get_issue(issue.id)
+        if not record.get('cappbot_commented'):
+            record['cappbot_commented'] = True
+            self.store.put_issue(issue.id, record)
 
     def get_issue_changes(self, issue):
         """Examine the given issue against what is stored in the database to see how it's been changed, if it has."""
 
         # Issue must be recorded at this point.
-        record = self.database['issues'][unicode(issue.id)]
+        record = self.store.get_issue(issue.id)
 
         r = set()
         if set(record['labels']) != set(label.name for label in issue.labels):
@@ -190,8 +484,9 @@ class CappBot(object):
         if record['milestone_number'] != (int(issue.milestone.number) if issue.milestone else None):
             r.add('milestone')
 
-        # _comments might not have been loaded yet in which case we can't detect changes there.
-        if hasattr(issue, '_comments') and issue.comments and (record['latest_seen_comment_id'] is None or record['latest_seen_comment_id'] != int(issue._comments[-1].id)):
+        # _comments might not have been loaded yet in which case we can't detect changes there. If only new
+        # comments were retrieved there may be none.
+        if getattr(issue, '_comments', None) and issue.comments and (record['latest_seen_comment_id'] is None or record['latest_seen_comment_id'] != int(issue._comments[-1].id)):
             r.add('comments')
 
         if issue._force_paper_trail:
@@ -208,7 +503,7 @@ class CappBot(object):
 
         milestone_title = defs.get('milestone')
         if milestone_title:
-            milestone = self.github.Milestones.get_or_create_in_repository(self.repo_user, self.repo_name, milestone_title)
+            milestone = self.catalog.get_or_create_milestone(milestone_title)
             patch['milestone'] = milestone.number
 
         if defs.get('labels') is not None:
@@ -218,18 +513,63 @@ class CappBot(object):
             patch['assignee'] = defs['assignee']
 
         if len(patch):
-            if not self.dry_run:
-                try:
-                    issue.patch(**patch)
-                except:
-                    logbook.error(u"Unable to change issue %s with attributes %r" % (issue, patch))
-                    raise
+            self.patch_issue(issue, patch)
             logbook.info(u"Installed defaults %r for issue %s." % (patch, issue))
 
+    def patch_issue(self, issue, patch):
+        """Change the issue attributes in the `patch` dict with a single request.
+
+        The request is queued, and the issue is changed right away to look like it will once the request has been
+        made.
+
+        """
+
+        if not patch or self.dry_run:
+            return
+
+        self.put_write(issue, {'method': 'PATCH', 'url': issue.url, 'body': patch}, lambda: issue.patch(**patch))
+
+        for key, value in patch.items():
+            if key == 'labels':
+                value = [LabelSummary(name) for name in value]
+            elif key == 'milestone' and value is not None:
+                value = self.catalog.get_milestone_by_number(value)
+            elif key == 'assignee' and value is not None:
+                value = self.catalog.get_collaborator(value)
+            setattr(issue, key, value)
+
+    def post_comment(self, issue, body):
+        """Queue posting a comment with the given body to the issue."""
+
+        comment = self.github.Comment()
+        comment.body = body
+        comments = issue._comments
+        self.put_write(issue, {'method': 'POST', 'url': issue.url, 'body': {'body': body}}, lambda: comments.post(comment))
+
+    def put_write(self, issue, write, perform):
+        """Queue `write`, to be made by calling `perform`, as part of the change made to the issue being handled."""
+
+        write = dict(write, issue_id=issue.id, issue_number=issue.number)
+        if self._change is not None:
+            write['change'] = self._change
+        write_id = self.writes.put(write, perform)
+        if self._change is None:
+            self._change = write_id
+
+    def perform_write(self, write):
+        """Make a write left pending by a previous process."""
+
+        issue = self.github.Issue.from_dict({'url': write['url']})
+        if write['method'] == 'PATCH':
+            issue.patch(**write['body'])
+        else:
+            comment = self.github.Comment.from_dict(write['body'])
+            self.github.Comments.for_issue(issue).post(comment)
+
     def get_new_comments(self, issue):
         """Get all comments which are new since the last call to record_latest_seen_comment."""
 
-        record = self.database['issues'][unicode(issue.id)]
+        record = self.store.get_issue(issue.id)
         latest_seen_comment_id = record['latest_seen_comment_id']
 
         comments = issue._comments
@@ -270,11 +610,8 @@ class CappBot(object):
 
     def get_label_by_name(self, aLabel):
         """Get the label with the proper capitalisation among those available, or None if the label is not available."""
-        aLabel = aLabel.lower()
-        for label in self.known_labels:
-            if label.lower() == aLabel:
-                return label
-        return None
+        label = self.catalog.get_label(aLabel)
+        return label.name if label else None
 
     def get_milestone_title_by_title(self, aMilestone):
         """Get the milestone title with the proper capitalisation among those available, or None if the milestone is not available."""
@@ -282,11 +619,8 @@ class CappBot(object):
         if not aMilestone or not aMilestone.strip():
             return None
 
-        aMilestone = aMilestone.lower()
-        for milestone in self.known_milestones:
-            if milestone.lower() == aMilestone:
-                return milestone
-        return None
+        milestone = self.catalog.get_milestone(aMilestone)
+        return milestone.title if milestone else None
 
     def get_assignee_login_by_name(self, anAssignee):
         """Get the assignee login with the proper capitalisation among those available, or None if the assignee is not available.
@@ -298,11 +632,8 @@ class CappBot(object):
         if not anAssignee or not anAssignee.strip():
             return None
 
-        anAssignee = anAssignee.lower()
-        for assignee in self.collaborator_logins:
-            if assignee.lower() == anAssignee:
-                return assignee
-        return None
+        collaborator = self.catalog.get_collaborator(anAssignee)
+        return collaborator.login if collaborator else None
 
     def add_label(self, new_label, issue_working_state):
         new_label_proper = self.get_label_by_name(new_label)
@@ -312,7 +643,7 @@ class CappBot(object):
             # label was added last later.
             issue_working_state['labels'].remove(new_label_proper)
         issue_working_state['labels'].append(new_label_proper)
-        if any(l.lower() == new_label_proper.lower() for l in self.settings.CLOSE_ISSUE_WHEN_CAPPBOT_ADDS_LABEL) or self.should_open_issue is new_label_proper:
+        if self.label_rules.closes(new_label_proper) or self.should_open_issue is new_label_proper:
             self.should_open_issue = False
             self.should_close_issue = new_label_proper
 
@@ -337,14 +668,14 @@ class CappBot(object):
             return
 
         issue_working_state['labels'].remove(remove_label_proper)
-        if any(l.lower() == remove_label_proper.lower() for l in self.settings.OPEN_ISSUE_WHEN_CAPPBOT_REMOVES_LABEL) or self.should_close_issue is remove_label_proper:
+        if self.label_rules.opens(remove_label_proper) or self.should_close_issue is remove_label_proper:
             self.should_open_issue = remove_label_proper
             self.should_close_issue = False
 
     def remove_label_due_to_comment(self, remove_label, comment, issue_working_state):
         remove_label_proper = self.get_label_by_name(remove_label)
 
-        if not remove_label_proper in self.known_labels:
+        if not remove_label_proper:
             logbook.info(u'Ignoring unknown label %s in comment %s by %s.' % (remove_label, comment.id, comment.user.login))
             self.send_message(comment.user, u'Unknown label', u'(Your comment)[%s] appears to request that the label `%s` is removed from the issue but this does not seems to be a valid label.' % (comment.url, remove_label))
             return
@@ -420,63 +751,24 @@ class CappBot(object):
         logbook.debug(u"Examining %d new comment(s) for %s" % (len(new_comments), issue))
 
         for comment in new_comments:
-            if not comment.body:
-                continue
-
-            for line in comment.body.split('\n'):
-                line = line.strip()
-
-                # Votes look just like +<label> or -<label> where the label is the number 1 or 0.
-                if VOTE_REGEX.match(line):
-                    continue
-
-                m = ADD_LABEL_REGEX.match(line)
-                if m:
-                    new_label = (m.group(1) or m.group(2)).lower()
-                    self.add_label_due_to_comment(new_label, comment, issue_working_state)
-                    continue
-
-                m = REMOVE_LABEL_REGEX.match(line)
-                if m:
-                    remove_label = m.group(1).lower()
-                    self.remove_label_due_to_comment(remove_label, comment, issue_working_state)
-                    continue
-
-                m = SET_MILESTONE_REGEX.match(line)
-                if m:
-                    new_milestone = m.group(1).lower()
-                    self.set_milestone_due_to_comment(new_milestone, comment, issue_working_state)
-                    continue
-
-                m = SET_ASSIGNEE_REGEX.match(line)
-                if m:
-                    new_assignee = m.group(1).lower()
-                    self.set_assignee_due_to_comment(new_assignee, comment, issue_working_state)
-                    continue
+            for kind, argument in scan_commands(comment.body):
+                if kind == ADD_LABEL:
+                    self.add_label_due_to_comment(argument.lower(), comment, issue_working_state)
+                elif kind == REMOVE_LABEL:
+                    self.remove_label_due_to_comment(argument.lower(), comment, issue_working_state)
+                elif kind == SET_MILESTONE:
+                    self.set_milestone_due_to_comment(argument.lower(), comment, issue_working_state)
+                elif kind == SET_ASSIGNEE:
+                    self.set_assignee_due_to_comment(argument.lower(), comment, issue_working_state)
 
         return issue_working_state
 
     def updated_state_per_label_removal_rules(self, issue, issue_working_state):
         issue_working_state = issue_working_state.copy()
-        for trigger_label, labels_to_remove in self.settings.WHEN_LABEL_REMOVE_LABELS.items():
-            if trigger_label in issue_working_state['labels']:
-                for label in labels_to_remove:
-                    if label in issue_working_state['labels']:
-                        logbook.info("Removing label %s due to label %s being set." % (label, trigger_label))
-                        # This ensures that side effects of removing the label kick in.
-                        self.remove_label(label, issue_working_state)
-
-        # Remove conflicting labels.
-        backwards = list(reversed(issue_working_state['labels']))
-        for n, label in enumerate(backwards):
-            if label in self.settings.MUTUALLY_EXCLUSIVE_LABELS:
-                for other_label in backwards[n + 1:]:
-                    if other_label in self.settings.MUTUALLY_EXCLUSIVE_LABELS:
-                        logbook.info("Removing label %s due to label %s being set." % (other_label, label))
-                        # This ensures that side effects of removing the label kick in.
-                        self.remove_label(other_label, issue_working_state)
-                # We've removed all conflicting labels at this stage so we're done.
-                break
+        for label, cause in self.label_rules.conflicts(issue_working_state['labels']):
+            logbook.info("Removing label %s due to label %s being set." % (label, cause))
+            # This ensures that side effects of removing the label kick in.
+            self.remove_label(label, issue_working_state)
 
         return issue_working_state
 
@@ -486,37 +778,66 @@ class CappBot(object):
         The special syntax 0, +0 or -0 is also allowed to reset a previously made vote or to express a non counted
         opinion.
 
-        """
+        Each user's vote is recorded along with the comment it was cast in, so usually only the new comments need
+        to be searched. The whole thread is searched again when a comment may have been edited or deleted.
 
-        votes = {}
-        for comment in issue._comments:
-            if not comment.body:
-                continue
+        """
 
-            for line in comment.body.split('\n'):
-                line = line.strip()
+        record = self.store.get_issue(issue.id)
+        voters = record.get('voters')
+        if voters is None or self.may_have_changed_old_comments(issue, record):
+            if issue._comments_since:
+                comments = self.github.Comments.by_issue(issue, per_page=100, all_pages=True)
+            else:
+                comments = issue._comments
+            voters = {}
+        else:
+            comments = self.get_new_comments(issue)
+            voters = dict(voters)
 
-                if VOTE_REGEX.match(line):
+        for comment in comments:
+            for kind, argument in scan_commands(comment.body):
+                if kind == VOTE:
                     # If a user votes more than once, the final vote is what will count.
-                    votes[comment.user.login] = int(line)
+                    voters[comment.user.login] = {'vote': argument, 'comment_id': comment.id}
 
         # Differentiate between a vote of 0 (e.g. +1, -1) and no votes.
-        score = sum(votes.values()) if len(votes) else None
-        record = self.database['issues'][unicode(issue.id)]
-        if score != record['votes']:
+        score = sum(voter['vote'] for voter in voters.values()) if len(voters) else None
+        did_change = score != record['votes']
+        if did_change or voters != record.get('voters'):
             record['votes'] = score
+            record['voters'] = voters
+            self.store.put_issue(issue.id, record)
+        return did_change
+
+    def may_have_changed_old_comments(self, issue, record):
+        """Return True if a comment seen before might since have been edited or deleted."""
+
+        if not issue._comments_since:
+            # All comments were retrieved, so there's nothing to go on.
+            return True
+
+        # Only comments updated since the last seen update were retrieved. Any of those seen before have been edited.
+        latest_seen_comment_id = record['latest_seen_comment_id']
+        if any(comment.id <= latest_seen_comment_id and comment.updated_at != comment.created_at for comment in issue._comments):
             return True
-        return False
+
+        # Every comment now is either counted in the last recording or new, unless some have been deleted.
+        return issue.comments != record['comments_count'] + len(self.get_new_comments(issue))
 
     def get_vote_count(self, issue):
         """Return the vote tally for the issue."""
 
-        record = self.database['issues'][unicode(issue.id)]
+        record = self.store.get_issue(issue.id)
         return record['votes']
 
     def did_comment_on(self, issue):
         """Return true if we've commented previously on this issue."""
 
+        record = self.store.get_issue(issue.id)
+        if record is not None and record.get('cappbot_commented'):
+            return True
+
         return issue.comments > 0 and any(comment for comment in issue._comments if comment.user.login == self.current_user.login)
 
     def ensure_referenced_labels_exist(self):
@@ -524,30 +845,61 @@ class CappBot(object):
 
         defs = self.settings.NEW_ISSUE_DEFAULTS
         for label in defs.get('labels', []):
-            self.github.Labels.get_or_create_in_repository(self.repo_user, self.repo_name, label)
-
-    def delay_after_update(self):
-        """Cause a delay after each paper trail message is posted to limit the maximum rate of
-        paper trail messages per minute.
-
-        """
+            self.catalog.get_or_create_label(label)
 
-        if self.settings.UPDATE_DELAY:
-            time.sleep(self.settings.UPDATE_DELAY)
+    def prepare_handle_issue(self, issue):
+        """Prepare an issue whose comments have been retrieved and react to its changes, then let go of its
+        comments.
 
-    def check_prepare_issue(self, issue):
-        """Phase 1 issue work: record new issues, install issue defaults, mark déjà vu issues,
-        and retrieve the issue comments.
+        The issue is prepared before any change is made to it so that déjà vu is detected from its comments as
+        they were, before we added to them. Nothing else about one issue depends on another, so each can be seen
+        to completely before the next one is started.
 
         """
 
+        # A copy, since the record may be changed in place while the issue is handled.
+        previous_record = copy.deepcopy(self.store.get_issue(issue.id))
+        self._change = None
+        try:
+            self.prepare_issue(issue)
+            if not issue._should_ignore:
+                self.handle_issue_changes(issue)
+        finally:
+            if self._change is not None:
+                # Until the changes have been made the issue keeps its previous record, so that if they can't be
+                # made it's looked at again.
+                record = self.store.get_issue(issue.id)
+                if previous_record is None:
+                    self.store.delete_issue(issue.id)
+                else:
+                    self.store.put_issue(issue.id, previous_record)
+                self.put_write(issue, {'method': RECORD, 'url': issue.url, 'record': record}, None)
+                self._change = None
+
+        # Long threads take up a lot of memory and the comments aren't needed any more.
+        issue._comments = None
+
+        self.writes.collect()
+
+    def check_issue(self, issue):
+        """Return True if the issue may have changed and so needs its comments retrieved and to be prepared."""
+
         issue._should_ignore = False
         issue._force_paper_trail = False
+        issue._comments_since = None
+        issue._comments_unchanged = False
+        issue._comments_seen_at = None
+
+        if self.writes.is_pending(issue.id):
+            logbook.info("Issue %d has changes which are still to be made. Leaving it until they have been." % issue.number)
+            issue._should_ignore = True
+            self._held_back = True
+            return False
 
         if self.settings.IGNORE_CLOSED_ISSUES_NOT_UPDATED_SINCE_FIRST_RUN and issue.state == 'closed' and iso8601.parse_date(issue.updated_at) < self.first_run_date:
             logbook.debug("Issue %d has been closed since %s, before first run at %s. Ignoring." % (issue.number, issue.updated_at, self.first_run_date.isoformat()))
             issue._should_ignore = True
-            return
+            return False
 
         if self.has_seen_issue(issue) and self.last_seen_issue_update(issue) == issue.updated_at and not self.get_issue_changes(issue):
             # Note that we need to check both get_issue_changes and updated_at. The updated_at field doesn't update for every
@@ -556,20 +908,87 @@ class CappBot(object):
             # The important part here is that we don't download the Comments. Downloading all the comments for every
             # issue, on every run, is not very efficient.
             issue._should_ignore = True
+            return False
+
+        # Once the latest comment has been seen, only comments from the last seen update onwards can be new ones.
+        # Older comments are still needed to find our own paper trail until we've recorded leaving one. (This is
+        # decided here since the database may only be used from this thread.)
+        record = self.store.get_issue(issue.id)
+        if record is not None and record['latest_seen_comment_id'] is not None and record.get('cappbot_commented'):
+            if issue.comments == record['comments_count']:
+                # Most updates are label and title edits, and the comments don't need to be retrieved for those: our
+                # paper trail is known to be there already, and no comment has been added unless one was deleted
+                # too. Any comments added or edited meanwhile are seen the next time they're retrieved.
+                logbook.debug("Issue %d has no new comments. Not retrieving them." % issue.number)
+                issue._comments_unchanged = True
+            issue._comments_since = record.get('comments_seen_at', record['updated_at'])
+
+        return True
+
+    def retrieve_comments(self, issue):
+        """Download the issue comments. This only touches the issue itself so it's safe to do for several issues
+        at once on different threads.
+
+        """
+
+        if issue._comments_unchanged:
+            # There's nothing to retrieve, but there may be a paper trail to post.
+            issue._comments = self.github.Comments.for_issue(issue)
             return
 
-        # We'll need this now or later, or both.
-        issue._comments = self.github.Comments.by_issue(issue, per_page=100, all_pages=True)
+        # We'll need this now or later, or both. A thread which has been seen before is only retrieved from where
+        # we left off, since long threads take many pages.
+        issue._comments = self.github.Comments.by_issue(issue, since=issue._comments_since, per_page=100, all_pages=True)
+        issue._comments_seen_at = issue.updated_at
 
-        if self.settings.AVOID_RATE_LIMIT:
-            remaining = issue._comments.get_rate_limit_remaining()
+    def retrieve_comments_batch(self, issues):
+        """Download the comments of several issues with a single GraphQL query, like `retrieve_comments` would one
+        at a time. Only the most recent GRAPHQL_COMMENTS comments of each are in the answer, so the comments of an
+        issue with more than that are retrieved as usual.
+
+        """
+
+        wanted = []
+        for issue in issues:
+            if issue._comments_unchanged:
+                self.retrieve_comments(issue)
+            else:
+                wanted.append(issue)
+        if not wanted:
+            return
+
+        recent_comments = self.github.graphql.recent_comments(self.repo_user, self.repo_name, [issue.number for issue in wanted], count=self.settings.GRAPHQL_COMMENTS)
+        for issue in wanted:
+            comments = recent_comments.get(issue.number)
+            if comments is None or comments.total_count > len(comments.entries):
+                self.retrieve_comments(issue)
+                continue
+
+            # Every comment is there, so leave out the same ones the REST API would have.
+            if issue._comments_since:
+                comments.entries = [comment for comment in comments.entries if comment.updated_at >= issue._comments_since]
+            issue._comments = comments
+            issue._comments_seen_at = issue.updated_at
+
+    def retrieve_comments_async(self, issue):
+        """Start downloading the issue comments, like `retrieve_comments`, over the non-blocking connections of
+        `async_github`. Return a `Future` which completes once they're in.
+
+        """
 
-            # Remaining will be None if the 'empty comments' optimisation kicked in.
-            if not remaining is None:
-                delay = 3600.0 / max(1, remaining)
-                if delay > 1:
-                    logbook.debug("Approaching rate limit (%d requests remaining). Sleeping for %.1fs." % (remaining, delay))
-                    time.sleep(delay)
+        if issue._comments_unchanged:
+            issue._comments = self.github.Comments.for_issue(issue)
+            return resolved(self.async_github.loop, issue._comments)
+
+        def retrieved(comments):
+            issue._comments = comments
+            issue._comments_seen_at = issue.updated_at
+
+        comments = self.github.Comments.by_issue(issue, since=issue._comments_since, per_page=100)
+        return self.async_github.deliver_all(comments).then(retrieved)
+
+    def prepare_issue(self, issue):
+        """Record the issue if it's new and install its defaults, now that its comments have been retrieved."""
 
         if self.has_seen_issue(issue):
             # It's not a new issue if we have recorded it previously.
@@ -581,6 +1000,7 @@ class CappBot(object):
             if self.memorise_forgotten:
                 logbook.warning(u"Déjà vu: it looks like CappBot has interacted with %s but it's not in the database. Recording it now." % issue)
                 self.record_issue(issue)
+                self.record_commented(issue)
                 self.recount_votes(issue)
                 self.record_latest_seen_comment(issue)
                 issue._should_ignore = True
@@ -603,7 +1023,9 @@ class CappBot(object):
         self.record_issue(issue)
 
     def handle_issue_changes(self, issue):
-        if not self.did_comment_on(issue):
+        if self.did_comment_on(issue):
+            self.record_commented(issue)
+        else:
             # This issue might not have been changed since we first saw it, but we've never commented
             # on it so there's no paper trail yet.
             issue._force_paper_trail = True
@@ -614,10 +1036,9 @@ class CappBot(object):
         changes = self.get_issue_changes(issue)
 
         if not changes:
-            # Make sure we capture the update time so we don't need to run the expensive
+            # Make sure we capture the update time and comment count so we don't need to run the expensive
             # comments check again in the future while this issue remains unchanged.
-            if self.last_seen_issue_update(issue) is None:
-                self.record_issue(issue)
+            self.record_issue(issue)
 
             logbook.debug(u"No changes for %s" % issue)
             return
@@ -629,44 +1050,35 @@ class CappBot(object):
         if 'comments' in changes:
             # Check for action comments which change labels, milestones or assigngee.
             issue_working_state = self.updated_state_by_interpreting_new_comments(issue, issue_working_state)
-            self.record_latest_seen_comment(issue)
 
-            # Count votes.
+            # Count votes, while the new comments can still be told apart.
             did_change_votes = self.recount_votes(issue)
+            self.record_latest_seen_comment(issue)
 
         # Remove labels superseded by new labels.
         issue_working_state = self.updated_state_per_label_removal_rules(issue, issue_working_state)
 
-        # Perform each patch separately so that an error with one does not disrupt the others.
+        # Collect every changed field so that the issue can be updated with a single request.
+        patch = {}
+
         if set(issue_working_state['labels']) != set(original_labels):
             changes.add('labels')
-            if not self.dry_run:
-                try:
-                    issue.patch(labels=sorted(map(unicode, issue_working_state['labels'])))
-                except:
-                    logbook.error(u"Unable to set %s labels to %s" % (issue, sorted(map(unicode, issue_working_state['labels']))))
-                    raise
+            patch['labels'] = sorted(map(unicode, issue_working_state['labels']))
 
         if issue_working_state['milestone'] != get_milestone_title(issue.milestone):
             changes.add('milestone')
             if not self.dry_run:
                 try:
-                    milestone = self.github.Milestones.get_or_create_in_repository(self.repo_user, self.repo_name, issue_working_state['milestone'])
-                    issue.patch(milestone=milestone.number if milestone else None)
+                    milestone = self.catalog.get_or_create_milestone(issue_working_state['milestone'])
                 except:
                     logbook.error(u"Unable to set %s milestone to %s" % (issue, issue_working_state['milestone']))
                     raise
+                patch['milestone'] = milestone.number if milestone else None
 
         if issue_working_state['assignee'] != get_user_login(issue.assignee):
             changes.add('assignee')
-            if not self.dry_run:
-                try:
-                    issue.patch(assignee=issue_working_state['assignee'])
-                except:
-                    logbook.error(u"Unable to set %s assignee to %s" % (issue, issue_working_state['assignee']))
-                    raise
+            patch['assignee'] = issue_working_state['assignee']
 
-        # Post paper trail.
         changes = changes.difference(set(['comments']))
         if did_change_votes:
             changes.add('votes')
@@ -683,86 +1095,275 @@ class CappBot(object):
             elif m:
                 logbook.info(u"Clearing vote from title of %s: '%s'" % (issue, issue_title))
 
-            if not self.dry_run:
-                try:
-                    issue.patch(title=issue_title)
-                except:
-                    logbook.error(u"Unable to set the title of %s to %s" % (issue, issue_title))
-                    raise
+            patch['title'] = issue_title
 
         if issue_working_state['labels'] != original_labels:
             changes.add('labels')
-        if len(changes):
-            # If we're going to reopen the issue, do that before leaving the paper trail.
-            if self.should_open_issue and issue.state != 'open':
-                logbook.info(u'Reopening %s due to label %s being removed' % (issue, self.should_open_issue))
-                if not self.dry_run:
-                    try:
-                        issue.patch(state="open")
-                    except:
-                        logbook.error(u"Unable to open %s" % issue)
-                        raise
 
+        # If we're going to reopen the issue, do that along with the other changes, before leaving the paper trail.
+        if len(changes) and self.should_open_issue and issue.state != 'open':
+            logbook.info(u'Reopening %s due to label %s being removed' % (issue, self.should_open_issue))
+            patch['state'] = 'open'
+
+        self.patch_issue(issue, patch)
+
+        # Post paper trail.
+        if len(changes):
             # Note that we assume the issue_working_state has been properly installed into the issue. This
             # makes the messages appear right in dry-run mode. However, if say the assignee wasn't successfully
             # changed, CappBot's message might suggest it was. I think that's fine.
             msg = self.settings.getPaperTrailMessage(issue_working_state['assignee'], issue_working_state['milestone'], issue_working_state['labels'], self.get_vote_count(issue))
-            comment = self.github.Comment()
-            comment.body = msg
             logbook.info(u"Adding paper trail for %s (changes: %s): '%s'" % (issue, ", ".join(changes), msg))
             if not self.dry_run:
-                try:
-                    issue._comments.post(comment)
-                except:
-                    logbook.error(u"Unable to comment on %s" % issue)
-                    raise
+                self.post_comment(issue, msg)
+                self.record_commented(issue)
                 self.record_latest_seen_comment(issue)
-                self.delay_after_update()
 
             # Close the issue after leaving the paper trail. It looks more natural.
             if self.should_close_issue and issue.state != 'closed':
                 logbook.info(u'Closing %s due to label %s being added' % (issue, self.should_close_issue))
-                if not self.dry_run:
-                    try:
-                        issue.patch(state="closed")
-                    except:
-                        logbook.error(u"Unable to close %s" % issue)
-                        raise
+                self.patch_issue(issue, {'state': 'closed'})
 
         # Now record the latest labels etc so we don't react to these same changes the next time.
         self.record_issue(issue)
 
-    def run(self):
-        logbook.debug("Logged in as %s." % self.current_user.login)
+    def is_repository_metadata_stale(self):
+        """Return True if the repository metadata hasn't been loaded within METADATA_REFRESH_INTERVAL seconds."""
 
-        self.ensure_referenced_labels_exist()
+        loaded_at = self._repository_metadata_loaded_at
+        return loaded_at is None or time.time() - loaded_at >= self.settings.METADATA_REFRESH_INTERVAL
+
+    def load_repository_metadata(self):
+        """Load the labels, milestones and collaborators of the repository."""
 
-        self.known_labels = set(label.name for label in self.github.Labels.by_repository(self.repo_user, self.repo_name, per_page=100, all_pages=True))
+        self._repository_metadata_loaded_at = time.time()
 
-        self.known_milestones = set(milestone.title for milestone in self.github.Milestones.by_repository_all(self.repo_user, self.repo_name, per_page=100, all_pages=True))
+        catalog = RepositoryCatalog(self.github, self.repo_user, self.repo_name)
+        catalog.load()
+        self.catalog = catalog
+
+        self.ensure_referenced_labels_exist()
 
         # Everyone who's a collaborator automatically has permissions to do everything.
-        self.collaborator_logins = set(c.login for c in self.github.Collaborators.by_repository(self.repo_user, self.repo_name, per_page=100, all_pages=True))
-        for login in self.collaborator_logins:
-            self.settings.PERMISSIONS[login] = ['labels', 'assignee', 'milestone']
+        for collaborator in self.catalog.collaborators.values():
+            self.settings.PERMISSIONS[collaborator.login] = ['labels', 'assignee', 'milestone']
 
-        # Find all issues.
-        issues = self.github.Issues.by_repository_all(self.repo_user, self.repo_name, per_page=100, all_pages=True)
+        logbook.debug(u"Loaded %s" % unicode(self.catalog))
 
-        logbook.debug("Found %d issue(s)." % len(issues))
+    def process_issue(self, number):
+        """Examine and react to changes of the single issue with the given number, as a run would."""
 
-        # Phase 1: check, prepare and record issues.
-        for issue in issues:
-            if issue.number in self.ignore:
-                continue
-            self.check_prepare_issue(issue)
+        if number in self.ignore:
+            return
 
-        # Phase 2: react to changed issues.
-        for issue in issues:
-            if issue.number in self.ignore or issue._should_ignore:
-                continue
+        issue = self.github.Issue.by_number(self.repo_user, self.repo_name, number)
+
+        if self.check_issue(issue):
+            self.retrieve_comments(issue)
+            self.prepare_handle_issue(issue)
+        self.writes.join()
+
+    def serve(self, server, save_database, interval):
+        """Process the work called for by webhook deliveries to the `WebhookServer` `server` as it comes in, calling
+        `save_database` after each piece of work.
+
+        A regular run is also started every `interval` seconds, beginning with one to catch up, since deliveries
+        can be missed, such as while CappBot isn't running or when GitHub gives up on delivering them.
+
+        """
+
+        self.run()
+        save_database()
+        next_run_at = time.time() + interval
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logbook.info(u"Listening for webhook deliveries on %s:%d." % server.server_address[:2])
+
+        try:
+            while True:
+                if time.time() >= next_run_at:
+                    try:
+                        self.run()
+                    except Exception:
+                        # Try again next time around, like run_forever does.
+                        logbook.exception(u"Run failed.")
+                    save_database()
+                    next_run_at = time.time() + interval
+
+                # Use a timeout so that we can be interrupted while waiting.
+                work = server.next_work(timeout=max(0, min(1, next_run_at - time.time())))
+                if work is None:
+                    continue
+
+                kind, number = work
+                try:
+                    if kind == 'metadata':
+                        self.load_repository_metadata()
+                    else:
+                        self.process_issue(number)
+                except Exception:
+                    # Keep serving; the issue will be looked at again by the next delivery about it.
+                    logbook.exception(u"Unable to process %s %s." % (kind, number or ''))
+                save_database()
+        finally:
+            server.shutdown()
+
+    def run_forever(self, interval, save_database, settings_path=None):
+        """Start a run every `interval` seconds until interrupted, calling `save_database` after each one.
+
+        Unlike starting a new process for every run, the database, connections and repository metadata stay in
+        memory between runs. If `settings_path` is given, the settings are reloaded from it whenever the file is
+        modified.
 
-            self.handle_issue_changes(issue)
+        """
+
+        settings_mtime = get_mtime(settings_path) if settings_path else None
+
+        while True:
+            started_at = time.time()
+            try:
+                self.run()
+            except Exception:
+                # Try again next time around, like a fresh process would.
+                logbook.exception(u"Run failed.")
+            save_database()
+
+            if settings_path:
+                settings_mtime = self.reload_settings(settings_path, settings_mtime)
+
+            time.sleep(max(0, interval - (time.time() - started_at)))
+
+    def reload_settings(self, settings_path, settings_mtime):
+        """Reload the settings from `settings_path` if the file has been modified since `settings_mtime`, keeping
+        the previous settings if it can't be loaded. Return the modification time of the file now.
+
+        """
+
+        mtime = get_mtime(settings_path)
+        if mtime is None:
+            # Such as while the file is being replaced. It's looked at again after the next run.
+            logbook.warning(u"Unable to find the settings file %s. Keeping the previous settings." % settings_path)
+            return settings_mtime
+        if mtime == settings_mtime:
+            return settings_mtime
+
+        logbook.info(u"Reloading settings from %s." % settings_path)
+        previous_settings = self.settings
+        try:
+            self.configure(load_settings(settings_path))
+        except Exception:
+            # Such as a syntax error in a file saved halfway through editing it. It's loaded again once it changes.
+            logbook.exception(u"Unable to load the settings from %s. Keeping the previous settings." % settings_path)
+            if self.settings is not previous_settings:
+                self.configure(previous_settings)
+        return mtime
+
+    def run(self):
+        for step in self.run_steps():
+            pass
+
+    def run_steps(self):
+        """Do a run an issue at a time, yielding after each, so that the runs for several repositories can take
+        turns.
+
+        """
+
+        logbook.debug("Logged in as %s." % self.current_user.login)
+
+        if self.is_repository_metadata_stale():
+            self.load_repository_metadata()
+        else:
+            # Labels and milestones may have been created since, and commands naming them must not be dropped.
+            self.catalog.may_reload = True
+
+        # Finish whatever a previous process left undone before looking at anything anew.
+        self.writes.resume()
+
+        # Find all issues which might have changed. They arrive a page at a time, and each page is checked while
+        # the next one is being retrieved.
+        issues = itertools.chain(self.list_issues(), self.list_issues_to_recheck())
+
+        # Check each issue as it's listed, and prepare and react to each one which may have changed as soon as
+        # its comments are in. Comments are retrieved concurrently, by worker threads, over non-blocking
+        # connections or in batches, while everything which touches the database or makes changes is done on this
+        # thread, in order.
+        listed_numbers = set()
+        changed_count = 0
+        newest_update = None
+        retrievals = deque()
+        batch_size = self.settings.GRAPHQL_BATCH_SIZE
+        if batch_size:
+            concurrency = batch_size * max(1, self.settings.COMMENT_WORKERS)
+        elif self.async_github:
+            concurrency = self.settings.ASYNC_REQUESTS
+        else:
+            concurrency = self.settings.COMMENT_WORKERS
+        workers = None
+        batch = None
+        try:
+            for issue in issues:
+                yield
+
+                # Changing an issue moves it to the front of an incremental listing, which pushes the issues
+                # listed after it back. The last issue of a page may then be listed again on the next one.
+                if issue.number in listed_numbers:
+                    continue
+                listed_numbers.add(issue.number)
+
+                if issue.updated_at > newest_update:
+                    newest_update = issue.updated_at
+
+                if issue.number in self.ignore or not self.check_issue(issue):
+                    continue
+                changed_count += 1
+
+                if batch_size or self.async_github or concurrency > 1:
+                    if batch_size:
+                        if workers is None:
+                            workers = ThreadPool(max(1, self.settings.COMMENT_WORKERS))
+                        if batch is None or batch.sent:
+                            batch = CommentBatch(self.retrieve_comments_batch, workers, batch_size)
+                        retrievals.append((issue, batch.add(issue)))
+                    elif self.async_github:
+                        retrievals.append((issue, self.retrieve_comments_async(issue)))
+                    else:
+                        if workers is None:
+                            workers = ThreadPool(concurrency)
+                        retrievals.append((issue, workers.apply_async(self.retrieve_comments, (issue,))))
+
+                    # Take each issue, in order, as soon as its comments are in. Don't retrieve further ahead than
+                    # can be kept in flight, or comments would pile up while issues are being changed.
+                    while retrievals and (retrievals[0][1].ready() or len(retrievals) > concurrency):
+                        issue, retrieval = retrievals.popleft()
+                        retrieval.get()
+                        self.prepare_handle_issue(issue)
+                else:
+                    self.retrieve_comments(issue)
+                    self.prepare_handle_issue(issue)
+
+            while retrievals:
+                yield
+                issue, retrieval = retrievals.popleft()
+                retrieval.get()
+                self.prepare_handle_issue(issue)
+        finally:
+            if workers is not None:
+                workers.close()
+
+        logbook.debug("Found %d issue(s), %d of which may have changed." % (len(listed_numbers), changed_count))
+
+        # Changes are made in the background while the issues are being looked at. Wait for the last of them.
+        while not self.writes.wait(0.1):
+            yield
+        self.writes.collect()
+        self.recheck_dropped_changes()
+
+        self.record_listed_issues(newest_update)
+
+        if self.github.response_cache:
+            logbook.debug(u"Response cache: %s" % unicode(self.github.response_cache))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
@@ -779,32 +1380,56 @@ if __name__ == '__main__':
         help='in case of déjà vu, record the issue as fully up to date')
     parser.add_argument('--ignore', metavar='NUMBER', action='append',
         help='complete ignore issue NUMBER during this run. Can be specified multiple times.')
+    parser.add_argument('--migrate-from', metavar='JSON_DATABASE',
+        help='copy everything in the JSON database JSON_DATABASE into the (new) DATABASE and exit')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--serve', action='store_true', default=False,
+        help='after a regular run, keep running and process the issues named by GitHub webhook deliveries')
+    mode.add_argument('--daemon', action='store_true', default=False,
+        help='keep running and start a new run every RUN_INTERVAL seconds')
 
     args = parser.parse_args()
 
-    settings = imp.load_source('settings', args.settings if os.path.exists(args.settings) else os.path.join(os.path.dirname(__file__), 'default_settings.py'))
-
-    DATABASE = settings.DATABASE
-    NEW_DATABASE = DATABASE + ".new"
-
-    if os.path.exists(NEW_DATABASE):
-        # If we failed to mv the new database to the old name, that might have been because we crashed while writing the
-        # new one, in which case the old database might be better to preserve. Or it might be that we wrote .new but
-        # failed to mv() in which case the new is better to preserve. So this error situation requires manual
-        # intervention.
-        raise Exception("{} exists. Manually resolve if {} or {} is less bad and then mv and rm by hand to resolve.".format(NEW_DATABASE, DATABASE, NEW_DATABASE))
-
-    if os.path.exists(DATABASE):
-        with open(DATABASE, 'rb') as f:
-            database = json.load(f)
+    settings_path = args.settings if os.path.exists(args.settings) else os.path.join(os.path.dirname(__file__), 'default_settings.py')
+    settings = load_settings(settings_path)
+
+    if args.serve and not settings.WEBHOOK_SECRET:
+        parser.error("WEBHOOK_SECRET must be set to use --serve")
+
+    if settings.GITHUB_REPOSITORIES or settings.LEASE_DATABASE:
+        if args.serve or args.migrate_from:
+            parser.error("--serve and --migrate-from only work with a single GITHUB_REPOSITORY and no LEASE_DATABASE")
+    try:
+        repository_settings = get_repository_settings(settings) if settings.GITHUB_REPOSITORIES else [settings]
+    except ValueError as e:
+        parser.error(str(e))
+
+    coordinator = None
+    if settings.LEASE_DATABASE:
+        if any(each.DATABASE.endswith('.json') for each in repository_settings):
+            parser.error("replicas can only share SQLite databases")
+        coordinator = ShardCoordinator(SqliteLeases(settings.LEASE_DATABASE), settings.REPLICA_NAME or socket.gethostname(), [each.GITHUB_REPOSITORY for each in repository_settings], duration=settings.LEASE_DURATION)
+        coordinator.start_heartbeat()
+        # Let the other replicas take over right away when asked to stop.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if coordinator is not None:
+        # Only the databases of the repositories this replica gets to look after are opened.
+        stores = [LazyStore(partial(open_store, each.DATABASE, dry_run=args.dry_run, shared=True)) for each in repository_settings]
     else:
-        database = {}
+        stores = [open_store(each.DATABASE, dry_run=args.dry_run) for each in repository_settings]
+
+    if args.migrate_from:
+        store = stores[0]
+        if store.issues():
+            parser.error("{} already contains issues".format(settings.DATABASE))
+        migrate(JsonStore.load(args.migrate_from), store)
+        store.close()
+        sys.exit(0)
 
     def save_database():
-        if not args.dry_run:
-            with open(NEW_DATABASE, 'wb') as f:
-                json.dump(database, f, indent=1, sort_keys=True)
-            shutil.move(NEW_DATABASE, DATABASE)
+        for store in stores:
+            store.save()
 
     # Write to the database immediately to verify we have write permission and disk space.
     # We don't want to find out that there is a problem at the end and lose all the data.
@@ -815,7 +1440,22 @@ if __name__ == '__main__':
     with null_handler.applicationbound():
         with logbook.StreamHandler(args.log, level=log_level, bubble=False) as log_handler:
             with log_handler.applicationbound():
+                cappbots = []
                 try:
-                    CappBot(settings, database, dry_run=args.dry_run, memorise_forgotten=args.memorise_forgotten, ignore=[int(n) for n in args.ignore] if args.ignore else []).run()
+                    # Several repositories share one client, and so its connections, response cache and rate limit.
+                    github = create_github(settings) if len(stores) > 1 else None
+                    pacer = WritePacer(settings.UPDATE_DELAY) if len(stores) > 1 else None
+                    cappbots = [CappBot(each, store, dry_run=args.dry_run, memorise_forgotten=args.memorise_forgotten, ignore=[int(n) for n in args.ignore] if args.ignore else [], github=github, pacer=pacer) for each, store in zip(repository_settings, stores)]
+                    if args.serve:
+                        cappbots[0].serve(WebhookServer((settings.WEBHOOK_HOST, settings.WEBHOOK_PORT), settings.WEBHOOK_SECRET, settings.GITHUB_REPOSITORY), save_database, settings.RUN_INTERVAL)
+                    elif len(cappbots) == 1 and coordinator is None:
+                        if args.daemon:
+                            cappbots[0].run_forever(settings.RUN_INTERVAL, save_database, settings_path)
+                        else:
+                            cappbots[0].run()
+                    elif args.daemon:
+                        RepositoryScheduler(cappbots, coordinator).run_forever(settings.RUN_INTERVAL, save_database)
+                    else:
+                        RepositoryScheduler(cappbots, coordinator).run()
                 finally:
-                    save_database()
+                    shut_down(cappbots, coordinator, stores, settings.HTTP_TIMEOUT)
@@ -15,14 +15,20 @@
 # THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-from mock import Mock, call
+from mock import Mock, call, patch
+import datetime
 import imp
 import json
 import logbook
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from cappbot import CappBot
+from async_github import AsyncGitHub, Future
+from cappbot import GITHUB_DATE_FORMAT, CappBot, shut_down
+from store import JsonStore
 import mini_github3
 
 
@@ -38,6 +44,15 @@ def load_fixture(name):
         return json.load(inf)
 
 
+class FakeIssueSummary(mini_github3.IssueSummary):
+    """A summary with room for the mock `patch` and comments the tests attach to it, and nothing else, so that
+    CappBot keeping anything on an issue without a slot for it fails.
+
+    """
+
+    __slots__ = ('patch', '_mock_comments')
+
+
 class TestCappBot(unittest.TestCase):
     def setUp(self):
         self.log_handler = logbook.TestHandler()
@@ -49,7 +64,7 @@ class TestCappBot(unittest.TestCase):
         self.settings.AVOID_RATE_LIMIT = False
         self.settings.UPDATE_DELAY = 0
         self.database = {'first_run': '2012-01-01T22:06:51Z'}
-        self.cappbot = CappBot(self.settings, self.database)
+        self.cappbot = CappBot(self.settings, JsonStore(self.database))
         # Replace the GitHub API with a mock.
         self.cappbot.github = Mock(spec=self.cappbot.github)
 
@@ -61,18 +76,21 @@ class TestCappBot(unittest.TestCase):
         user_template['name'] = 'Alice Tester'
         user_template['url'] = 'https://api.github.com/users/alice_tester'
         user_template['login'] = 'alice_tester'
+        user_template['id'] = 1022440
         self.alice_user = mini_github3.User.from_dict(user_template)
 
         user_template = user_template.copy()
         user_template['name'] = 'Bob Tester'
         user_template['url'] = 'https://api.github.com/users/bob_tester'
         user_template['login'] = 'bob'
+        user_template['id'] = 1022441
         self.bob_user = mini_github3.User.from_dict(user_template)
 
         user_template = user_template.copy()
         user_template['name'] = 'Chuck Tester'
         user_template['url'] = 'https://api.github.com/users/chuck_tester'
         user_template['login'] = 'chuck'
+        user_template['id'] = 1022442
         self.chuck_user = mini_github3.User.from_dict(user_template)
 
         self.cappbot.github.current_user = Mock(return_value=self.cappbot_user)
@@ -81,8 +99,61 @@ class TestCappBot(unittest.TestCase):
         self.log_handler.pop_thread()
 
     def test_ensure_referenced_labels_exist(self):
-        self.cappbot.ensure_referenced_labels_exist()
-        self.cappbot.github.Labels.get_or_create_in_repository.assert_called_with("alice_tester", "blox", "#new")
+        issues, labels, milestones = self.configure_github_mock([], load_fixture('labels.json'), load_fixture('milestones.json'))
+        self.settings.NEW_ISSUE_DEFAULTS['labels'] = ['#new', '#untriaged']
+
+        self.cappbot.load_repository_metadata()
+
+        self.assertEquals(labels.post.call_count, 1)
+        self.assertEquals(labels[-1].name, '#untriaged')
+        self.assertEquals(self.cappbot.get_label_by_name('#UNTRIAGED'), '#untriaged')
+
+    def test_catalog(self):
+        issues, labels, milestones = self.configure_github_mock([], load_fixture('labels.json'), load_fixture('milestones.json'))
+
+        self.cappbot.load_repository_metadata()
+        catalog = self.cappbot.catalog
+
+        self.assertEquals(self.cappbot.get_milestone_title_by_title('someday'), 'Someday')
+        self.assertEquals(self.cappbot.get_assignee_login_by_name('ALICE_tester'), 'alice_tester')
+        self.assertEquals(self.cappbot.get_assignee_login_by_name('bob'), None)
+
+        # A missing milestone is created once, however often it's asked for, without listing milestones again.
+        for n in range(3):
+            milestone = catalog.get_or_create_milestone('2.0')
+        self.assertEquals(milestones.post.call_count, 1)
+        self.assertEquals(catalog.get_milestone('2.0'), milestone)
+        self.assertEquals(self.cappbot.github.Milestones.by_repository.call_count, 1)
+        # Closed milestones can be named too.
+        self.assertEquals(self.cappbot.github.Milestones.by_repository.call_args[1]['state'], 'all')
+
+    def test_catalog_reloaded_on_miss(self):
+        issues, labels, milestones = self.configure_github_mock([], load_fixture('labels.json'), load_fixture('milestones.json'))
+
+        self.cappbot.load_repository_metadata()
+        catalog = self.cappbot.catalog
+        self.assertEquals(catalog.get_milestone_by_number(milestones[0].number), milestones[0])
+
+        # Created by someone else after the catalog was loaded.
+        label = mini_github3.Label.from_dict({'name': 'Lambda', 'color': '000000'})
+        labels.entries.append(label)
+        milestone = mini_github3.Milestone.from_dict(dict(load_fixture('milestones.json')[0], number=99, title='3.0'))
+        milestones.entries.append(milestone)
+
+        # Not looked for again until a new run allows it.
+        self.assertEquals(self.cappbot.get_label_by_name('lambda'), None)
+        self.assertEquals(self.cappbot.github.Labels.by_repository.call_count, 1)
+
+        catalog.may_reload = True
+        self.assertEquals(self.cappbot.get_label_by_name('lambda'), 'Lambda')
+        self.assertEquals(catalog.get_milestone_by_number(99), milestone)
+        self.assertEquals(catalog.get_milestone('3.0'), milestone)
+        self.assertEquals(self.cappbot.github.Labels.by_repository.call_count, 2)
+
+        # Only once a run, however many lookups miss.
+        self.assertEquals(self.cappbot.get_label_by_name('nonesuch'), None)
+        self.assertEquals(catalog.get_milestone_by_number(100), None)
+        self.assertEquals(self.cappbot.github.Labels.by_repository.call_count, 2)
 
     def test_current_user(self):
         current_user = self.cappbot.current_user
@@ -99,15 +170,15 @@ class TestCappBot(unittest.TestCase):
         # There's quite a bit of GitHub interaction to fake.
 
         comments = comments or []
-        issues = mini_github3.Issues.from_dict(issues)
+        issues = mini_github3.IssueSummaries(entries=[FakeIssueSummary.from_dict(issue) for issue in issues])
         labels = mini_github3.Labels.from_dict(labels)
         milestones = mini_github3.Milestones.from_dict(milestones)
         collaborator_users = (self.cappbot_user, self.alice_user)
-        collaborators = mini_github3.Collaborators.from_dict([{'login': user.login} for user in collaborator_users])
+        collaborators = mini_github3.Collaborators.from_dict([{'login': user.login, 'id': user.id} for user in collaborator_users])
 
         self.cappbot.github.Collaborators.by_repository = Mock(return_value=collaborators)
         self.cappbot.github.Labels.by_repository = Mock(return_value=labels)
-        self.cappbot.github.Milestones.by_repository_all = Mock(return_value=milestones)
+        self.cappbot.github.Milestones.by_repository = Mock(return_value=milestones)
 
         def install_issue_mock_patch(issue):
             def mock_patch(*args, **kwargs):
@@ -149,32 +220,33 @@ class TestCappBot(unittest.TestCase):
         install_list_post_patch(milestones)
         install_list_post_patch(labels)
 
-        def milestone_get_or_create_in_repository(user_name, repo_name, milestone_title):
-            for milestone in milestones:
-                if milestone.title == milestone_title:
-                    return milestone
-
-            milestone = mini_github3.Milestone()
-            milestone.title = milestone_title
-            milestones.post(milestone)  # Will call the Mock version.
+        self.cappbot.github.Label = mini_github3.Label
+        self.cappbot.github.Milestone = mini_github3.Milestone
 
-            return milestone
-
-        self.cappbot.github.Milestones.get_or_create_in_repository = Mock(side_effect=milestone_get_or_create_in_repository)
-
-        self.cappbot.github.Issues.by_repository = Mock(return_value=issues)
-        self.cappbot.github.Issues.by_repository_all = Mock(return_value=issues)
+        self.cappbot.github.IssueSummaries.by_repository = Mock(return_value=issues)
+        self.cappbot.github.IssueSummaries.by_repository_since = Mock(return_value=issues)
 
         for n, issue in enumerate(issues):
             issue._mock_comments = mini_github3.Comments.from_dict(comments[n]) if n < len(comments) else mini_github3.Comments(entries=[])
             issue.comments = len(issue._mock_comments)
             install_list_post_patch(issue._mock_comments)
 
-        def get_comments(issue, **kwargs):
-            return issue._mock_comments
+        def get_comments(issue, since=None, **kwargs):
+            # Like GitHub, only return the comments updated at or after `since`. Like remoteobjects, don't add
+            # posted comments to the list they were posted to.
+            comments = mini_github3.Comments(entries=[comment for comment in issue._mock_comments if not since or comment.updated_at >= since])
+            comments.post = Mock(side_effect=issue._mock_comments.post)
+            return comments
 
         self.cappbot.github.Comments.by_issue = Mock(side_effect=get_comments)
 
+        def get_empty_comments(issue):
+            comments = mini_github3.Comments(entries=[])
+            comments.post = Mock(side_effect=issue._mock_comments.post)
+            return comments
+
+        self.cappbot.github.Comments.for_issue = Mock(side_effect=get_empty_comments)
+
         return issues, labels, milestones
 
     def test_install_defaults(self):
@@ -186,6 +258,572 @@ class TestCappBot(unittest.TestCase):
         self.assertEquals(issues[0]._mock_comments[-1].body, "**Milestone:** Someday.  **Label:** #new.  **What's next?** A reviewer should examine this issue.")
         issues[0]._mock_comments.post.assert_called_with(issues[0]._mock_comments[-1])
 
+    def test_incremental_listing(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'))
+
+        # The first run has nothing to go on so it lists everything.
+        self.cappbot.run()
+
+        self.cappbot.github.IssueSummaries.by_repository.assert_called_once_with("alice_tester", "blox", state='all', per_page=100)
+        self.assertFalse(self.cappbot.github.IssueSummaries.by_repository_since.called)
+        self.assertEquals(self.database['newest_listed_update'], max(issue.updated_at for issue in issues))
+        self.assertTrue(self.database['last_full_scan'])
+
+        # Later runs only list what has been updated since.
+        self.cappbot.run()
+
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository.call_count, 1)
+        self.cappbot.github.IssueSummaries.by_repository_since.assert_called_once_with("alice_tester", "blox", self.database['newest_listed_update'], per_page=100)
+
+    def test_full_scan_when_due(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'))
+        self.database['newest_listed_update'] = '2012-04-19T22:06:51Z'
+        self.database['last_full_scan'] = '2012-04-19T22:06:51Z'
+
+        self.cappbot.run()
+
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository.call_count, 1)
+        self.assertFalse(self.cappbot.github.IssueSummaries.by_repository_since.called)
+        self.assertNotEquals(self.database['last_full_scan'], '2012-04-19T22:06:51Z')
+
+    def test_poll_events(self):
+        self.settings.POLL_EVENTS = True
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'))
+        Events = self.cappbot.github.Events
+        Events.by_repository_since = Mock(return_value=mini_github3.Events.from_dict([{'id': '5', 'type': 'WatchEvent', 'payload': {}}]))
+        self.cappbot.github.Issue.by_number = Mock(side_effect=lambda user, repo, number: first(issue for issue in issues if issue.number == number))
+
+        # Without a previous event to go by, the first run lists everything.
+        self.cappbot.run()
+
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository.call_count, 1)
+        self.assertEquals(self.database['newest_event_id'], 5)
+
+        events = mini_github3.Events.from_dict([
+            {'id': '8', 'type': 'IssueCommentEvent', 'payload': {'issue': {'number': 8}, 'comment': {'body': '+1'}}},
+            {'id': '7', 'type': 'WatchEvent', 'payload': {}},
+            {'id': '6', 'type': 'IssuesEvent', 'payload': {'action': 'labeled', 'issue': {'number': 3}}},
+        ])
+        events._poll_interval = '60'
+        Events.by_repository_since.return_value = events
+
+        self.cappbot.run()
+
+        Events.by_repository_since.assert_called_with("alice_tester", "blox", 5, per_page=100)
+        self.assertEquals(self.cappbot.github.Issue.by_number.call_args_list, [call("alice_tester", "blox", 3), call("alice_tester", "blox", 8)])
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository.call_count, 1)
+        self.assertFalse(self.cappbot.github.IssueSummaries.by_repository_since.called)
+        self.assertEquals(self.database['newest_event_id'], 8)
+
+        # GitHub asked not to be polled again for a minute.
+        self.cappbot.run()
+
+        self.assertEquals(Events.by_repository_since.call_count, 2)
+
+        # When events have been missed everything is listed again.
+        self.cappbot._next_events_poll = None
+        Events.by_repository_since.return_value = None
+        fallback = mini_github3.Events.from_dict([{'id': '400', 'type': 'WatchEvent', 'payload': {}}])
+        # Like the listing GitHub returns, the poll interval is only known once it's delivered.
+        fallback._delivered = False
+
+        def deliver():
+            fallback._poll_interval = '60'
+            fallback._delivered = True
+            return fallback
+        fallback.deliver = deliver
+        Events.by_repository = Mock(return_value=fallback)
+
+        self.cappbot.run()
+
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository.call_count, 2)
+        self.assertEquals(self.database['newest_event_id'], 400)
+        self.assertTrue(self.cappbot._next_events_poll > time.time())
+
+    def test_poll_events_issue_gone(self):
+        self.settings.POLL_EVENTS = True
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'))
+        self.database['newest_event_id'] = 5
+        self.database['last_full_scan'] = datetime.datetime.utcnow().strftime(GITHUB_DATE_FORMAT)
+        self.database['newest_listed_update'] = '2012-04-19T22:06:51Z'
+        self.cappbot.github.Events.by_repository_since = Mock(return_value=mini_github3.Events.from_dict([
+            {'id': '8', 'type': 'IssuesEvent', 'payload': {'action': 'transferred', 'issue': {'number': 8}}},
+            {'id': '7', 'type': 'IssuesEvent', 'payload': {'action': 'deleted', 'issue': {'number': 7}}},
+            {'id': '6', 'type': 'IssuesEvent', 'payload': {'action': 'labeled', 'issue': {'number': 3}}},
+        ]))
+
+        def by_number(user, repo, number):
+            if number == 3:
+                return first(issue for issue in issues if issue.number == number)
+            # Not delivered yet; GitHub answers 410 Gone for a deleted issue, 404 for a transferred one.
+            gone = mini_github3.Issue.get('https://api.github.com/repos/alice_tester/blox/issues/%d' % number, http=Mock())
+            gone.deliver = Mock(side_effect=mini_github3.Gone() if number == 7 else mini_github3.Issue.NotFound())
+            return gone
+        self.cappbot.github.Issue.by_number = Mock(side_effect=by_number)
+        self.cappbot.prepare_handle_issue = Mock()
+
+        self.cappbot.run()
+
+        self.assertEquals([args[0].number for args, kwargs in self.cappbot.prepare_handle_issue.call_args_list], [3])
+        self.assertEquals(self.database['newest_event_id'], 8)
+        self.assertTrue(any('Skipping issue 7' in record.message for record in self.log_handler.records))
+        self.assertTrue(any('Skipping issue 8' in record.message for record in self.log_handler.records))
+
+    def test_concurrent_comment_retrieval(self):
+        self.settings.COMMENT_WORKERS = 4
+        comments = [[self.fake_comment(self.alice_user, '+1')] for n in range(8)]
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'), comments)
+
+        self.cappbot.run()
+
+        self.assertEquals(self.cappbot.github.Comments.by_issue.call_count, 8)
+        for issue in issues:
+            record = self.database['issues'][unicode(issue.id)]
+            self.assertEquals(record['votes'], 1)
+            self.assertEquals(record['latest_seen_comment_id'], issue._mock_comments[0].id)
+            self.assertTrue(issue._mock_comments[-1].body.startswith('**'))
+
+    def test_async_comment_retrieval(self):
+        self.settings.ASYNC_REQUESTS = 100
+        comments = [[self.fake_comment(self.alice_user, '+1')] for n in range(8)]
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'), comments)
+        self.cappbot.async_github = AsyncGitHub(self.cappbot.github)
+        loop = self.cappbot.async_github.loop
+
+        def deliver_all(listing):
+            # All are in flight at once, and the comments of later issues arrive first.
+            future = Future(loop)
+            loop.call_later(0.01 * (8 - deliver_all.started), lambda: future.set_result(listing))
+            deliver_all.started += 1
+            return future
+        deliver_all.started = 0
+        self.cappbot.async_github.deliver_all = deliver_all
+
+        self.cappbot.run()
+
+        self.assertEquals(deliver_all.started, 8)
+        self.assertTrue(all('all_pages' not in kwargs for args, kwargs in self.cappbot.github.Comments.by_issue.call_args_list))
+        for issue in issues:
+            record = self.database['issues'][unicode(issue.id)]
+            self.assertEquals(record['votes'], 1)
+            self.assertEquals(record['latest_seen_comment_id'], issue._mock_comments[0].id)
+            self.assertTrue(issue._mock_comments[-1].body.startswith('**'))
+
+    def test_graphql_comment_retrieval(self):
+        self.settings.GRAPHQL_BATCH_SIZE = 5
+        self.settings.GRAPHQL_COMMENTS = 2
+        comments = [[self.fake_comment(self.alice_user, '+1')] for n in range(8)]
+        # More comments than are in a GraphQL answer.
+        comments[3] += [self.fake_comment(self.bob_user, 'Me too.'), self.fake_comment(self.chuck_user, 'Still?')]
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json'), load_fixture('labels.json'), load_fixture('milestones.json'), comments)
+        by_number = dict((issue.number, issue) for issue in issues)
+
+        def recent_comments(user_name, repo_name, numbers, count=100):
+            r = {}
+            for number in numbers:
+                issue = by_number[number]
+                r[number] = mini_github3.Comments(entries=issue._mock_comments.entries[-count:])
+                r[number].total_count = len(issue._mock_comments)
+                r[number].post = Mock(side_effect=issue._mock_comments.post)
+            return r
+        self.cappbot.github.graphql.recent_comments = Mock(side_effect=recent_comments)
+
+        self.cappbot.run()
+
+        # A request for every five issues, and one for the issue with a longer thread.
+        self.assertEquals([len(args[2]) for args, kwargs in self.cappbot.github.graphql.recent_comments.call_args_list], [5, 3])
+        self.cappbot.github.Comments.by_issue.assert_called_once_with(issues[3], since=None, per_page=100, all_pages=True)
+        for issue in issues:
+            record = self.database['issues'][unicode(issue.id)]
+            self.assertEquals(record['votes'], 1)
+            self.assertTrue(issue._mock_comments[-1].body.startswith('**'))
+
+    def test_pipelined_issues(self):
+        self.settings.COMMENT_WORKERS = 1
+        comments = [[self.fake_comment(self.alice_user, '+1')] for n in range(3)]
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[:3], load_fixture('labels.json'), load_fixture('milestones.json'), comments)
+        # The last issue of a page can be listed again on the next one if an issue is updated meanwhile.
+        issues.entries.append(issues[2])
+
+        handled = []
+        handle_issue_changes = self.cappbot.handle_issue_changes
+
+        def mock_handle_issue_changes(issue):
+            # Each issue is handled before the comments of the next one are retrieved, and the comments of
+            # the ones before have been let go of.
+            self.assertEquals(self.cappbot.github.Comments.by_issue.call_count, len(handled) + 1)
+            self.assertTrue(all(other._comments is None for other in handled))
+            handled.append(issue)
+            handle_issue_changes(issue)
+
+        self.cappbot.handle_issue_changes = Mock(side_effect=mock_handle_issue_changes)
+
+        self.cappbot.run()
+
+        self.assertEquals(handled, issues.entries[:3])
+        for issue in issues.entries[:3]:
+            self.assertIsNone(issue._comments)
+            self.assertEquals(self.database['issues'][unicode(issue.id)]['votes'], 1)
+
+    def fake_now(self):
+        """Return a timestamp later than any returned before, and than the fixtures."""
+
+        self.fake_time = getattr(self, 'fake_time', 0) + 1
+        return '2012-05-01T10:%02d:%02dZ' % divmod(self.fake_time, 60)
+
+    def add_fake_comment(self, issue, owner, body):
+        """Comment on an issue configured by configure_github_mock as if someone just did on GitHub."""
+
+        comment = self.fake_comment(owner, body)
+        comment['created_at'] = comment['updated_at'] = issue.updated_at = self.fake_now()
+        issue._mock_comments.entries.append(mini_github3.Comment.from_dict(comment))
+        issue.comments = len(issue._mock_comments)
+
+    def install_fake_paper_trail_comments(self):
+        """Give paper trail comments ids and times, which are needed to tell which comments are new."""
+
+        def new_comment():
+            comment = self.fake_comment(self.cappbot_user, None)
+            comment['created_at'] = comment['updated_at'] = self.fake_now()
+            return mini_github3.Comment.from_dict(comment)
+
+        self.cappbot.github.Comment = Mock(side_effect=new_comment)
+
+    def test_incremental_comments(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, '+1')]])
+        issue = issues[0]
+        by_issue = self.cappbot.github.Comments.by_issue
+        self.install_fake_paper_trail_comments()
+
+        self.cappbot.run()
+
+        by_issue.assert_called_once_with(issue, since=None, per_page=100, all_pages=True)
+        self.assertEquals(self.cappbot.get_vote_count(issue), 1)
+
+        # Only comments since the last seen update are retrieved.
+        since = self.database['issues'][unicode(issue.id)]['updated_at']
+        self.add_fake_comment(issue, self.bob_user, 'Me too.\n+1')
+        by_issue.reset_mock()
+
+        self.cappbot.run()
+
+        by_issue.assert_called_once_with(issue, since=since, per_page=100, all_pages=True)
+        self.assertEquals(self.cappbot.get_vote_count(issue), 2)
+        self.assertTrue(issue.title.endswith('[+2]'))
+
+        self.add_fake_comment(issue, self.bob_user, 'Any news?')
+        by_issue.reset_mock()
+
+        self.cappbot.run()
+
+        self.assertEquals(by_issue.call_count, 1)
+        self.assertEquals(self.cappbot.get_vote_count(issue), 2)
+        self.assertEquals(self.database['issues'][unicode(issue.id)]['latest_seen_comment_id'], issue._mock_comments[-1].id)
+
+    def test_edited_comment_not_new(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, '+1')]])
+        issue = issues[0]
+        self.install_fake_paper_trail_comments()
+
+        self.cappbot.run()
+        self.add_fake_comment(issue, self.bob_user, 'Me too.')
+        self.add_fake_comment(issue, self.chuck_user, 'Me three.')
+        self.cappbot.run()
+
+        latest_seen_comment_id = self.database['issues'][unicode(issue.id)]['latest_seen_comment_id']
+        self.assertEquals(latest_seen_comment_id, issue._mock_comments[-1].id)
+
+        # With the newest comment deleted and an older one edited, the edited one is all that's retrieved. That doesn't make
+        # the ones after it new again.
+        del issue._mock_comments.entries[-1]
+        issue.comments = len(issue._mock_comments)
+        edited = issue._mock_comments[0]
+        edited.body = '+1, still.'
+        edited.updated_at = issue.updated_at = self.fake_now()
+        retrieved = []
+        get_comments = self.cappbot.github.Comments.by_issue.side_effect
+        self.cappbot.github.Comments.by_issue.side_effect = lambda *args, **kwargs: retrieved.append(get_comments(*args, **kwargs)) or retrieved[-1]
+
+        self.cappbot.run()
+
+        self.assertEquals([comment.id for comment in retrieved[0]], [edited.id])
+        self.assertEquals(self.database['issues'][unicode(issue.id)]['latest_seen_comment_id'], latest_seen_comment_id)
+
+    def test_votes_recounted_after_edit_or_delete(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, '+1')]])
+        issue = issues[0]
+        by_issue = self.cappbot.github.Comments.by_issue
+        self.install_fake_paper_trail_comments()
+
+        self.add_fake_comment(issue, self.bob_user, '+1')
+        self.cappbot.run()
+
+        record = self.database['issues'][unicode(issue.id)]
+        self.assertEquals(record['voters'], {
+            'alice_tester': {'vote': 1, 'comment_id': issue._mock_comments[0].id},
+            'bob': {'vote': 1, 'comment_id': issue._mock_comments[1].id}
+        })
+
+        # Bob's vote is deleted. Only the count of comments gives it away.
+        del issue._mock_comments.entries[1]
+        self.add_fake_comment(issue, self.alice_user, 'Hm.')
+        by_issue.reset_mock()
+
+        self.cappbot.run()
+
+        self.assertEquals(by_issue.call_count, 2)
+        self.assertEquals(self.cappbot.get_vote_count(issue), 1)
+        self.assertEquals(self.database['issues'][unicode(issue.id)]['voters'].keys(), ['alice_tester'])
+
+        # Alice's first comment is edited into a vote against. With no new comments, the comments aren't
+        # retrieved at all, and the edit isn't seen yet.
+        issue._mock_comments[0].body = '-1'
+        issue._mock_comments[0].updated_at = issue.updated_at = self.fake_now()
+        by_issue.reset_mock()
+
+        self.cappbot.run()
+
+        self.assertEquals(by_issue.call_count, 0)
+        self.assertEquals(self.cappbot.get_vote_count(issue), 1)
+
+        # It is once there's a new comment, since comments are retrieved from where they were last retrieved.
+        self.add_fake_comment(issue, self.bob_user, 'Hm?')
+        self.cappbot.run()
+
+        self.assertEquals(by_issue.call_count, 2)
+        self.assertEquals(self.cappbot.get_vote_count(issue), -1)
+        self.assertTrue(issue.title.endswith('[-1]'))
+
+    def test_label_edit_without_comments(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, '+1')]])
+        issue = issues[0]
+        by_issue = self.cappbot.github.Comments.by_issue
+        self.install_fake_paper_trail_comments()
+
+        self.cappbot.run()
+        # GitHub counts the paper trail comment.
+        issue.comments = len(issue._mock_comments)
+        issue.updated_at = self.fake_now()
+        self.cappbot.run()
+        self.assertEquals(by_issue.call_count, 2)
+
+        # A label is added in the web interface. Only the issue itself is needed to react to that.
+        issue.patch(labels=['#new', 'enhancement'])
+        issue.updated_at = self.fake_now()
+        by_issue.reset_mock()
+
+        self.cappbot.run()
+
+        self.assertFalse(by_issue.called)
+        self.assertEquals(issue._mock_comments[-1].body, "**Milestone:** Someday.  **Vote:** 1.  **Labels:** #new, enhancement.  **What's next?** A reviewer should examine this issue.")
+        self.assertEquals(self.database['issues'][unicode(issue.id)]['labels'], ['#new', 'enhancement'])
+
+    def test_resume_pending_writes(self):
+        self.configure_github_mock([], load_fixture('labels.json'), load_fixture('milestones.json'))
+        url = 'https://api.github.com/repos/alice_tester/blox/issues/8'
+        self.database['pending_writes'] = [{'id': 1, 'method': 'PATCH', 'url': url, 'body': {'state': 'closed'}}]
+
+        self.cappbot.run()
+
+        self.cappbot.github.Issue.from_dict.assert_called_once_with({'url': url})
+        self.cappbot.github.Issue.from_dict.return_value.patch.assert_called_once_with(state='closed')
+        self.assertEquals(self.database['pending_writes'], [])
+
+    def test_failed_write_not_recorded(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, 'Hello.')]])
+        issue = issues[0]
+        self.install_fake_paper_trail_comments()
+        self.cappbot.run()
+        record = json.loads(json.dumps(self.database['issues'][unicode(issue.id)]))
+
+        # GitHub rejects adding the label Bob asks for.
+        self.add_fake_comment(issue, self.bob_user, '+enhancement')
+        comment_count = len(issue._mock_comments)
+        patch_issue = issue.patch.side_effect
+        issue.patch.side_effect = ValueError('422 Unprocessable Entity')
+        self.cappbot.run()
+
+        # No paper trail claims it was, and the command is still to be acted on, by the next run, whether the issue
+        # is listed again or not.
+        self.assertEquals(len(issue._mock_comments), comment_count)
+        self.assertEquals(self.database['issues'][unicode(issue.id)], dict(record, updated_at=None))
+        self.assertEquals(self.database['pending_writes'], [])
+        self.assertEquals(self.database['recheck_numbers'], [issue.number])
+
+        issue.patch.side_effect = patch_issue
+        self.cappbot.github.IssueSummaries.by_repository_since.return_value = mini_github3.IssueSummaries(entries=[])
+        self.cappbot.github.Issue.by_number = Mock(return_value=issue)
+        self.cappbot.run()
+
+        self.cappbot.github.Issue.by_number.assert_called_once_with('alice_tester', 'blox', issue.number)
+        self.assertEquals(self.database['recheck_numbers'], [])
+
+        self.assertEquals([label.name for label in issue.labels], ['#new', 'enhancement'])
+        self.assertEquals(len(issue._mock_comments), comment_count + 1)
+        self.assertEquals(self.database['issues'][unicode(issue.id)]['labels'], ['#new', 'enhancement'])
+
+    def test_issue_with_pending_writes_left_alone(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'))
+        issue = issues[0]
+        self.database['newest_listed_update'] = '2012-01-01T00:00:00Z'
+        # Left pending by a run which couldn't reach GitHub.
+        self.cappbot.writes.permit = lambda: False
+        self.database['pending_writes'] = [{'id': 1, 'method': 'PATCH', 'url': issue.url, 'body': {'state': 'closed'}, 'issue_id': issue.id}]
+
+        self.cappbot.run()
+
+        self.assertFalse(issue.patch.called)
+        self.assertEquals(self.cappbot.store.get_issue(issue.id), None)
+        self.assertEquals(self.database['newest_listed_update'], '2012-01-01T00:00:00Z')
+        self.assertEquals(len(self.database['pending_writes']), 1)
+
+    def test_process_issue(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, 'Very enhancing.\n\n+enhancement')]])
+        self.cappbot.github.Issue.by_number = Mock(return_value=issues[0])
+
+        self.cappbot.load_repository_metadata()
+        self.cappbot.process_issue(8)
+
+        self.cappbot.github.Issue.by_number.assert_called_once_with("alice_tester", "blox", 8)
+        self.assertFalse(self.cappbot.github.IssueSummaries.by_repository.called)
+        issues[0].patch.assert_has_calls([call(labels=[u'#new'], milestone=2), call(labels=[u'#new', u'enhancement'])])
+        self.assertEquals(issues[0]._mock_comments[-1].body, "**Milestone:** Someday.  **Labels:** #new, enhancement.  **What's next?** A reviewer should examine this issue.")
+
+    def test_run_forever(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'))
+        # The threads of a ThreadPool sleep too, which wouldn't go well with sleep patched.
+        self.settings.COMMENT_WORKERS = 1
+        save_database = Mock()
+
+        with patch('time.sleep', side_effect=[None, KeyboardInterrupt]):
+            self.assertRaises(KeyboardInterrupt, self.cappbot.run_forever, 150, save_database)
+
+        self.assertEquals(save_database.call_count, 2)
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository.call_count, 1)
+        self.assertEquals(self.cappbot.github.IssueSummaries.by_repository_since.call_count, 1)
+        # Repository metadata stays loaded between runs.
+        self.assertEquals(self.cappbot.github.Labels.by_repository.call_count, 1)
+        self.assertEquals(self.cappbot.github.current_user.call_count, 1)
+
+    def test_serve(self):
+        server = Mock(server_address=('', 8080))
+        server.next_work.side_effect = [('issue', 8), ('metadata', None), None, KeyboardInterrupt]
+        self.cappbot.run = Mock()
+        self.cappbot.process_issue = Mock()
+        self.cappbot.load_repository_metadata = Mock()
+        save_database = Mock()
+
+        # Runs are due all the time, between each piece of work.
+        self.assertRaises(KeyboardInterrupt, self.cappbot.serve, server, save_database, 0)
+
+        self.cappbot.process_issue.assert_called_once_with(8)
+        self.assertEquals(self.cappbot.load_repository_metadata.call_count, 1)
+        self.assertEquals(self.cappbot.run.call_count, 5)
+        self.assertEquals(save_database.call_count, 7)
+        self.assertTrue(server.shutdown.called)
+
+    def test_run_forever_reloads_settings(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'))
+        # The threads of a ThreadPool sleep too, which wouldn't go well with sleep patched.
+        self.settings.COMMENT_WORKERS = 1
+        settings_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, settings_directory)
+        settings_path = os.path.join(settings_directory, 'settings.py')
+        shutil.copy('default_settings.py', settings_path)
+        self.cappbot.configure = Mock()
+
+        sleeps = []
+
+        def sleep(delay):
+            # Modify the settings during the first sleep and stop during the second one.
+            sleeps.append(delay)
+            if len(sleeps) > 1:
+                raise KeyboardInterrupt
+            os.utime(settings_path, (0, 0))
+
+        with patch('time.sleep', side_effect=sleep):
+            self.assertRaises(KeyboardInterrupt, self.cappbot.run_forever, 150, Mock(), settings_path)
+
+        self.assertEquals(self.cappbot.configure.call_count, 1)
+
+    def test_run_forever_keeps_settings_on_error(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'))
+        self.settings.COMMENT_WORKERS = 1
+        settings_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, settings_directory)
+        settings_path = os.path.join(settings_directory, 'settings.py')
+        shutil.copy('default_settings.py', settings_path)
+        self.cappbot.configure = Mock()
+
+        # Saved halfway through editing, first failing partway through and then not even parsing.
+        edits = ['UPDATE_DELAY = 99\nnot_defined\n', 'UPDATE_DELAY = (\n']
+
+        def sleep(delay):
+            if not edits:
+                raise KeyboardInterrupt
+            with open(settings_path, 'wb') as f:
+                f.write(edits.pop(0))
+            os.utime(settings_path, (len(edits), len(edits)))
+
+        with patch('time.sleep', side_effect=sleep):
+            self.assertRaises(KeyboardInterrupt, self.cappbot.run_forever, 150, Mock(), settings_path)
+
+        self.assertFalse(self.cappbot.configure.called)
+        self.assertTrue(self.cappbot.settings is self.settings)
+        self.assertEquals(self.settings.UPDATE_DELAY, 0)
+        self.assertEquals(len([record for record in self.log_handler.records if 'Unable to load the settings' in record.message]), 2)
+
+    def test_run_forever_settings_file_missing(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'))
+        self.settings.COMMENT_WORKERS = 1
+        settings_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, settings_directory)
+        settings_path = os.path.join(settings_directory, 'settings.py')
+        shutil.copy('default_settings.py', settings_path)
+        self.cappbot.configure = Mock()
+
+        sleeps = []
+
+        def sleep(delay):
+            # Replace the settings file, which is missing for a moment during the first sleep.
+            sleeps.append(delay)
+            if len(sleeps) == 1:
+                os.rename(settings_path, settings_path + '.old')
+            elif len(sleeps) == 2:
+                os.rename(settings_path + '.old', settings_path)
+            else:
+                raise KeyboardInterrupt
+
+        with patch('time.sleep', side_effect=sleep):
+            self.assertRaises(KeyboardInterrupt, self.cappbot.run_forever, 150, Mock(), settings_path)
+
+        # The daemon keeps going, and the settings file put back unchanged isn't loaded again.
+        self.assertEquals(len(sleeps), 3)
+        self.assertFalse(self.cappbot.configure.called)
+        self.assertTrue(any('Unable to find the settings file' in record.message for record in self.log_handler.records))
+
+    def test_shut_down(self):
+        steps = Mock()
+        cappbots = [Mock(), Mock()]
+        for n, cappbot in enumerate(cappbots):
+            cappbot.writes = getattr(steps, 'writes%d' % n)
+            cappbot.writes.stop.return_value = True
+
+        shut_down(cappbots, steps.coordinator, [steps.store], 30)
+
+        # Whoever takes over a repository once the leases are given up makes the writes left pending, so the write
+        # being made has to be done with first.
+        self.assertEquals(steps.mock_calls, [call.writes0.stop(30), call.writes1.stop(30), call.coordinator.release_all(), call.store.save(), call.store.close()])
+
+        # A write which doesn't finish in time keeps the leases until they run out.
+        steps.reset_mock()
+        cappbots[1].writes.stop.return_value = False
+
+        shut_down(cappbots, steps.coordinator, [steps.store], 30)
+
+        self.assertFalse(steps.coordinator.release_all.called)
+        self.assertTrue(steps.store.close.called)
+
     def fake_comment(self, owner, body):
         number = getattr(self, 'fake_comment_number', 5207158) + 1
         self.fake_comment_number = number
@@ -250,6 +888,19 @@ class TestCappBot(unittest.TestCase):
 
         self.assertEquals(issues[0]._mock_comments[-1].body, "**Milestone:** Someday.  **Label:** #wont-fix.  **What's next?** A reviewer or core team member has decided against acting upon this issue.")
 
+    def test_coalesced_patch(self):
+        issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, 'Fixed it.\n+#fixed\nassignee=alice_tester\n+1')]])
+
+        self.cappbot.run()
+
+        # Labels, assignee and title are changed with one request, and closing waits until after the paper trail.
+        self.assertEquals(issues[0].patch.call_args_list, [
+            call(labels=[u'#new'], milestone=2),
+            call(labels=[u'#fixed'], assignee='alice_tester', title=u'Too few characters [+1]'),
+            call(state='closed')
+        ])
+        self.assertEquals(issues[0]._mock_comments[-1].body, "**Assignee:** [alice_tester](https://github.com/alice_tester).  **Milestone:** Someday.  **Vote:** 1.  **Label:** #fixed.  **What's next?** This issue is considered successfully resolved.")
+
     def test_action_by_comment_open_issue(self):
         issues, labels, milestones = self.configure_github_mock(load_fixture('issues.json')[7:8], load_fixture('labels.json'), load_fixture('milestones.json'), [[self.fake_comment(self.alice_user, 'Not actually fixed. \n-#fixed')]])
         issues[0].labels = [labels[6]]
@@ -258,8 +909,7 @@ class TestCappBot(unittest.TestCase):
         # CappBot will record the issue as manually triaged and ignore any comment actions.
         self.cappbot.run()
         issues[0].patch.assert_has_calls([
-            call(labels=[]),
-            call(state='open')
+            call(labels=[], state='open')
         ])
 
         self.assertEquals(issues[0]._mock_comments[-1].body, "**What's next?** A reviewer should examine this issue.")
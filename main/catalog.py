@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""The labels, milestones and collaborators of a repository, indexed for lookups by name."""
+
+import logbook
+
+
+class RepositoryCatalog(object):
+    """The labels, milestones and collaborators of a repository, keyed by their lowercased names.
+
+    Everything is listed once by `load`, after which lookups don't touch the API. Labels and milestones created
+    through the catalog are added to it, so asking for the same missing one twice only creates it once. Those
+    created by someone else since are found by setting `may_reload`, which lets the first label or milestone
+    lookup to miss load everything again.
+
+    """
+
+    def __init__(self, github, repo_user, repo_name):
+        self.github = github
+        self.repo_user = repo_user
+        self.repo_name = repo_name
+
+        self.labels = {}
+        self.milestones = {}
+        self.milestones_by_number = {}
+        self.collaborators = {}
+        self.may_reload = False
+
+        self._label_list = None
+        self._milestone_list = None
+
+    def __unicode__(self):
+        return u"<RepositoryCatalog %s/%s: %d labels, %d milestones, %d collaborators>" % (self.repo_user, self.repo_name, len(self.labels), len(self.milestones), len(self.collaborators))
+
+    def load(self):
+        """List the labels, milestones and collaborators of the repository, replacing anything loaded before."""
+
+        self._label_list = self.github.Labels.by_repository(self.repo_user, self.repo_name, per_page=100, all_pages=True)
+        self.labels = dict((label.name.lower(), label) for label in self._label_list)
+
+        self._milestone_list = self.github.Milestones.by_repository(self.repo_user, self.repo_name, state='all', per_page=100, all_pages=True)
+        self.milestones = dict((milestone.title.lower(), milestone) for milestone in self._milestone_list)
+        self.milestones_by_number = dict((milestone.number, milestone) for milestone in self._milestone_list)
+
+        collaborators = self.github.Collaborators.by_repository(self.repo_user, self.repo_name, per_page=100, all_pages=True)
+        self.collaborators = dict((collaborator.login.lower(), collaborator) for collaborator in collaborators)
+
+        self.may_reload = False
+
+    def _reload(self):
+        """Load everything again if `may_reload` is set, returning True if it was."""
+
+        if not self.may_reload:
+            return False
+        logbook.debug(u"Reloading %s after a lookup missed." % unicode(self))
+        self.load()
+        return True
+
+    def get_label(self, name):
+        """Return the label with the given name, in any capitalisation, or None if there is no such label."""
+
+        if not name:
+            return None
+        label = self.labels.get(name.lower())
+        if label is None and self._reload():
+            label = self.labels.get(name.lower())
+        return label
+
+    def get_milestone(self, title):
+        """Return the milestone with the given title, in any capitalisation, or None if there is no such milestone."""
+
+        if not title:
+            return None
+        milestone = self.milestones.get(title.lower())
+        if milestone is None and self._reload():
+            milestone = self.milestones.get(title.lower())
+        return milestone
+
+    def get_milestone_by_number(self, number):
+        """Return the milestone with the given number, or None if there is no such milestone."""
+
+        milestone = self.milestones_by_number.get(number)
+        if milestone is None and self._reload():
+            milestone = self.milestones_by_number.get(number)
+        return milestone
+
+    def get_collaborator(self, login):
+        """Return the collaborator with the given login, in any capitalisation, or None if there is no such
+        collaborator.
+
+        """
+
+        return self.collaborators.get(login.lower()) if login else None
+
+    def get_or_create_label(self, name):
+        label = self.get_label(name)
+        if label is not None:
+            return label
+
+        label = self.github.Label()
+        label.name = name
+        self._label_list.post(label)
+        logbook.info(u"Created label %s." % name)
+
+        self.labels[name.lower()] = label
+        return label
+
+    def get_or_create_milestone(self, title):
+        if title is None:
+            return None
+
+        milestone = self.get_milestone(title)
+        if milestone is not None:
+            return milestone
+
+        milestone = self.github.Milestone()
+        milestone.title = title
+        self._milestone_list.post(milestone)
+        logbook.info(u"Created milestone %s." % title)
+
+        self.milestones[title.lower()] = milestone
+        self.milestones_by_number[milestone.number] = milestone
+        return milestone
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""The commands people can give CappBot in issue comments.
+
+Each line of a comment is one potential command:
+
+    +1, -1, +0, -0   vote for or against the issue, or withdraw a vote
+    +label, #label   add a label
+    -label           remove a label
+    milestone=title  set the milestone, or clear it with an empty title
+    assignee=login   set the assignee, or clear it with an empty login
+
+"""
+
+import re
+
+VOTE = 'vote'
+ADD_LABEL = 'add_label'
+REMOVE_LABEL = 'remove_label'
+SET_MILESTONE = 'milestone'
+SET_ASSIGNEE = 'assignee'
+
+# Each pattern is a single character class, so matching never takes more than linear time however long the line.
+LABEL_REGEX = re.compile(r'[-\w _#]+$')
+ASSIGNEE_REGEX = re.compile(r'[-\w_#]*$')
+
+
+def scan_commands(body):
+    """Yield a (kind, argument) tuple for every command in the comment `body`, in order.
+
+    Votes have an int argument. All other arguments are strings as written, in their original capitalisation.
+
+    """
+
+    if not body:
+        return
+
+    for line in body.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+
+        # Most lines are prose or pasted logs, so tell from the first character whether a line could be a command
+        # at all before looking at the rest of it.
+        first = line[0]
+        if first == '+' or first == '-':
+            argument = line[1:]
+            if argument == '1' or argument == '0':
+                # Votes look just like +<label> or -<label> where the label is the number 1 or 0.
+                yield VOTE, int(line)
+            elif argument and LABEL_REGEX.match(argument):
+                yield (ADD_LABEL if first == '+' else REMOVE_LABEL), argument
+        elif first == '#':
+            if len(line) > 1 and LABEL_REGEX.match(line, 1):
+                yield ADD_LABEL, line
+        elif first == 'm':
+            if line.startswith('milestone='):
+                yield SET_MILESTONE, line[10:]
+        elif first == 'a':
+            if line.startswith('assignee=') and ASSIGNEE_REGEX.match(line, 9):
+                yield SET_ASSIGNEE, line[9:]
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Time scanning comments for commands, with and without pasted logs.
+
+Usage: python comment_commands_benchmark.py [-n REPEAT]
+
+The regular expressions CappBot used before `scan_commands` are timed alongside for comparison.
+
+"""
+
+import argparse
+import re
+import timeit
+
+from comment_commands import scan_commands
+
+ADD_LABEL_REGEX = re.compile(r'^\+([-\w\d _#]*[-\w\d_#]+)$|^(#[-\w\d _#]*[-\w\d_#]+)$')
+REMOVE_LABEL_REGEX = re.compile(r'^-([-\w\d _#]*[-\w\d_#]+)$')
+SET_MILESTONE_REGEX = re.compile(r'^milestone=(.*)$')
+SET_ASSIGNEE_REGEX = re.compile(r'^assignee=([-\w\d_#]*)$')
+VOTE_REGEX = re.compile(r'^[-\+][01]$')
+
+STACK_TRACE = '\n'.join(['Traceback (most recent call last):'] + ['  File "/usr/lib/app/frame%d.py", line %d, in handler' % (n, n) for n in range(2000)])
+# Diff and list lines which start out looking like label commands.
+DIFF = '\n'.join(['- removed line %d of the old implementation of the frame handler' % n for n in range(2000)] + ['+ added line %d' % n for n in range(2000)])
+# A long line of label characters which ends in something else, like a wrapped log message. The old label
+# expressions backtrack over the whole line before rejecting it.
+LONG_LINE = '+' + 'connection to worker lost retrying ' * 300 + '...'
+
+COMMENTS = {
+    'short comment': 'Confirmed on 0.9.5.\n\n+1\n#needs-patch\nmilestone=1.0',
+    'stack trace': STACK_TRACE,
+    'diff': DIFF,
+    'long line': LONG_LINE,
+}
+
+
+def scan_with_regexes(body):
+    """Find the commands the way CappBot used to: every line against every regular expression."""
+
+    r = []
+    for line in body.split('\n'):
+        line = line.strip()
+        if VOTE_REGEX.match(line):
+            r.append(line)
+            continue
+        for regex in (ADD_LABEL_REGEX, REMOVE_LABEL_REGEX, SET_MILESTONE_REGEX, SET_ASSIGNEE_REGEX):
+            if regex.match(line):
+                r.append(line)
+                break
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='best of how many runs (default: 5)')
+    args = parser.parse_args()
+
+    print "%-15s %10s %12s %12s" % ('comment', 'bytes', 'regexes', 'scanner')
+    for name, body in sorted(COMMENTS.items()):
+        regexes = min(timeit.repeat(lambda: scan_with_regexes(body), number=1, repeat=args.repeat))
+        scanner = min(timeit.repeat(lambda: list(scan_commands(body)), number=1, repeat=args.repeat))
+        print "%-15s %10d %10.2fms %10.2fms" % (name, len(body), regexes * 1000, scanner * 1000)
+
+
+if __name__ == '__main__':
+    main()
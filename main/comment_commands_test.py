@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2011-12, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import unittest
+
+from comment_commands import ADD_LABEL, REMOVE_LABEL, SET_ASSIGNEE, SET_MILESTONE, VOTE, scan_commands
+
+
+class TestScanCommands(unittest.TestCase):
+    def assertCommands(self, body, expected):
+        self.assertEquals(list(scan_commands(body)), expected)
+
+    def test_votes(self):
+        self.assertCommands('+1', [(VOTE, 1)])
+        self.assertCommands('  -1  ', [(VOTE, -1)])
+        self.assertCommands('+0\n-0', [(VOTE, 0), (VOTE, 0)])
+        self.assertCommands('+2', [(ADD_LABEL, '2')])
+        self.assertCommands('+1 from me', [(ADD_LABEL, '1 from me')])
+
+    def test_labels(self):
+        self.assertCommands('Looks like a bug.\n\n+#Bug\n-#needs-info\n#ready-to-commit', [(ADD_LABEL, '#Bug'), (REMOVE_LABEL, '#needs-info'), (ADD_LABEL, '#ready-to-commit')])
+        self.assertCommands('+needs review', [(ADD_LABEL, 'needs review')])
+        self.assertCommands('+bug!', [])
+        self.assertCommands('#', [])
+        self.assertCommands('+', [])
+        self.assertCommands(u'+caf\xe9', [])
+
+    def test_milestone_and_assignee(self):
+        self.assertCommands('milestone=1.0 Beta\nassignee=Alice_Tester', [(SET_MILESTONE, '1.0 Beta'), (SET_ASSIGNEE, 'Alice_Tester')])
+        self.assertCommands('milestone=\nassignee=', [(SET_MILESTONE, ''), (SET_ASSIGNEE, '')])
+        self.assertCommands('assignee=alice tester', [])
+        self.assertCommands('Milestone=1.0', [])
+
+    def test_prose(self):
+        self.assertCommands(None, [])
+        self.assertCommands('', [])
+        self.assertCommands('I think this needs\na +1 and milestone=1.0.', [])
+
+    def test_long_lines(self):
+        # Lines which nearly look like commands must still be rejected in linear time.
+        line = '+' + 'frame ' * 50000 + '!'
+        self.assertCommands('\n'.join([line, line.replace('+', '-', 1), '#' + line[1:], '+1']), [(VOTE, 1)])
+
@@ -4,7 +4,39 @@ GITHUB_USER = "cappbot"
 GITHUB_TOKEN = ""
 GITHUB_REPOSITORY = "cappuccino/cappuccino"
 
-DATABASE = "cappbot-%s-db.json" % GITHUB_REPOSITORY.replace('/', '-')
+# To look after several repositories from one process, list them here instead,
+# either by name or as a dict from name to the settings which differ for that
+# repository, like {"cappuccino/cappuccino": {}, "cappuccino/website":
+# {"NEW_ISSUE_DEFAULTS": {...}}}. The repositories share the GitHub user,
+# connections and response cache, and take turns issue by issue, so
+# GITHUB_TOKEN, RESPONSE_CACHE*, HTTP_*, AVOID_RATE_LIMIT, UPDATE_DELAY,
+# RUN_INTERVAL and LEASE_* can't be set for a single repository. Each has a database of its
+# own, named after DATABASE with the repository name added.
+# --serve and --migrate-from only work with a single GITHUB_REPOSITORY, and
+# with several the settings file isn't reloaded by --daemon.
+GITHUB_REPOSITORIES = None
+
+# Where CappBot remembers what it has seen. A path ending with .json uses a
+# single JSON file, which is rewritten in full on every save; anything else is
+# an SQLite database. To move from a JSON database to SQLite, run CappBot once
+# with --migrate-from OLD-DATABASE.json. A new SQLite database next to a JSON
+# database of the same name, like the one DATABASE used to default to, starts
+# out as a copy of it.
+DATABASE = "cappbot-%s-db.sqlite" % GITHUB_REPOSITORY.replace('/', '-')
+
+# Directory in which to keep GitHub API responses so that later requests for
+# the same data can be made conditional. GitHub does not count a request
+# against the rate limit when the answer is "not modified". Set to None to
+# disable. Least recently used responses are dropped once the cache grows
+# beyond RESPONSE_CACHE_MAX_SIZE bytes.
+RESPONSE_CACHE = "cappbot-%s-cache" % GITHUB_REPOSITORY.replace('/', '-')
+RESPONSE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# GitHub API requests are made over at most this many keep-alive connections,
+# which are given up on after HTTP_TIMEOUT seconds without a response. The
+# pages of long listings are fetched concurrently over these connections.
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUT = 30
 
 # Ignore all closed issues not updated since before the CappBot database was
 # created. This will prevent CappBot from causing a flood of needless
@@ -13,15 +45,92 @@ DATABASE = "cappbot-%s-db.json" % GITHUB_REPOSITORY.replace('/', '-')
 # CappBot will work with them.
 IGNORE_CLOSED_ISSUES_NOT_UPDATED_SINCE_FIRST_RUN = True
 
-# If True, if the remaining rate limit drops below 3600, CappBot will wait
-# (1.0 / remaining_limit) at the beginning of handling a new issue.
+# If True, CappBot spreads the requests remaining until GitHub resets the rate
+# limit evenly over that time. Each run (every RUN_INTERVAL seconds) may use its
+# share of them straight away; requests beyond that are slowed down to the rate
+# which would use up the rest exactly as the rate limit resets.
 AVOID_RATE_LIMIT = True
 
-# Wait this many seconds after each update. This is separate and in addition
-# to any delay caused by AVOID_RATE_LIMIT. The purpose of UPDATE_DELAY is to
-# limit the maximum trouble per hour caused by CappBot if some bug causes it
-# to post over and over to the same issue.
-UPDATE_DELAY = 10
+# Make changes to issues at least this many seconds apart. Changes are made in
+# the background, so this doesn't hold up looking at other issues. GitHub asks
+# for at least a second between requests which create content; when it asks
+# CappBot to slow down anyway, changes are spaced out further for a while. The
+# purpose of UPDATE_DELAY is also to limit the maximum trouble per hour caused
+# by CappBot if some bug causes it to post over and over to the same issue.
+# Changes not yet made when CappBot stops are made when it starts again. With
+# several repositories, their changes share this pace.
+UPDATE_DELAY = 1
+
+# With --daemon, start a new run this many seconds after the previous one
+# started.
+RUN_INTERVAL = 150
+
+# The labels, milestones and collaborators of the repository are loaded again
+# when they are older than this many seconds at the start of a run. In
+# --daemon mode, they are also loaded again, at most once a run, when a
+# comment names a label or milestone which isn't known yet.
+METADATA_REFRESH_INTERVAL = 10 * 60
+
+# Retrieve the comments of up to this many changed issues at a time. Changes
+# are still made one issue at a time.
+COMMENT_WORKERS = 4
+
+# Normally CappBot only lists the issues updated since the newest update it
+# has seen. Every FULL_SCAN_INTERVAL seconds it lists every issue instead, to
+# catch changes which didn't show up in the incremental listing. Set to 0 to
+# list every issue on every run.
+FULL_SCAN_INTERVAL = 24 * 60 * 60
+
+# Retrieve the comments of up to this many changed issues at a time over
+# non-blocking connections, all on one thread, instead of with COMMENT_WORKERS
+# threads. GitHub allows at most 100 concurrent requests. Set to 0 to use
+# threads.
+ASYNC_REQUESTS = 0
+
+# Retrieve the comments of changed issues through GitHub's GraphQL API, with one
+# request for up to GRAPHQL_BATCH_SIZE issues rather than one or more requests
+# per issue. Only the latest GRAPHQL_COMMENTS (at most 100) comments of each
+# issue are in the answer; the comments of issues with more than that are
+# retrieved as usual. Set GRAPHQL_BATCH_SIZE to 0 to not use GraphQL.
+GRAPHQL_BATCH_SIZE = 0
+GRAPHQL_COMMENTS = 100
+
+# Find changed issues through the repository's events rather than by listing
+# issues. When nothing has happened this takes a single request which doesn't
+# count against the rate limit. If more has happened since the last run than
+# GitHub keeps events for, every issue is listed instead.
+POLL_EVENTS = False
+
+## Webhooks ##
+
+# With --serve, CappBot listens for GitHub webhook deliveries on this address
+# and reacts to the issues they name right away. Deliveries must be signed
+# with WEBHOOK_SECRET. A regular run is still made every RUN_INTERVAL seconds
+# to catch anything the deliveries missed.
+WEBHOOK_HOST = ''
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = None
+
+## Replicas ##
+
+# To share the repositories among several replicas of CappBot, point
+# LEASE_DATABASE at an SQLite database which all of them can reach, on a volume
+# they share along with their DATABASEs, which has to support file locking
+# across hosts. A replica only opens the DATABASEs of the repositories it looks
+# after, and they use a rollback journal rather than a write-ahead log, which
+# only works on one host. Each repository is looked after by one
+# replica at a time, chosen by consistent hashing, which holds a lease on it for
+# LEASE_DURATION seconds and keeps renewing it. When a replica stops, its
+# repositories move to the others once their leases run out. Every replica needs
+# a REPLICA_NAME of its own, which defaults to the host name, and the same
+# settings otherwise, and their clocks should agree to within a few seconds. The
+# DATABASEs have to be SQLite databases, and --serve and --migrate-from don't
+# work with LEASE_DATABASE. Changes to a repository are only made while at least
+# a third of the lease is left, so that they're done before another replica
+# could take over, which takes a LEASE_DURATION well over 3 * HTTP_TIMEOUT.
+LEASE_DATABASE = None
+LEASE_DURATION = 2 * RUN_INTERVAL
+REPLICA_NAME = None
 
 ## Issue Life Cycle ##
 
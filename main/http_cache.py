@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""A disk backed cache of HTTP responses for making conditional requests.
+
+Each cached response is stored with the validators (ETag and Last-Modified) it was served with. When the same URL is
+requested again, the validators are sent along as If-None-Match and If-Modified-Since, and if the server answers 304
+Not Modified, the cached body is used instead. GitHub doesn't count such responses against the rate limit.
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logbook
+import os
+import threading
+
+
+class ResponseCache(object):
+    """A size bounded, least recently used cache of response headers and bodies, keyed by URL.
+
+    Every entry is a file in `directory`, which is created when the first entry is stored. Once the combined size of
+    the entries exceeds `max_size` bytes, the least recently used entries are evicted.
+
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._sizes = None
+        self._total_size = 0
+        self._lock = threading.RLock()
+
+    def __unicode__(self):
+        return u"<ResponseCache %s: %d hits, %d misses, %d evictions, %d bytes>" % (self.directory, self.hits, self.misses, self.evictions, self._total_size)
+
+    def record(self, hit):
+        """Count a request answered from the cache if `hit`, or by a full response otherwise."""
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def _load_index(self):
+        """Find the existing entries, least recently used first."""
+
+        if self._sizes is not None:
+            return
+
+        self._sizes = OrderedDict()
+        self._total_size = 0
+
+        if not os.path.isdir(self.directory):
+            return
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.new'):
+                # Left behind by an interrupted write.
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for mtime, name, size in sorted(entries):
+            self._sizes[name] = size
+            self._total_size += size
+
+    def get(self, url):
+        """Return the cached `(headers, content)` for `url`, or None if there is no such entry."""
+
+        with self._lock:
+            self._load_index()
+
+            path = self._path(url)
+            name = os.path.basename(path)
+            if name not in self._sizes:
+                return None
+
+            try:
+                with open(path, 'rb') as f:
+                    meta, content = f.read().split('\n', 1)
+                meta = json.loads(meta)
+            except (IOError, OSError, ValueError):
+                logbook.warning(u"Discarding unreadable response cache entry for %s." % url)
+                self.delete(url)
+                return None
+
+            if meta['url'] != url:
+                # A hash collision; treat it as a miss.
+                return None
+
+            # Mark the entry as recently used, both here and on disk for the next process.
+            self._sizes[name] = self._sizes.pop(name)
+            os.utime(path, None)
+
+            return meta['headers'], content
+
+    def set(self, url, headers, content):
+        """Store the response `headers` (a dict) and `content` for `url`."""
+
+        with self._lock:
+            self._load_index()
+
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            path = self._path(url)
+            name = os.path.basename(path)
+            data = json.dumps({'url': url, 'headers': headers}) + '\n' + content
+
+            if len(data) > self.max_size:
+                return
+
+            self.delete(url)
+            with open(path + '.new', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.new', path)
+
+            self._sizes[name] = len(data)
+            self._total_size += len(data)
+
+            while self._total_size > self.max_size:
+                old_name, size = self._sizes.popitem(last=False)
+                self._total_size -= size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, old_name))
+                except OSError:
+                    pass
+
+    def delete(self, url):
+        with self._lock:
+            self._load_index()
+
+            path = self._path(url)
+            size = self._sizes.pop(os.path.basename(path), None)
+            if size is None:
+                return
+
+            self._total_size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""The label settings of a repository, compiled for applying them to issue after issue."""
+
+
+class LabelRules(object):
+    """WHEN_LABEL_REMOVE_LABELS, MUTUALLY_EXCLUSIVE_LABELS and the labels which close and reopen issues, compiled.
+
+    Every label named by the rules is given a bit, by its lowercased name like the catalog's lookups, so the set of
+    rule labels an issue has is a single int and each rule is a mask test instead of a scan of the issue's labels.
+
+    """
+
+    def __init__(self, when_label_remove_labels=None, mutually_exclusive_labels=(), close_when_added=(), open_when_removed=()):
+        self.bits = {}
+        # The labels each trigger label removes, by the bit of the trigger label.
+        self.removals = {}
+        for trigger_label, labels_to_remove in (when_label_remove_labels or {}).items():
+            trigger = self.intern(trigger_label)
+            for label in labels_to_remove:
+                self.removals[trigger] = self.removals.get(trigger, 0) | self.intern(label)
+
+        self.exclusive = 0
+        for label in mutually_exclusive_labels:
+            self.exclusive |= self.intern(label)
+
+        self.closing = frozenset(label.lower() for label in close_when_added)
+        self.opening = frozenset(label.lower() for label in open_when_removed)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.WHEN_LABEL_REMOVE_LABELS, settings.MUTUALLY_EXCLUSIVE_LABELS, settings.CLOSE_ISSUE_WHEN_CAPPBOT_ADDS_LABEL, settings.OPEN_ISSUE_WHEN_CAPPBOT_REMOVES_LABEL)
+
+    def intern(self, label):
+        """Return the bit of `label`, giving it the next free one if it has none yet."""
+
+        key = label.lower()
+        bit = self.bits.get(key)
+        if bit is None:
+            bit = self.bits[key] = 1 << len(self.bits)
+        return bit
+
+    def bit(self, label):
+        """Return the bit of `label`, or 0 for labels no rule mentions."""
+
+        return self.bits.get(label.lower(), 0) if label else 0
+
+    def closes(self, label):
+        """Return True if adding `label` closes the issue."""
+
+        return label.lower() in self.closing
+
+    def opens(self, label):
+        """Return True if removing `label` reopens the issue."""
+
+        return label.lower() in self.opening
+
+    def conflicts(self, labels):
+        """Return a (label, cause) pair for every label in `labels`, in the order they were added, which the rules
+        say has to be removed because the label `cause` is set.
+
+        The most recently added labels take precedence: triggers are applied from the last added backwards, skipping
+        any a later trigger already removed, and of the mutually exclusive labels left only the last added is kept.
+        Removing labels can't set off any further rules, so what is left satisfies every rule.
+
+        """
+
+        bits = [self.bit(label) for label in labels]
+        present = 0
+        for bit in bits:
+            present |= bit
+        if not present:
+            return []
+
+        r = []
+        for n in range(len(labels) - 1, -1, -1):
+            bit = bits[n]
+            if not bit & present:
+                continue
+            mask = self.removals.get(bit, 0) & present
+            if not mask:
+                continue
+            for m, other in enumerate(bits):
+                if other & mask:
+                    r.append((labels[m], labels[n]))
+            present &= ~mask
+
+        exclusive = present & self.exclusive
+        if exclusive & (exclusive - 1):
+            # More than one bit set. Keep the last added and drop the others, most recent first.
+            keep = None
+            for n in range(len(labels) - 1, -1, -1):
+                bit = bits[n]
+                if not bit & exclusive:
+                    continue
+                if keep is None:
+                    keep = labels[n]
+                else:
+                    r.append((labels[n], keep))
+                exclusive &= ~bit
+
+        return r
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Time applying label rules to the issues of a synthetic repository with hundreds of labels and rules.
+
+Usage: python label_rules_benchmark.py [-n REPEAT] [--labels LABELS] [--issues ISSUES]
+
+The loops CappBot used before `LabelRules` are timed alongside for comparison.
+
+"""
+
+import argparse
+import random
+import timeit
+
+from label_rules import LabelRules
+
+
+def synthetic_repository(label_count, issue_count, seed=0):
+    """Return label rules settings and issue label lists like those of a large repository."""
+
+    rand = random.Random(seed)
+    labels = ['#label-%d' % n for n in range(label_count)]
+    when_label_remove_labels = dict((label, rand.sample(labels, 10)) for label in rand.sample(labels, label_count // 2))
+    mutually_exclusive_labels = rand.sample(labels, 20)
+    issues = [rand.sample(labels, rand.randint(1, 8)) for n in range(issue_count)]
+    return when_label_remove_labels, mutually_exclusive_labels, issues
+
+
+def apply_with_loops(when_label_remove_labels, mutually_exclusive_labels, labels):
+    """Apply the rules the way CappBot used to: every rule against the list of labels."""
+
+    labels = list(labels)
+    for trigger_label, labels_to_remove in when_label_remove_labels.items():
+        if trigger_label in labels:
+            for label in labels_to_remove:
+                if label in labels:
+                    labels.remove(label)
+
+    backwards = list(reversed(labels))
+    for n, label in enumerate(backwards):
+        if label in mutually_exclusive_labels:
+            for other_label in backwards[n + 1:]:
+                if other_label in mutually_exclusive_labels:
+                    labels.remove(other_label)
+            break
+    return labels
+
+
+def apply_with_rules(rules, labels):
+    labels = list(labels)
+    for label, cause in rules.conflicts(labels):
+        labels.remove(label)
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='best of how many runs (default: 5)')
+    parser.add_argument('--labels', type=int, default=500, help='labels in the repository (default: 500)')
+    parser.add_argument('--issues', type=int, default=10000, help='issues to apply the rules to (default: 10000)')
+    args = parser.parse_args()
+
+    when_label_remove_labels, mutually_exclusive_labels, issues = synthetic_repository(args.labels, args.issues)
+    print "%d labels, %d removal rules, %d mutually exclusive labels, %d issues" % (args.labels, len(when_label_remove_labels), len(mutually_exclusive_labels), len(issues))
+
+    compiling = min(timeit.repeat(lambda: LabelRules(when_label_remove_labels, mutually_exclusive_labels), number=1, repeat=args.repeat))
+    rules = LabelRules(when_label_remove_labels, mutually_exclusive_labels)
+    loops = min(timeit.repeat(lambda: [apply_with_loops(when_label_remove_labels, mutually_exclusive_labels, labels) for labels in issues], number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(lambda: [apply_with_rules(rules, labels) for labels in issues], number=1, repeat=args.repeat))
+
+    print "%-10s %10.2fms" % ('compiling', compiling * 1000)
+    print "%-10s %10.2fms" % ('loops', loops * 1000)
+    print "%-10s %10.2fms" % ('compiled', compiled * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2011-12, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import imp
+import unittest
+
+from label_rules import LabelRules
+
+
+class TestLabelRules(unittest.TestCase):
+    def setUp(self):
+        self.rules = LabelRules.from_settings(imp.load_source('settings', 'default_settings.py'))
+
+    def test_removals(self):
+        self.assertEquals(self.rules.conflicts(['#needs-info', 'bug', '#Acknowledged']), [('#needs-info', '#Acknowledged')])
+        self.assertEquals(self.rules.conflicts(['#needs-info', 'bug', '#needs-review']), [])
+        self.assertEquals(self.rules.conflicts(['bug', None]), [])
+
+    def test_most_recent_trigger_first(self):
+        rules = LabelRules({'a': ['b'], 'b': ['c']})
+        # b is added last, so it removes c before a removes b.
+        self.assertEquals(rules.conflicts(['a', 'c', 'b']), [('c', 'b'), ('b', 'a')])
+        # a removes b before b can remove c.
+        self.assertEquals(rules.conflicts(['c', 'b', 'a']), [('b', 'a')])
+
+    def test_mutually_exclusive(self):
+        self.assertEquals(self.rules.conflicts(['#new', '#accepted', 'bug', '#fixed']), [('#accepted', '#fixed'), ('#new', '#fixed')])
+        self.assertEquals(self.rules.conflicts(['#new', 'bug']), [])
+
+    def test_removals_before_exclusion(self):
+        # #duplicate removes #new, which then doesn't conflict with #accepted.
+        self.assertEquals(self.rules.conflicts(['#accepted', '#new', '#duplicate']), [('#new', '#duplicate')])
+
+    def test_closes_and_opens(self):
+        self.assertTrue(self.rules.closes('#Fixed'))
+        self.assertFalse(self.rules.closes('#new'))
+        self.assertTrue(self.rules.opens('#wont-fix'))
+        self.assertFalse(self.rules.opens('bug'))
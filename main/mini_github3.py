@@ -19,29 +19,304 @@
 
 """
 
+from collections import namedtuple
+from contextlib import contextmanager
 from link_header import parse_link_value
+from multiprocessing.pool import ThreadPool
 from urllib import quote_plus
 from urlparse import urljoin
+import Queue
 import argparse
+import httplib
 import httplib2
 import json
 import logbook
+import socket
+import threading
+import time
 import urllib
 import urlparse
 
 
 from remoteobjects import RemoteObject, fields, ListObject
 
-# TODO Don't use a global since this only allows one token at a time.
-SharedGitHub = None
+
+class ConnectionPool(object):
+    """A bounded pool of `httplib2.Http` user agents, compatible with `httplib2.Http`.
+
+    Each user agent keeps its connection to the API open between requests, so that the TCP and TLS handshakes are
+    only paid once per connection rather than once per request. At most `size` connections are opened; when all of
+    them are busy, requests wait for one to become available. Connections time out after `timeout` seconds.
+
+    """
+
+    def __init__(self, size=4, timeout=30):
+        self.size = size
+        self.timeout = timeout
+
+        # Last in, first out so that the connection most likely to still be open is reused first.
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return httplib2.Http(timeout=self.timeout)
+
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        http = self._acquire()
+        try:
+            yield http
+        finally:
+            self._idle.put(http)
+
+    def request(self, *args, **kwargs):
+        with self.connection() as http:
+            return http.request(*args, **kwargs)
+
+
+class RateLimitBudget(object):
+    """Spread the requests left in the current rate limit window evenly over the time until it resets.
+
+    The `X-RateLimit-Remaining` and `X-RateLimit-Reset` headers of every response are read. Each `cycle` seconds,
+    such as the time between runs, may use its share of the requests remaining in the window all at once. After
+    that, requests are let through at the rate which would use up the window exactly as it resets. A request only
+    waits when that budget is used up, or until the reset when the window itself is used up.
+
+    """
+
+    def __init__(self, cycle=150, clock=time.time, sleep=time.sleep):
+        self.cycle = cycle
+        self.clock = clock
+        self.sleep = sleep
+
+        self.remaining = None
+        self.limit = None
+        self.reset_at = None
+
+        self._tokens = None
+        self._refilled_at = None
+        self._lock = threading.Lock()
+
+    def update(self, response):
+        """Take the rate limit as stated by `response`."""
+
+        if 'x-ratelimit-remaining' not in response or 'x-ratelimit-reset' not in response:
+            return
+        if response.get('x-ratelimit-resource', 'core') != 'core':
+            # The GraphQL API and others are limited separately.
+            return
+
+        with self._lock:
+            self.remaining = int(response['x-ratelimit-remaining'])
+            self.limit = int(response.get('x-ratelimit-limit') or 0) or None
+            self.reset_at = int(response['x-ratelimit-reset'])
+
+    def refund(self):
+        """Give back the request taken by `acquire` if it didn't count against the rate limit after all."""
+
+        with self._lock:
+            if self._tokens is not None:
+                self._tokens += 1
+
+    def acquire(self):
+        """Take one request from the budget, waiting until there is one if need be. Return the time waited."""
+
+        delay = self.reserve()
+        if delay > 0:
+            self.sleep(delay)
+        return delay
+
+    def reserve(self):
+        """Take one request from the budget and return how many seconds to wait before making it, for callers
+        which can't just sleep.
+
+        """
+
+        with self._lock:
+            now = self.clock()
+            if self.remaining is None or now >= self.reset_at:
+                # Either nothing is known yet, or the window has reset and the next response will say how it looks.
+                self._tokens = None
+                return 0
+
+            if self.remaining <= 0:
+                delay = self.reset_at - now
+            else:
+                rate = float(self.remaining) / (self.reset_at - now)
+                capacity = min(self.remaining, max(1.0, rate * self.cycle))
+                if self._tokens is None:
+                    self._tokens = capacity
+                else:
+                    self._tokens = min(capacity, self._tokens + (now - self._refilled_at) * rate)
+                self._refilled_at = now
+
+                # Waiting requests reserve the requests to come, so that they are let through one at a time.
+                self._tokens -= 1
+                delay = -self._tokens / rate if self._tokens < 0 else 0
+                self.remaining -= 1
+
+        if delay > 1:
+            logbook.debug("Rate limit budget used up (%d requests remaining). Waiting %.1fs." % (max(0, self.remaining), delay))
+        return delay
+
+
+class GitHubHttp(object):
+    """The user agent for all GitHub requests, compatible with `httplib2.Http`.
+
+    Requests are made over the keep-alive connections of a `ConnectionPool`.
+
+    If a `ResponseCache` is given, GET responses with an ETag or Last-Modified validator are stored in it and
+    later requests for the same URL are made conditional. On a 304 Not Modified response the cached response is
+    returned in its place, with the rate limit headers of the fresh response.
+
+    If a `RateLimitBudget` is given, every request to the REST API is made within it. GraphQL queries are limited
+    separately, by points rather than requests, so they don't take from it.
+
+    """
+
+    def __init__(self, response_cache=None, pool_size=4, timeout=30, rate_limit=None):
+        self.pool = ConnectionPool(size=pool_size, timeout=timeout)
+        self.response_cache = response_cache
+        self.rate_limit = rate_limit
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if self.is_budgeted(uri):
+            self.rate_limit.acquire()
+
+        headers, cached = self.prepare(uri, method, headers)
+        response, content = self.pool.request(uri, method=method, body=body, headers=headers, **kwargs)
+        return self.complete(uri, method, cached, response, content)
+
+    def is_budgeted(self, uri):
+        """Return whether a request to `uri` is made within the `RateLimitBudget`."""
+
+        return self.rate_limit is not None and urlparse.urlsplit(uri).path != '/graphql'
+
+    def prepare(self, uri, method, headers):
+        """Return the headers to make a request with, conditional if there's a cached response to `uri`, and the
+        cached response, if any.
+
+        """
+
+        cache = self.response_cache
+        if cache is None or method != 'GET':
+            return headers, None
+
+        headers = dict(headers or {})
+        cached = cache.get(uri)
+        if cached:
+            cached_headers, cached_content = cached
+            if 'etag' in cached_headers:
+                headers['if-none-match'] = cached_headers['etag']
+            if 'last-modified' in cached_headers:
+                headers['if-modified-since'] = cached_headers['last-modified']
+        return headers, cached
+
+    def complete(self, uri, method, cached, response, content):
+        """Return the response to a request made with the headers from `prepare`, taken from the cache if it
+        wasn't modified, and cache it if need be.
+
+        """
+
+        response, content = self._complete(uri, method, cached, response, content)
+        if self.is_budgeted(uri):
+            self.rate_limit.update(response)
+            if getattr(response, 'fromcache', False):
+                # GitHub doesn't count requests answered with "not modified".
+                self.rate_limit.refund()
+        return response, content
+
+    def _complete(self, uri, method, cached, response, content):
+        cache = self.response_cache
+        if cache is None or method != 'GET':
+            return response, content
+
+        if cached and response.status == 304:
+            cached_headers, cached_content = cached
+            cache.record(hit=True)
+            cached_headers = dict(cached_headers)
+            cached_headers.update((k, v) for k, v in response.items() if k.startswith('x-ratelimit-') or k == 'x-poll-interval')
+            cached_headers['status'] = '200'
+            response = httplib2.Response(cached_headers)
+            response.fromcache = True
+            return response, cached_content
+
+        cache.record(hit=False)
+        if response.status == 200 and ('etag' in response or 'last-modified' in response):
+            cache.set(uri, dict(response), content)
+
+        return response, content
+
+
+class RateLimited(httplib.HTTPException):
+    """GitHub asked for requests to slow down. If it said for how long, `retry_after` is that many seconds."""
+
+    def __init__(self, message, retry_after=None):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Unavailable(httplib.HTTPException):
+    """GitHub answered with a server error. The same request may well succeed when made again."""
+
+
+class Gone(httplib.HTTPException):
+    """GitHub answered 410 Gone, as it does for an issue which was deleted."""
+
+
+# Failures which say nothing about the request itself, so that it may well succeed when made again. Timeouts and
+# TLS errors are socket errors too.
+TRANSIENT_ERRORS = (Unavailable, socket.error, httplib.BadStatusLine, httplib.IncompleteRead, httplib2.ServerNotFoundError)
 
 
 class GitHubRemoteObject(RemoteObject):
+    # The `GitHub` client requests are made through. Each client has subclasses of its own with this set; see
+    # `GitHub.__init__`.
+    _github = None
+
+    @classmethod
+    def raise_for_response(cls, url, response, content):
+        # Requests made too quickly, or beyond the rate limit, are answered with a 403 or 429. Secondary rate limits
+        # come with a Retry-After header or at least say so in the message.
+        if response.status in (403, 429) and ('retry-after' in response or response.get('x-ratelimit-remaining') == '0' or 'rate limit' in (content or '').lower()):
+            retry_after = None
+            if 'retry-after' in response:
+                retry_after = int(response['retry-after'])
+            elif response.get('x-ratelimit-remaining') == '0' and 'x-ratelimit-reset' in response:
+                retry_after = max(0, int(response['x-ratelimit-reset']) - int(time.time()))
+            raise RateLimited('%d %s requesting %s %s' % (response.status, response.reason, cls.__name__, url), retry_after)
+
+        if response.status >= 500:
+            raise Unavailable('%d %s requesting %s %s' % (response.status, response.reason, cls.__name__, url))
+        if response.status == 410:
+            raise Gone('%d %s requesting %s %s' % (response.status, response.reason, cls.__name__, url))
+
+        super(GitHubRemoteObject, cls).raise_for_response(url, response, content)
+
+    @classmethod
+    def get(cls, url, http=None, **kwargs):
+        # Default to the shared user agent so that requests reuse its connections and response cache.
+        return super(GitHubRemoteObject, cls).get(url, http=http or cls._github.http, **kwargs)
+
+    def post(self, obj, http=None):
+        return super(GitHubRemoteObject, self).post(obj, http=http or self._github.http)
+
     def get_request(self, headers=None, **kwargs):
         request = super(GitHubRemoteObject, self).get_request(headers=headers, **kwargs)
 
         # Add authentication header.
-        request['headers']['Authorization'] = 'token ' + SharedGitHub.api_token
+        request['headers']['Authorization'] = 'token ' + self._github.api_token
 
         return request
 
@@ -74,7 +349,7 @@ class GitHubRemoteObject(RemoteObject):
 
         request = self.get_request(url=location, method='PATCH', body=body, headers=headers)
         if http is None:
-            http = httplib2.Http()
+            http = self._github.http
         response, content = http.request(**request)
 
         # print body, response, content
@@ -90,11 +365,28 @@ class GitHubRemoteObject(RemoteObject):
         return int(r) if not r is None else None
 
 
+class Entries(fields.List):
+    """The entries of a list, which are made with the classes not bound to any client, but make their requests
+    through the client of the list.
+
+    """
+
+    def __get__(self, obj, cls):
+        entries = super(Entries, self).__get__(obj, cls)
+        if obj is not None and obj._github is not None and obj.__dict__.get('_bound_entries') is not entries:
+            for entry in entries:
+                if entry._github is not obj._github:
+                    entry._github = obj._github
+            obj.__dict__['_bound_entries'] = entries
+        return entries
+
+
 class GitHubRemoteListObject(ListObject, GitHubRemoteObject):
     def update_from_response(self, url, response, content):
         r = super(GitHubRemoteObject, self).update_from_response(url, response, content)
 
         self._rate_limit = (response.get('x-ratelimit-remaining'), response.get('x-ratelimit-limit'))
+        self._poll_interval = response.get('x-poll-interval')
 
         # GitHub sends paging information as a response header like this:
         # <https://api.github.com/repos/cappuccino/cappuccino/issues?page=2&state=open>; rel="next", <https://api.github.com/repos/cappuccino/cappuccino/issues?page=11&state=open>; rel="last"
@@ -116,6 +408,40 @@ class GitHubRemoteListObject(ListObject, GitHubRemoteObject):
 
         return r
 
+    def get_page_count(self):
+        """Return the number of pages in this listing according to the rel="last" link, or None if it's unknown."""
+
+        if not self._last_page_url:
+            return None
+
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self._last_page_url)[4]))
+        try:
+            return int(query['page'])
+        except (KeyError, ValueError):
+            return None
+
+    def get_poll_interval(self):
+        """Return the number of seconds GitHub asks clients to wait before polling this listing again, or None."""
+
+        try:
+            return int(self._poll_interval)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    @classmethod
+    def page_url(cls, url, per_page=30, page=None):
+        url_parts = list(urlparse.urlparse(url))
+        query = dict(urlparse.parse_qsl(url_parts[4]))
+
+        if per_page != 30:
+            query['per_page'] = per_page
+        if page is not None:
+            query['page'] = page
+
+        # Sort the parameters so that the same request always has the same URL, for the response cache's sake.
+        url_parts[4] = urllib.urlencode(sorted(query.items()))
+        return urlparse.urlunparse(url_parts)
+
     @classmethod
     def get(cls, url, **kwargs):
         per_page = 30
@@ -128,35 +454,91 @@ class GitHubRemoteListObject(ListObject, GitHubRemoteObject):
             all_pages = kwargs['all_pages']
             del kwargs['all_pages']
 
-        r = None
-        while url:
-            url_parts = list(urlparse.urlparse(url))
-            query = dict(urlparse.parse_qsl(url_parts[4]))
+        r = super(ListObject, cls).get(cls.page_url(url, per_page), **kwargs)
+
+        if not all_pages:
+            return r
 
-            if per_page != 30:
-                query['per_page'] = per_page
+        # Don't lazy evaluate, we need the paging information right away.
+        r.deliver()
 
-            url_parts[4] = urllib.urlencode(query)
-            url = urlparse.urlunparse(url_parts)
+        page_count = r.get_page_count()
+        if page_count:
+            # All the remaining page URLs are known so fetch them concurrently, as many at a time as there are
+            # connections to fetch them with.
+            urls = [cls.page_url(r._last_page_url, per_page, page=page) for page in range(2, page_count + 1)]
 
-            new_r = super(ListObject, cls).get(url, **kwargs)
+            pages = []
+            # With a single page, rel="last" points at the page already retrieved.
+            if urls:
+                workers = ThreadPool(min(len(urls), cls._github.http.pool.size))
+                try:
+                    pages = workers.map(lambda url: cls.get_page(url, **kwargs), urls)
+                finally:
+                    workers.close()
 
-            if not all_pages:
-                return new_r
+            for page in pages:
+                r.entries.extend(page.entries)
 
-            # Don't lazy evaluate, we need the next page URL right away.
+            # The pages have all been followed.
+            r._next_page_url = None
+            return r
+
+        # Without a rel="last" link the pages have to be followed one at a time.
+        url = r._next_page_url
+        while url:
+            new_r = super(ListObject, cls).get(cls.page_url(url, per_page), **kwargs)
             new_r.deliver()
 
-            if not r:
-                r = new_r
-            else:
-                # Append these results to the existing ones when fetching all pages.
-                r.entries.extend(new_r.entries)
+            # Append these results to the existing ones when fetching all pages.
+            r.entries.extend(new_r.entries)
 
             url = new_r._next_page_url
 
+        r._next_page_url = None
         return r
 
+    @classmethod
+    def get_page(cls, url, **kwargs):
+        """Retrieve the single page of a listing at `url` right away."""
+
+        page = super(ListObject, cls).get(url, **kwargs)
+        page.deliver()
+        return page
+
+    def iter_all(self):
+        """Yield the entries of this listing and of every page after it, as each page arrives.
+
+        The next page is retrieved in the background while the entries of the current one are being handled, so the
+        first entries can be handled before the whole listing has been retrieved, and no more than a couple of pages
+        are held at a time. A listing retrieved with `all_pages` has no pages left to follow.
+
+        """
+
+        if not self._delivered:
+            self.deliver()
+
+        page = self
+        workers = None
+        try:
+            while True:
+                next_page = None
+                next_page_url = getattr(page, '_next_page_url', None)
+                if next_page_url:
+                    if workers is None:
+                        workers = ThreadPool(1)
+                    next_page = workers.apply_async(type(self).get_page, (next_page_url,), {'http': self._http})
+
+                for entry in page.entries:
+                    yield entry
+
+                if next_page is None:
+                    return
+                page = next_page.get()
+        finally:
+            if workers is not None:
+                workers.close()
+
 
 class User(GitHubRemoteObject):
     """A GitHub user account.
@@ -213,7 +595,7 @@ class User(GitHubRemoteObject):
             url = '/users/%s' % quote_plus(kwargs['id'])
         else:
             url = '/user'
-        return cls.get(urljoin(SharedGitHub.endpoint, url), http=http)
+        return cls.get(urljoin(cls._github.endpoint, url), http=http)
 
     def __unicode__(self):
         return u"<User %d>" % self.id
@@ -241,7 +623,7 @@ class Label(GitHubRemoteObject):
 
 
 class Labels(GitHubRemoteListObject):
-    entries = fields.List(fields.Object(Label))
+    entries = Entries(fields.Object(Label))
 
     def __getitem__(self, key):
         return self.entries.__getitem__(key)
@@ -257,19 +639,6 @@ class Labels(GitHubRemoteListObject):
         url = '/repos/%s/%s/labels' % (user_name, repo_name)
         return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
 
-    @classmethod
-    def get_or_create_in_repository(cls, user_name, repo_name, label_name):
-        labels = cls.by_repository(user_name, repo_name, per_page=100, all_pages=True)
-        for label in labels:
-            if label.name == label_name:
-                return label
-
-        label = Label()
-        label.name = label_name
-        labels.post(label)
-
-        return label
-
 
 class Milestone(GitHubRemoteObject):
     """A GitHub milestone.
@@ -313,7 +682,7 @@ class Milestone(GitHubRemoteObject):
 
 
 class Milestones(GitHubRemoteListObject):
-    entries = fields.List(fields.Object(Milestone))
+    entries = Entries(fields.Object(Milestone))
 
     def __getitem__(self, key):
         return self.entries.__getitem__(key)
@@ -329,32 +698,6 @@ class Milestones(GitHubRemoteListObject):
         url = '/repos/%s/%s/milestones?state=%s' % (user_name, repo_name, state)
         return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
 
-    @classmethod
-    def by_repository_all(cls, user_name, repo_name, state='open', **kwargs):
-        """Get all milestones by repository (open and closed)."""
-
-        open_milestones = cls.by_repository(user_name, repo_name, state='open', **kwargs)
-        closed_milestones = cls.by_repository(user_name, repo_name, state='closed', **kwargs)
-
-        open_milestones.entries.extend(closed_milestones.entries)
-        return open_milestones
-
-    @classmethod
-    def get_or_create_in_repository(cls, user_name, repo_name, milestone_title):
-        if milestone_title is None:
-            return None
-
-        milestones = cls.by_repository_all(user_name, repo_name, per_page=100, all_pages=True)
-        for milestone in milestones:
-            if milestone.title == milestone_title:
-                return milestone
-
-        milestone = Milestone()
-        milestone.title = milestone_title
-        milestones.post(milestone)
-
-        return milestone
-
 
 class Comment(GitHubRemoteObject):
     """A GitHub issue comment.
@@ -389,14 +732,14 @@ class Comment(GitHubRemoteObject):
 
 
 class Comments(GitHubRemoteListObject):
-    entries = fields.List(fields.Object(Comment))
+    entries = Entries(fields.Object(Comment))
 
     def __getitem__(self, key):
         return self.entries.__getitem__(key)
 
     @classmethod
-    def by_issue(cls, issue, **kwargs):
-        """Get comments by issue.
+    def by_issue(cls, issue, since=None, **kwargs):
+        """Get comments by issue, optionally only those created or updated at or after `since`.
 
         `GET /repos/:user/:repo/issues/:number/comments`
 
@@ -404,13 +747,24 @@ class Comments(GitHubRemoteListObject):
 
         # Don't request the list of comments if we know there should be 0.
         if issue.comments == 0:
-            comments = cls(entries=[])
-            comments._location = '%s/comments' % issue.url
-            return comments
+            return cls.for_issue(issue)
 
         url = '%s/comments' % issue.url
+        if since:
+            url += '?' + urllib.urlencode({'since': since})
         return cls.get(url, **kwargs)
 
+    @classmethod
+    def for_issue(cls, issue):
+        """Get an empty list of comments of the issue, which new comments can be posted to without retrieving
+        the existing ones.
+
+        """
+
+        comments = cls(entries=[])
+        comments._location = '%s/comments' % issue.url
+        return comments
+
 
 class Event(GitHubRemoteObject):
     """A GitHub event.
@@ -461,7 +815,7 @@ class Event(GitHubRemoteObject):
 
 
 class Events(GitHubRemoteListObject):
-    entries = fields.List(fields.Object(Event))
+    entries = Entries(fields.Object(Event))
 
     def __getitem__(self, key):
         return self.entries.__getitem__(key)
@@ -477,6 +831,35 @@ class Events(GitHubRemoteListObject):
         url = '/repos/%s/%s/events' % (repo_user, repo_name)
         return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
 
+    @classmethod
+    def by_repository_since(cls, repo_user, repo_name, event_id, **kwargs):
+        """Get the events of a repository newer than the event with the given id, newest first.
+
+        Pages are fetched until that event is reached. GitHub only keeps a few hundred recent events, so if the
+        feed runs out first some events may have been missed and None is returned. With no `event_id` just the
+        first page is returned.
+
+        """
+
+        r = cls.by_repository(repo_user, repo_name, **kwargs)
+        r.deliver()
+        if event_id is None or not r.entries:
+            return r
+
+        entries = []
+        page = r
+        while True:
+            for event in page.entries:
+                if int(event.id) <= event_id:
+                    r.entries = entries
+                    return r
+                entries.append(event)
+
+            if not page._next_page_url:
+                return None
+            page = super(ListObject, cls).get(page._next_page_url)
+            page.deliver()
+
 
 class Issue(GitHubRemoteObject):
     """A GitHub issue.
@@ -562,9 +945,20 @@ class Issue(GitHubRemoteObject):
     def __unicode__(self):
         return u"<Issue %d>" % self.number
 
+    @classmethod
+    def by_number(cls, user_name, repo_name, number, **kwargs):
+        """Get an issue by its number.
+
+        `GET /repos/:user/:repo/issues/:number`
+
+        """
+
+        url = '/repos/%s/%s/issues/%d' % (user_name, repo_name, number)
+        return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
+
 
 class Issues(GitHubRemoteListObject):
-    entries = fields.List(fields.Object(Issue))
+    entries = Entries(fields.Object(Issue))
 
     @classmethod
     def by_repository(cls, user_name, repo_name, state='open', **kwargs):
@@ -578,14 +972,113 @@ class Issues(GitHubRemoteListObject):
         return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
 
     @classmethod
-    def by_repository_all(cls, user_name, repo_name, **kwargs):
-        """Get all issues by repository (open and closed)."""
+    def by_repository_since(cls, user_name, repo_name, since, **kwargs):
+        """Get all issues by repository (open and closed) updated at or after `since`, most recently
+        updated first.
+
+        `GET /repos/:user/:repo/issues?state=all&sort=updated&since=:since`
+
+        """
+
+        url = '/repos/%s/%s/issues?state=all&sort=updated&direction=desc&since=%s' % (user_name, repo_name, quote_plus(since))
+        return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
+
+
+LabelSummary = namedtuple('LabelSummary', 'name')
+MilestoneSummary = namedtuple('MilestoneSummary', 'number title')
+UserSummary = namedtuple('UserSummary', 'id login')
+
+
+class IssueSummary(object):
+    """The parts of an issue needed to tell whether it has changed, as found in an issue listing.
+
+    Whole `Issue` objects keep everything GitHub sent, like the issue body and full user records, which adds up for a
+    repository with thousands of issues. A summary decodes the fields in `__slots__` right away and drops the rest.
+    Labels, the milestone and the assignee are reduced to their names, numbers, titles, ids and logins. Any other
+    `Issue` field is retrieved from GitHub when first asked for.
+
+    There is no `__dict__`, so the attributes CappBot keeps on an issue while looking at it have slots of their own,
+    as they do on a full `Issue`.
 
-        open_issues = cls.by_repository(user_name, repo_name, state='open', **kwargs)
-        closed_issues = cls.by_repository(user_name, repo_name, state='closed', **kwargs)
+    """
+
+    # The `GitHub` client to retrieve and patch the issue through, set on the subclass each client has of its own.
+    _github = None
+
+    __slots__ = ('id', 'number', 'state', 'title', 'url', 'comments', 'updated_at', 'labels', 'milestone', 'assignee', '_issue',
+                 '_comments', '_comments_since', '_comments_unchanged', '_comments_seen_at', '_should_ignore', '_force_paper_trail')
+
+    def __init__(self):
+        for name in IssueSummary.__slots__:
+            setattr(self, name, None)
+
+    def __unicode__(self):
+        return u"<Issue %d>" % self.number
+
+    def __str__(self):
+        return "<Issue %d>" % self.number
+
+    def __getattr__(self, name):
+        # Only called for attributes which aren't in the summary.
+        if name in Issue.fields:
+            return getattr(self.get_issue(), name)
+        raise AttributeError(name)
 
-        open_issues.entries.extend(closed_issues.entries)
-        return open_issues
+    @classmethod
+    def from_dict(cls, data):
+        self = cls()
+        self.id = data['id']
+        self.number = data['number']
+        self.state = data['state']
+        self.title = data['title']
+        self.url = data['url']
+        self.comments = data['comments']
+        self.updated_at = data['updated_at']
+        self.labels = tuple(LabelSummary(label['name']) for label in data.get('labels') or ())
+        milestone = data.get('milestone')
+        self.milestone = MilestoneSummary(milestone['number'], milestone['title']) if milestone else None
+        assignee = data.get('assignee')
+        self.assignee = UserSummary(assignee['id'], assignee['login']) if assignee else None
+        return self
+
+    def update_from_issue(self, issue):
+        """Summarise the full `Issue` `issue` again, such as after changing it."""
+
+        self.id = issue.id
+        self.number = issue.number
+        self.state = issue.state
+        self.title = issue.title
+        self.url = issue.url
+        self.comments = issue.comments
+        self.updated_at = issue.updated_at
+        self.labels = tuple(LabelSummary(label.name) for label in issue.labels or ())
+        self.milestone = MilestoneSummary(issue.milestone.number, issue.milestone.title) if issue.milestone else None
+        self.assignee = UserSummary(issue.assignee.id, issue.assignee.login) if issue.assignee else None
+
+    def get_issue(self):
+        """Return the full `Issue`, retrieving it when it's first needed."""
+
+        if self._issue is None:
+            self._issue = self._github.Issue.get(self.url)
+        return self._issue
+
+    def patch(self, **kwargs):
+        """Change the issue like `Issue.patch` and summarise the result."""
+
+        if self._issue is None:
+            # The response to the patch has the full issue, so there's no need to retrieve it first.
+            self._issue = self._github.Issue.from_dict({'url': self.url})
+        self._issue.patch(**kwargs)
+        self.update_from_issue(self._issue)
+
+
+class IssueSummaries(Issues):
+    """Issue listings of `IssueSummary` entries rather than `Issue` ones."""
+
+    def update_from_dict(self, data):
+        super(IssueSummaries, self).update_from_dict([])
+        summary_class = self._github.IssueSummary if self._github else IssueSummary
+        self.entries = [summary_class.from_dict(entry) for entry in data]
 
 
 class Collaborator(GitHubRemoteObject):
@@ -617,7 +1110,7 @@ class Collaborator(GitHubRemoteObject):
 
 
 class Collaborators(GitHubRemoteListObject):
-    entries = fields.List(fields.Object(Collaborator))
+    entries = Entries(fields.Object(Collaborator))
 
     @classmethod
     def by_repository(cls, user_name, repo_name, **kwargs):
@@ -631,6 +1124,99 @@ class Collaborators(GitHubRemoteListObject):
         return cls.get(urljoin(GitHub.endpoint, url), **kwargs)
 
 
+class GraphQLError(httplib.HTTPException):
+    """GitHub answered a GraphQL query with errors."""
+
+
+COMMENT_FIELDS = """
+fragment comment on IssueComment {
+  databaseId
+  body
+  createdAt
+  updatedAt
+  author { login ... on User { databaseId } }
+}
+"""
+
+
+class GraphQL(object):
+    """The parts of GitHub's GraphQL API which do in a single request what would take many with the REST API.
+
+    `POST /graphql`
+
+    """
+
+    def __init__(self, github):
+        self.github = github
+
+    def query(self, query, variables=None):
+        """Return the data GitHub answers the GraphQL `query` with, given `variables`. Parts of the answer which
+        weren't found, like an issue deleted since, are None; any other error raises a `GraphQLError`.
+
+        """
+
+        url = urljoin(GitHub.endpoint, 'graphql')
+        headers = {'authorization': 'bearer ' + self.github.api_token, 'content-type': 'application/json', 'accept': 'application/json'}
+        response, content = self.github.http.request(url, method='POST', body=json.dumps({'query': query, 'variables': variables or {}}), headers=headers)
+        GitHubRemoteObject.raise_for_response(url, response, content)
+
+        result = json.loads(content)
+        # A field within the answer which wasn't found doesn't spoil the rest. If the top level isn't there, there
+        # is no answer.
+        errors = [error for error in result.get('errors') or () if error.get('type') != 'NOT_FOUND' or len(error.get('path') or ()) < 2]
+        if errors:
+            raise GraphQLError('; '.join(error.get('message', '') for error in errors))
+        return result['data']
+
+    def recent_comments(self, user_name, repo_name, numbers, count=100):
+        """Get the `count` most recent comments of each of the issues and pull requests with the given numbers, as
+        a dict of `Comments` by number. The `total_count` of each is the number of comments in all; if it's more
+        than `count`, older comments are missing. Issues which don't exist are left out.
+
+        """
+
+        selections = ''.join("""
+    n%d: issueOrPullRequest(number: %d) {
+      ... on Issue { comments(last: $count) { totalCount nodes { ...comment } } }
+      ... on PullRequest { comments(last: $count) { totalCount nodes { ...comment } } }
+    }""" % (number, number) for number in numbers)
+        query = """query($owner: String!, $name: String!, $count: Int!) {
+  repository(owner: $owner, name: $name) {%s
+  }
+}
+%s""" % (selections, COMMENT_FIELDS)
+
+        repository = self.query(query, {'owner': user_name, 'name': repo_name, 'count': count})['repository']
+
+        r = {}
+        for number in numbers:
+            found = repository.get('n%d' % number)
+            if not found:
+                continue
+
+            issue_url = urljoin(GitHub.endpoint, '/repos/%s/%s/issues/%d' % (user_name, repo_name, number))
+            comments = self.github.Comments(entries=[self.github.Comment.from_dict(self.rest_comment(node, user_name, repo_name)) for node in found['comments']['nodes']])
+            comments._location = '%s/comments' % issue_url
+            comments.total_count = found['comments']['totalCount']
+            r[number] = comments
+        return r
+
+    @classmethod
+    def rest_comment(cls, node, user_name, repo_name):
+        """Return the comment `node` of a GraphQL answer as the REST API would have described it."""
+
+        # Like the REST API, attribute comments by deleted users to the ghost user.
+        author = node.get('author') or {'login': 'ghost'}
+        return {
+            'id': node['databaseId'],
+            'url': urljoin(GitHub.endpoint, '/repos/%s/%s/issues/comments/%d' % (user_name, repo_name, node['databaseId'])),
+            'body': node['body'],
+            'user': {'login': author['login'], 'id': author.get('databaseId')},
+            'created_at': node['createdAt'],
+            'updated_at': node['updatedAt'],
+        }
+
+
 class GitHub(object):
     """An interface to the GitHub API.
 
@@ -638,29 +1224,21 @@ class GitHub(object):
 
     endpoint = 'https://api.github.com/'
 
-    def __init__(self, api_token):
-        # TODO Don't use a global.
-        global SharedGitHub
-
+    def __init__(self, api_token, response_cache=None, pool_size=4, timeout=30, rate_limit=None):
         self.api_token = api_token
-        SharedGitHub = self
-
-        self.User = User
-        self.Event = Event
-        self.Events = Events
-        self.Issue = Issue
-        self.Issues = Issues
-        self.Label = Label
-        self.Labels = Labels
-        self.Milestone = Milestone
-        self.Milestones = Milestones
-        self.Comment = Comment
-        self.Comments = Comments
-        self.Collaborator = Collaborator
-        self.Collaborators = Collaborators
+        self.response_cache = response_cache
+        self.rate_limit = rate_limit
+        self.http = GitHubHttp(response_cache=response_cache, pool_size=pool_size, timeout=timeout, rate_limit=rate_limit)
+
+        # Every client has its own subclass of each resource, which makes its requests through this client. Several
+        # clients, with different tokens, can be used side by side.
+        for cls in (User, Event, Events, Issue, Issues, IssueSummaries, Label, Labels, Milestone, Milestones, Comment, Comments, Collaborator, Collaborators):
+            setattr(self, cls.__name__, type(cls.__name__, (cls,), {'_github': self}))
+        self.IssueSummary = type('IssueSummary', (IssueSummary,), {'__slots__': (), '_github': self})
+        self.graphql = GraphQL(self)
 
     def current_user(self, **kwargs):
-        return User.get_user(**kwargs)
+        return self.User.get_user(**kwargs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,442 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2011-12, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from mock import Mock, patch
+import httplib2
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+
+from async_github_test import FakeGitHub
+from http_cache import ResponseCache
+import mini_github3
+
+
+def fake_response(status, content='', **headers):
+    headers = dict((k.replace('_', '-'), v) for k, v in headers.items())
+    headers['status'] = str(status)
+    return httplib2.Response(headers), content
+
+
+class FakePagedApi(object):
+    """Serve `entries` in pages with Link headers like the GitHub API does, in place of a `ConnectionPool`."""
+
+    size = 4
+
+    def __init__(self, entries, include_last=True, last_on_last_page=False):
+        self.entries = entries
+        self.include_last = include_last
+        # Some listings link to the last page from the last page itself.
+        self.last_on_last_page = last_on_last_page
+        self.requested_urls = []
+        self.lock = threading.Lock()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        with self.lock:
+            self.requested_urls.append(uri)
+
+        url_parts = list(urlparse.urlparse(uri))
+        query = dict(urlparse.parse_qsl(url_parts[4]))
+        page, per_page = int(query.get('page', 1)), int(query.get('per_page', 30))
+        last_page = max(1, (len(self.entries) + per_page - 1) // per_page)
+
+        links = []
+        if page < last_page:
+            links.append('<%s?page=%d&per_page=%d>; rel="next"' % (uri.split('?')[0], page + 1, per_page))
+        if self.include_last and (page < last_page or self.last_on_last_page):
+            links.append('<%s?page=%d&per_page=%d>; rel="last"' % (uri.split('?')[0], last_page, per_page))
+
+        headers = {'content_type': 'application/json'}
+        if links:
+            headers['link'] = ', '.join(links)
+        return fake_response(200, json.dumps(self.entries[(page - 1) * per_page:page * per_page]), **headers)
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.github = mini_github3.GitHub('token')
+        self.url = 'https://api.github.com/repos/alice_tester/blox/issues?state=open'
+
+    def test_concurrent_pages(self):
+        api = self.github.http.pool = FakePagedApi([{'number': n} for n in range(1, 24)])
+
+        issues = self.github.Issues.get(self.url, per_page=5, all_pages=True)
+
+        self.assertEquals([issue.number for issue in issues], range(1, 24))
+        self.assertEquals(len(api.requested_urls), 5)
+        self.assertEquals(len(set(api.requested_urls)), 5)
+
+    def test_pages_without_last_link(self):
+        api = self.github.http.pool = FakePagedApi([{'number': n} for n in range(1, 24)], include_last=False)
+
+        issues = self.github.Issues.get(self.url, per_page=5, all_pages=True)
+
+        self.assertEquals([issue.number for issue in issues], range(1, 24))
+        self.assertEquals(len(api.requested_urls), 5)
+
+    def test_single_page(self):
+        api = self.github.http.pool = FakePagedApi([{'number': n} for n in range(1, 4)])
+
+        issues = self.github.Issues.get(self.url, per_page=5, all_pages=True)
+
+        self.assertEquals([issue.number for issue in issues], [1, 2, 3])
+        self.assertEquals(api.requested_urls, ['https://api.github.com/repos/alice_tester/blox/issues?per_page=5&state=open'])
+
+    def test_single_page_with_last_link(self):
+        api = self.github.http.pool = FakePagedApi([{'number': n} for n in range(1, 4)], last_on_last_page=True)
+
+        issues = self.github.Issues.get(self.url, per_page=5, all_pages=True)
+
+        self.assertEquals([issue.number for issue in issues], [1, 2, 3])
+        self.assertEquals(api.requested_urls, ['https://api.github.com/repos/alice_tester/blox/issues?per_page=5&state=open'])
+
+
+class TestIterAll(unittest.TestCase):
+    def setUp(self):
+        self.github = mini_github3.GitHub('token')
+        self.url = 'https://api.github.com/repos/alice_tester/blox/issues?state=all'
+
+    def test_iter_all(self):
+        api = self.github.http.pool = FakePagedApi([{'number': n} for n in range(1, 24)])
+
+        entries = self.github.Issues.get(self.url, per_page=5).iter_all()
+        self.assertEquals(api.requested_urls, [])
+
+        first = next(entries)
+        self.assertEquals(first.number, 1)
+        # At most the next page is being retrieved while the first is handled.
+        self.assertTrue(len(api.requested_urls) <= 2)
+
+        self.assertEquals([entry.number for entry in entries], range(2, 24))
+        self.assertEquals(len(api.requested_urls), 5)
+
+    def test_iter_all_pages(self):
+        api = self.github.http.pool = FakePagedApi([{'number': n} for n in range(1, 24)])
+
+        issues = self.github.Issues.get(self.url, per_page=5, all_pages=True)
+
+        self.assertEquals([entry.number for entry in issues.iter_all()], range(1, 24))
+        self.assertEquals(len(api.requested_urls), 5)
+
+
+class TestEvents(unittest.TestCase):
+    def setUp(self):
+        self.github = mini_github3.GitHub('token')
+        # Newest first, like GitHub lists them.
+        self.api = self.github.http.pool = FakePagedApi([{'id': str(n), 'type': 'IssuesEvent'} for n in range(250, 0, -1)])
+
+    def test_events_since(self):
+        events = self.github.Events.by_repository_since('alice_tester', 'blox', 150, per_page=30)
+
+        self.assertEquals([int(event.id) for event in events], range(250, 150, -1))
+        # Pages stop being fetched once the event seen before shows up.
+        self.assertEquals(len(self.api.requested_urls), 4)
+
+    def test_nothing_new(self):
+        events = self.github.Events.by_repository_since('alice_tester', 'blox', 250, per_page=30)
+
+        self.assertEquals(len(events), 0)
+        self.assertEquals(len(self.api.requested_urls), 1)
+
+    def test_events_missed(self):
+        self.api.entries = self.api.entries[:100]
+
+        self.assertEquals(self.github.Events.by_repository_since('alice_tester', 'blox', 10, per_page=30), None)
+
+    def test_poll_interval(self):
+        self.api.request = Mock(return_value=fake_response(200, '[]', content_type='application/json', x_poll_interval='60'))
+
+        events = self.github.Events.by_repository_since('alice_tester', 'blox', None)
+
+        self.assertEquals(events.get_poll_interval(), 60)
+
+
+class TestIssueSummary(unittest.TestCase):
+    def setUp(self):
+        self.github = mini_github3.GitHub('token')
+        with open(os.path.join(os.path.dirname(__file__), 'test_fixtures', 'issues.json'), 'rb') as inf:
+            self.data = json.load(inf)
+
+    def test_summary(self):
+        summaries = self.github.IssueSummaries.from_dict(self.data)
+        issues = self.github.Issues.from_dict(self.data)
+
+        self.assertEquals(len(summaries), len(issues))
+        for summary, issue in zip(summaries, issues):
+            for name in ('id', 'number', 'state', 'title', 'url', 'comments', 'updated_at'):
+                self.assertEquals(getattr(summary, name), getattr(issue, name))
+            self.assertEquals([label.name for label in summary.labels], [label.name for label in issue.labels])
+            self.assertEquals(summary.milestone.number if summary.milestone else None, issue.milestone.number if issue.milestone else None)
+            self.assertEquals(summary.assignee.login if summary.assignee else None, issue.assignee.login if issue.assignee else None)
+            self.assertEquals(unicode(summary), unicode(issue))
+
+        # Nothing but the summary is kept.
+        self.assertEquals(summaries.api_data, {'entries': []})
+        self.assertFalse(hasattr(summaries[0], '__dict__'))
+
+    def test_other_fields_retrieved_on_access(self):
+        summary = self.github.IssueSummary.from_dict(self.data[0])
+        self.github.http.pool = Mock()
+        self.github.http.pool.request.return_value = fake_response(200, json.dumps(self.data[0]), content_type='application/json')
+
+        self.assertEquals(summary.body, self.data[0]['body'])
+        self.assertEquals(summary.user.login, self.data[0]['user']['login'])
+        self.assertEquals(self.github.http.pool.request.call_count, 1)
+        self.assertEquals(self.github.http.pool.request.call_args[0][0], self.data[0]['url'])
+        self.assertRaises(AttributeError, getattr, summary, 'no_such_field')
+
+    def test_patch(self):
+        summary = self.github.IssueSummary.from_dict(self.data[0])
+        patched = dict(self.data[0], title='New title', labels=[{'name': '#fixed', 'url': '', 'color': 'ffffff'}], state='closed')
+        self.github.http.pool = Mock()
+        self.github.http.pool.request.return_value = fake_response(200, json.dumps(patched), content_type='application/json')
+
+        summary.patch(title='New title', labels=['#fixed'], state='closed')
+
+        self.assertEquals(self.github.http.pool.request.call_count, 1)
+        self.assertEquals(self.github.http.pool.request.call_args[1]['method'], 'PATCH')
+        self.assertEquals((summary.title, summary.state, [label.name for label in summary.labels]), ('New title', 'closed', ['#fixed']))
+
+
+class TestClients(unittest.TestCase):
+    def test_clients_side_by_side(self):
+        alice, bob = mini_github3.GitHub('alice-token'), mini_github3.GitHub('bob-token')
+        for github in (alice, bob):
+            github.http.pool = Mock()
+            github.http.pool.request.return_value = fake_response(200, '[{"name": "#new"}]', content_type='application/json')
+
+        labels = alice.Labels.by_repository('alice_tester', 'blox')
+        self.assertEquals(labels[0].name, '#new')
+        bob.Labels.by_repository('alice_tester', 'blox').deliver()
+
+        self.assertEquals(alice.http.pool.request.call_args[1]['headers']['Authorization'], 'token alice-token')
+        self.assertEquals(bob.http.pool.request.call_args[1]['headers']['Authorization'], 'token bob-token')
+        # Entries make their requests through the client of their list.
+        self.assertTrue(labels[0]._github is alice)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_connection_reuse(self):
+        pool = mini_github3.ConnectionPool(size=2)
+
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertNotEquals(first, second)
+        with pool.connection() as third:
+            # The most recently returned connection is reused.
+            self.assertEquals(third, first)
+
+        self.assertEquals(pool._created, 2)
+
+    def test_timeout(self):
+        pool = mini_github3.ConnectionPool(size=1, timeout=5)
+
+        with pool.connection() as http:
+            self.assertEquals(http.timeout, 5)
+
+
+class TestRateLimitBudget(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000.0
+        self.sleeps = []
+        self.budget = mini_github3.RateLimitBudget(cycle=150, clock=lambda: self.now, sleep=self.sleep)
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+    def set_rate_limit(self, remaining, reset_in):
+        self.budget.update(fake_response(200, x_ratelimit_remaining=str(remaining), x_ratelimit_limit='5000', x_ratelimit_reset=str(int(self.now + reset_in)))[0])
+
+    def test_unknown(self):
+        self.budget.acquire()
+        self.assertEquals(self.sleeps, [])
+
+    def test_reset_soon(self):
+        # Few requests remain, but the window resets before they could run out.
+        self.set_rate_limit(1000, 30)
+        for n in range(100):
+            self.budget.acquire()
+        self.assertEquals(self.sleeps, [])
+
+    def test_spread_until_reset(self):
+        # 100 requests over an hour is one every 36 seconds, and the share of a 150 second cycle is 4 of them.
+        self.set_rate_limit(100, 3600)
+        for n in range(4):
+            self.budget.acquire()
+        self.assertEquals(self.sleeps, [])
+
+        self.budget.acquire()
+        self.assertEquals(len(self.sleeps), 1)
+        self.assertTrue(0 < self.sleeps[0] <= 36)
+
+        self.budget.acquire()
+        self.assertTrue(36 <= self.sleeps[1] < 40)
+
+    def test_other_resources_ignored(self):
+        self.set_rate_limit(100, 3600)
+        # GraphQL requests are limited separately.
+        self.budget.update(fake_response(200, x_ratelimit_remaining='0', x_ratelimit_resource='graphql', x_ratelimit_reset=str(int(self.now + 60)))[0])
+        self.assertEquals(self.budget.remaining, 100)
+
+    def test_exhausted(self):
+        self.set_rate_limit(0, 20)
+        self.budget.acquire()
+        self.assertEquals(self.sleeps, [20])
+
+        # Once the window has reset the next response tells how it looks.
+        self.budget.acquire()
+        self.assertEquals(self.sleeps, [20])
+
+    def test_requests_within_budget(self):
+        http = mini_github3.GitHubHttp(rate_limit=self.budget)
+        http.pool = Mock(spec=mini_github3.ConnectionPool)
+        http.pool.request.return_value = fake_response(200, '{}', x_ratelimit_remaining='4000', x_ratelimit_reset=str(int(self.now + 3600)))
+
+        http.request('https://api.github.com/repos/alice_tester/blox/issues/1')
+
+        self.assertEquals(self.budget.remaining, 4000)
+
+    def test_graphql_not_budgeted(self):
+        self.set_rate_limit(1, 3600)
+        http = mini_github3.GitHubHttp(rate_limit=self.budget)
+        http.pool = Mock(spec=mini_github3.ConnectionPool)
+        http.pool.request.return_value = fake_response(200, '{}', x_ratelimit_remaining='4000', x_ratelimit_resource='graphql', x_ratelimit_reset=str(int(self.now + 3600)))
+
+        for n in range(3):
+            http.request('https://api.github.com/graphql', method='POST', body='{}')
+
+        # GraphQL queries take nothing from the budget of REST requests.
+        self.assertEquals(self.sleeps, [])
+        self.assertEquals(self.budget.remaining, 1)
+
+
+class TestGitHubHttp(unittest.TestCase):
+    def setUp(self):
+        self.cache_directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.cache_directory)
+        self.http = mini_github3.GitHubHttp(response_cache=self.cache)
+        self.http.pool = Mock(spec=mini_github3.ConnectionPool)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_directory)
+
+    def test_conditional_request(self):
+        url = 'https://api.github.com/repos/alice_tester/blox/labels'
+        self.http.pool.request.side_effect = [
+            fake_response(200, '[{"name": "#new"}]', etag='"abc"', x_ratelimit_remaining='4999'),
+            fake_response(304, etag='"abc"', x_ratelimit_remaining='4998'),
+        ]
+
+        response, content = self.http.request(url)
+        self.assertEquals(content, '[{"name": "#new"}]')
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 1))
+
+        response, content = self.http.request(url)
+        self.assertEquals(self.http.pool.request.call_args[1]['headers']['if-none-match'], '"abc"')
+        self.assertEquals(response.status, 200)
+        self.assertEquals(response['x-ratelimit-remaining'], '4998')
+        self.assertEquals(content, '[{"name": "#new"}]')
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+        # The cache persists between processes.
+        response, content = ResponseCache(self.cache_directory).get(url)
+        self.assertEquals(content, '[{"name": "#new"}]')
+
+    def test_changed_response(self):
+        url = 'https://api.github.com/repos/alice_tester/blox/labels'
+        self.http.pool.request.side_effect = [
+            fake_response(200, '[]', etag='"abc"'),
+            fake_response(200, '[{"name": "#new"}]', etag='"def"'),
+        ]
+
+        self.http.request(url)
+        response, content = self.http.request(url)
+
+        self.assertEquals(content, '[{"name": "#new"}]')
+        self.assertEquals(self.cache.get(url)[0]['etag'], '"def"')
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_only_get_is_cached(self):
+        url = 'https://api.github.com/repos/alice_tester/blox/issues/1'
+        self.http.pool.request.return_value = fake_response(200, '{}', etag='"abc"')
+
+        self.http.request(url, method='PATCH', body='{}')
+
+        self.assertEquals(self.cache.get(url), None)
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 0))
+
+    def test_eviction(self):
+        cache = ResponseCache(self.cache_directory, max_size=1000)
+        for n in range(10):
+            cache.set('https://api.github.com/%d' % n, {'etag': '"%d"' % n}, 'x' * 200)
+
+        self.assertTrue(cache.evictions > 0)
+        self.assertEquals(cache.get('https://api.github.com/0'), None)
+        self.assertEquals(cache.get('https://api.github.com/9')[1], 'x' * 200)
+        self.assertTrue(sum(os.path.getsize(os.path.join(self.cache_directory, name)) for name in os.listdir(self.cache_directory)) <= 1000)
+
+
+class TestGraphQL(unittest.TestCase):
+    def setUp(self):
+        # A local stand-in for the API, serving canned answers.
+        self.fake = FakeGitHub()
+        self.endpoint = patch.object(mini_github3.GitHub, 'endpoint', self.fake.endpoint)
+        self.endpoint.start()
+        self.github = mini_github3.GitHub('sekrit')
+
+    def tearDown(self):
+        self.endpoint.stop()
+        self.fake.close()
+
+    def test_recent_comments(self):
+        with open(os.path.join(os.path.dirname(__file__), 'test_fixtures', 'graphql_comments.json'), 'rb') as inf:
+            self.fake.routes['/graphql'] = (200, {}, inf.read())
+
+        comments = self.github.graphql.recent_comments('alice_tester', 'blox', [1, 2, 3], count=5)
+
+        method, path, headers, body, port = self.fake.requests[0]
+        self.assertEquals(len(self.fake.requests), 1)
+        self.assertEquals(headers['authorization'], 'bearer sekrit')
+        query = json.loads(body)
+        self.assertEquals(query['variables'], {'owner': 'alice_tester', 'name': 'blox', 'count': 5})
+        self.assertTrue('n3: issueOrPullRequest(number: 3)' in query['query'])
+
+        # Issues which don't exist are left out.
+        self.assertEquals(sorted(comments), [1, 2])
+        self.assertEquals([(comment.id, comment.user.login, comment.updated_at) for comment in comments[1].entries], [(3300001, 'alice_tester', '2012-01-02T10:00:00Z'), (3300002, 'bob', '2012-01-04T10:00:00Z')])
+        self.assertEquals((comments[1].total_count, comments[2].total_count), (2, 7))
+        self.assertEquals(comments[2].entries[0].user.login, 'ghost')
+        self.assertEquals(comments[1].entries[0].url, self.fake.endpoint + 'repos/alice_tester/blox/issues/comments/3300001')
+        # New comments can be posted to them, through the same client.
+        self.assertEquals(comments[1]._location, self.fake.endpoint + 'repos/alice_tester/blox/issues/1/comments')
+        self.assertTrue(comments[1].entries[0]._github is self.github)
+
+    def test_errors(self):
+        self.fake.routes['/graphql'] = (200, {}, {'data': None, 'errors': [{'message': "Field 'nope' doesn't exist on type 'Query'"}]})
+        self.assertRaises(mini_github3.GraphQLError, self.github.graphql.query, '{ nope }')
+
+        # Unlike a missing issue, a missing repository leaves nothing to answer with.
+        self.fake.routes['/graphql'] = (200, {}, {'data': {'repository': None}, 'errors': [{'type': 'NOT_FOUND', 'path': ['repository'], 'message': "Could not resolve to a Repository with the name 'alice_tester/nope'."}]})
+        self.assertRaises(mini_github3.GraphQLError, self.github.graphql.recent_comments, 'alice_tester', 'nope', [1])
+
+        self.fake.routes['/graphql'] = (403, {'Retry-After': '30'}, {'message': 'You have exceeded a secondary rate limit.'})
+        self.assertRaises(mini_github3.RateLimited, self.github.graphql.query, '{ viewer { login } }')
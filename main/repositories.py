@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Looking after several repositories from a single process, or from several replicas with `sharding`."""
+
+from collections import deque
+from functools import partial
+import logbook
+import os
+import time
+
+
+# Settings of the GitHub client and of the process as a whole, which every repository shares, so they can't be
+# overridden for one of them.
+SHARED_SETTINGS = ('GITHUB_TOKEN', 'GITHUB_REPOSITORIES', 'RESPONSE_CACHE', 'RESPONSE_CACHE_MAX_SIZE', 'HTTP_POOL_SIZE', 'HTTP_TIMEOUT',
+                   'AVOID_RATE_LIMIT', 'UPDATE_DELAY', 'RUN_INTERVAL', 'LEASE_DATABASE', 'LEASE_DURATION', 'REPLICA_NAME')
+
+
+class RepositorySettings(object):
+    """The settings of one of several repositories: the `overrides` given for it where there are any, and the
+    shared `settings` otherwise.
+
+    Unless overridden, each repository has a database of its own, named after the shared DATABASE with the name of
+    the repository added, and permissions of its own, starting out as the shared PERMISSIONS.
+
+    """
+
+    def __init__(self, settings, repository, overrides=None):
+        self._settings = settings
+        self.GITHUB_REPOSITORY = repository
+
+        root, ext = os.path.splitext(settings.DATABASE)
+        self.DATABASE = '%s-%s%s' % (root, repository.replace('/', '-'), ext)
+        # Collaborators of the repository are added to its permissions.
+        self.PERMISSIONS = dict(settings.PERMISSIONS)
+
+        self.__dict__.update(overrides or {})
+
+    def __getattr__(self, name):
+        return getattr(self._settings, name)
+
+
+def get_repository_settings(settings):
+    """Return the settings of each repository listed in the GITHUB_REPOSITORIES of `settings`, which is either a
+    list of repository names or a dict of the settings overridden for each repository, by name.
+
+    Raise a ValueError if settings which every repository shares are overridden for one of them.
+
+    """
+
+    repositories = settings.GITHUB_REPOSITORIES
+    if not isinstance(repositories, dict):
+        repositories = dict((repository, {}) for repository in repositories)
+    for repository, overrides in sorted(repositories.items()):
+        shared = sorted(name for name in overrides or () if name in SHARED_SETTINGS)
+        if shared:
+            raise ValueError("%s can't be set for %s alone, since every repository shares them" % (', '.join(shared), repository))
+    return [RepositorySettings(settings, repository, overrides) for repository, overrides in sorted(repositories.items())]
+
+
+class RepositoryScheduler(object):
+    """Run the `CappBot`s of several repositories side by side.
+
+    The runs take turns an issue at a time, so that a repository with a lot going on doesn't hold up the others.
+    A run which fails is logged and doesn't stop the others.
+
+    With a `coordinator`, a `ShardCoordinator` sharing the repositories with other replicas, only the repositories
+    this replica holds the lease on are run. A run is abandoned if the lease is lost along the way, and changes to a
+    repository are only made while the lease on it has long enough left for them to be made before another replica
+    could take over.
+
+    """
+
+    def __init__(self, cappbots, coordinator=None):
+        self.cappbots = cappbots
+        self.coordinator = coordinator
+
+        if coordinator is not None:
+            for cappbot in cappbots:
+                cappbot.writes.permit = partial(coordinator.may_write, cappbot.settings.GITHUB_REPOSITORY)
+
+    def _holds(self, cappbot):
+        return self.coordinator is None or self.coordinator.holds(cappbot.settings.GITHUB_REPOSITORY)
+
+    def run(self):
+        if self.coordinator is not None:
+            self.coordinator.refresh()
+
+        runs = deque((cappbot, cappbot.run_steps()) for cappbot in self.cappbots if self._holds(cappbot))
+        while runs:
+            cappbot, steps = runs.popleft()
+            if not self._holds(cappbot):
+                logbook.warning(u"Lost the lease on %s. Leaving the rest of its run to the replica which took it over." % cappbot.settings.GITHUB_REPOSITORY)
+                steps.close()
+                continue
+            try:
+                next(steps)
+            except StopIteration:
+                continue
+            except Exception:
+                # Try again next time around, like a fresh process would.
+                logbook.exception(u"Run for %s failed." % cappbot.settings.GITHUB_REPOSITORY)
+                continue
+            runs.append((cappbot, steps))
+
+    def run_forever(self, interval, save_database):
+        """Start a run of every repository every `interval` seconds until interrupted, calling `save_database`
+        after each one.
+
+        """
+
+        while True:
+            started_at = time.time()
+            self.run()
+            save_database()
+
+            time.sleep(max(0, interval - (time.time() - started_at)))
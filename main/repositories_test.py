@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from mock import Mock
+import imp
+import logbook
+import unittest
+
+from repositories import RepositoryScheduler, RepositorySettings, get_repository_settings
+
+
+class FakeCappBot(object):
+    def __init__(self, repository, issues, log, fail_after=None):
+        self.settings = Mock(GITHUB_REPOSITORY=repository)
+        self.writes = Mock()
+        self.issues = issues
+        self.log = log
+        self.fail_after = fail_after
+
+    def run_steps(self):
+        for n in range(self.issues):
+            if n == self.fail_after:
+                raise ValueError("Run failed.")
+            self.log.append((self.settings.GITHUB_REPOSITORY, n))
+            yield
+
+
+class TestRepositories(unittest.TestCase):
+    def setUp(self):
+        self.log_handler = logbook.TestHandler()
+        self.log_handler.push_thread()
+
+        self.settings = imp.load_source('settings', 'default_settings.py')
+        self.settings.DATABASE = '/var/lib/cappbot/db.sqlite'
+        self.settings.PERMISSIONS = {'bob': ['labels']}
+
+    def tearDown(self):
+        self.log_handler.pop_thread()
+
+    def test_repository_settings(self):
+        blox = RepositorySettings(self.settings, 'alice_tester/blox', {'COMMENT_WORKERS': 5})
+        website = RepositorySettings(self.settings, 'alice_tester/website', {'DATABASE': 'website.json'})
+
+        self.assertEquals((blox.GITHUB_REPOSITORY, blox.COMMENT_WORKERS, blox.RUN_INTERVAL), ('alice_tester/blox', 5, self.settings.RUN_INTERVAL))
+        self.assertEquals(blox.DATABASE, '/var/lib/cappbot/db-alice_tester-blox.sqlite')
+        self.assertEquals(website.DATABASE, 'website.json')
+
+        # Collaborators of one repository don't get permissions in the other.
+        blox.PERMISSIONS['alice_tester'] = ['labels', 'assignee', 'milestone']
+        self.assertEquals(website.PERMISSIONS, {'bob': ['labels']})
+        self.assertEquals(self.settings.PERMISSIONS, {'bob': ['labels']})
+
+    def test_get_repository_settings(self):
+        self.settings.GITHUB_REPOSITORIES = ['alice_tester/website', 'alice_tester/blox']
+        self.assertEquals([each.GITHUB_REPOSITORY for each in get_repository_settings(self.settings)], ['alice_tester/blox', 'alice_tester/website'])
+
+        self.settings.GITHUB_REPOSITORIES = {'alice_tester/blox': {'COMMENT_WORKERS': 5}}
+        self.assertEquals([each.COMMENT_WORKERS for each in get_repository_settings(self.settings)], [5])
+
+        # The repositories share one GitHub client, so its settings can't differ between them.
+        self.settings.GITHUB_REPOSITORIES = {'alice_tester/blox': {'COMMENT_WORKERS': 5}, 'alice_tester/website': {'GITHUB_TOKEN': 'sekrit', 'HTTP_TIMEOUT': 5}}
+        self.assertRaises(ValueError, get_repository_settings, self.settings)
+
+    def test_runs_take_turns(self):
+        log = []
+        scheduler = RepositoryScheduler([FakeCappBot('busy', 4, log), FakeCappBot('quiet', 1, log), FakeCappBot('broken', 3, log, fail_after=1)])
+
+        scheduler.run()
+
+        self.assertEquals(log, [('busy', 0), ('quiet', 0), ('broken', 0), ('busy', 1), ('busy', 2), ('busy', 3)])
+        self.assertTrue(any('Run for broken failed.' in record for record in self.log_handler.formatted_records))
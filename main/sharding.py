@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Sharing out the repositories among several replicas of CappBot, so that each is looked after by exactly one of
+them at a time.
+
+Every replica holds a lease on its membership, and the repositories are divided among the current members by
+consistent hashing. A replica only looks after a repository while it holds the lease on it. Leases run out unless
+they are renewed, so the repositories of a replica which stops move to the others within a lease period.
+
+"""
+
+import bisect
+import hashlib
+import logbook
+import sqlite3
+import threading
+import time
+
+MEMBER = 'replica/'
+SHARD = 'repository/'
+
+
+class LocalLeases(object):
+    """Leases kept in memory, for replicas within a single process, such as in tests."""
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name, owner, expires_at, now):
+        """Take or renew the lease `name` for `owner` until `expires_at`, unless another owner holds it at `now`.
+        Return True if `owner` holds the lease.
+
+        """
+
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is not None and holder[0] != owner and holder[1] > now:
+                return False
+            self._leases[name] = (owner, expires_at)
+            return True
+
+    def release(self, name, owner):
+        with self._lock:
+            if self._leases.get(name, (None, ))[0] == owner:
+                del self._leases[name]
+
+    def holders(self, prefix, now):
+        """Return the owner of each lease held at `now` whose name starts with `prefix`, by name."""
+
+        with self._lock:
+            return dict((name, owner) for name, (owner, expires_at) in self._leases.items() if name.startswith(prefix) and expires_at > now)
+
+
+class SqliteLeases(object):
+    """Leases kept in an SQLite database at `path`, which the replicas share.
+
+    Like the databases of the repositories the replicas share, this one uses a rollback journal rather than a
+    write-ahead log, which only works for processes on the same host. Either way, the volume the databases are on
+    has to support file locking across hosts.
+
+    """
+
+    def __init__(self, path, timeout=30):
+        # Used by the coordinator's heartbeat thread as well as by its own, one at a time.
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def _transaction(self, statements):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            for statement, parameters in statements:
+                result = self.connection.execute(statement, parameters)
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        return result
+
+    def acquire(self, name, owner, expires_at, now):
+        row = self._transaction([
+            ('INSERT OR IGNORE INTO lease (name, owner, expires_at) VALUES (?, ?, ?)', (name, owner, expires_at)),
+            ('UPDATE lease SET owner = ?, expires_at = ? WHERE name = ? AND (owner = ? OR expires_at <= ?)', (owner, expires_at, name, owner, now)),
+            ('SELECT owner FROM lease WHERE name = ?', (name, )),
+        ]).fetchone()
+        return row[0] == owner
+
+    def release(self, name, owner):
+        self._transaction([('DELETE FROM lease WHERE name = ? AND owner = ?', (name, owner))])
+
+    def holders(self, prefix, now):
+        rows = self.connection.execute('SELECT name, owner FROM lease WHERE substr(name, 1, ?) = ? AND expires_at > ?', (len(prefix), prefix, now))
+        return dict(rows.fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto `members`.
+
+    Each member is placed at `points` pseudo-random points around a ring, and a key belongs to the member at the
+    first point after the hash of the key. When a member joins or leaves, only the keys next to its points move.
+
+    """
+
+    def __init__(self, members, points=64):
+        self._ring = sorted((_hash(u'%s#%d' % (member, n)), member) for member in members for n in range(points))
+        self._hashes = [h for h, member in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        return self._ring[bisect.bisect(self._hashes, _hash(key)) % len(self._ring)][1]
+
+
+class ShardCoordinator(object):
+    """Decide which of the `shards`, the names of the repositories, the replica named `replica` looks after, in
+    agreement with the other replicas sharing `leases`.
+
+    Leases are taken for `duration` seconds, and renewed once a third of that has passed, whenever the replica
+    checks that it `holds` them and, once `start_heartbeat` has been called, on a thread of its own, so that they
+    aren't lost while a run is held up for a long time, say waiting for the rate limit to reset.
+
+    """
+
+    def __init__(self, leases, replica, shards, duration=300, clock=time.time):
+        self.leases = leases
+        self.replica = replica
+        self.shards = shards
+        self.duration = duration
+        self.clock = clock
+
+        # When each held lease was last renewed, by shard.
+        self.held = {}
+        self._member_renewed_at = None
+        self._lock = threading.RLock()
+        self._heartbeat_stopped = None
+
+    def _renew_membership(self, now):
+        self.leases.acquire(MEMBER + self.replica, self.replica, now + self.duration, now)
+        self._member_renewed_at = now
+
+    def _renew(self, shard, now):
+        if not self.leases.acquire(SHARD + shard, self.replica, now + self.duration, now):
+            logbook.warning(u"Lost the lease on %s." % shard)
+            del self.held[shard]
+            return False
+        self.held[shard] = now
+        return True
+
+    def refresh(self):
+        """Renew the membership of this replica, take the leases on the shards which belong to it among the
+        current members, and give up those which now belong to another member.
+
+        A shard which belongs to this replica but is still leased to another, which has yet to notice, is taken
+        on a later refresh.
+
+        """
+
+        with self._lock:
+            now = self.clock()
+            self._renew_membership(now)
+            ring = HashRing(self.leases.holders(MEMBER, now).values())
+
+            for shard in self.shards:
+                if ring.owner(shard) == self.replica:
+                    if self.leases.acquire(SHARD + shard, self.replica, now + self.duration, now):
+                        if shard not in self.held:
+                            logbook.info(u"Looking after %s from now on." % shard)
+                        self.held[shard] = now
+                    else:
+                        self.held.pop(shard, None)
+                elif shard in self.held:
+                    logbook.info(u"Handing %s over to %s." % (shard, ring.owner(shard)))
+                    self.release(shard)
+
+    def holds(self, shard):
+        """Return True if this replica holds the lease on `shard`, renewing it if it's due."""
+
+        with self._lock:
+            renewed_at = self.held.get(shard)
+            if renewed_at is None:
+                return False
+
+            now = self.clock()
+            if now - self._member_renewed_at >= self.duration / 3.0:
+                self._renew_membership(now)
+            if now - renewed_at >= self.duration / 3.0:
+                return self._renew(shard, now)
+            return True
+
+    def renew(self):
+        """Renew the membership of this replica and every lease it holds which is due."""
+
+        with self._lock:
+            now = self.clock()
+            if self._member_renewed_at is not None and now - self._member_renewed_at >= self.duration / 3.0:
+                self._renew_membership(now)
+            for shard, renewed_at in self.held.items():
+                if now - renewed_at >= self.duration / 3.0:
+                    self._renew(shard, now)
+
+    def may_write(self, shard):
+        """Return True if this replica holds the lease on `shard` with at least a third of it left, which leaves any
+        write made now the time to finish before another replica could take the lease over.
+
+        Unlike `holds`, this never renews the lease, and may be called from any thread.
+
+        """
+
+        renewed_at = self.held.get(shard)
+        return renewed_at is not None and self.clock() < renewed_at + self.duration * 2 / 3.0
+
+    def start_heartbeat(self):
+        """Renew the leases on a thread of their own until `release_all` is called."""
+
+        self._heartbeat_stopped = threading.Event()
+        thread = threading.Thread(target=self._beat, args=(self._heartbeat_stopped, ))
+        thread.daemon = True
+        thread.start()
+
+    def _beat(self, stopped):
+        # Often enough for every lease to be renewed well before a third of it is left.
+        while not stopped.wait(self.duration / 6.0):
+            try:
+                self.renew()
+            except Exception:
+                logbook.exception(u"Unable to renew the leases of %s." % self.replica)
+
+    def release(self, shard):
+        with self._lock:
+            self.held.pop(shard, None)
+            self.leases.release(SHARD + shard, self.replica)
+
+    def release_all(self):
+        """Give up every lease, so that the other replicas can take over right away."""
+
+        if self._heartbeat_stopped is not None:
+            self._heartbeat_stopped.set()
+        with self._lock:
+            for shard in list(self.held):
+                self.release(shard)
+            self.leases.release(MEMBER + self.replica, self.replica)
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logbook
+import os
+import shutil
+import tempfile
+import unittest
+
+from repositories import RepositoryScheduler
+from repositories_test import FakeCappBot
+from sharding import HashRing, LocalLeases, ShardCoordinator, SqliteLeases
+
+REPOSITORIES = sorted('alice_tester/repository-%d' % n for n in range(12))
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LeasesTests(object):
+    """Tests which every kind of lease store should pass."""
+
+    def test_acquire(self):
+        self.assertTrue(self.leases.acquire('repository/blox', 'a', 1100, 1000))
+        self.assertFalse(self.leases.acquire('repository/blox', 'b', 1100, 1050))
+        # Renewed by its owner.
+        self.assertTrue(self.leases.acquire('repository/blox', 'a', 1200, 1050))
+        self.assertFalse(self.leases.acquire('repository/blox', 'b', 1250, 1150))
+        # Taken over once it runs out.
+        self.assertTrue(self.leases.acquire('repository/blox', 'b', 1300, 1200))
+        self.assertEquals(self.leases.holders('repository/', 1200), {'repository/blox': 'b'})
+
+    def test_release(self):
+        self.leases.acquire('repository/blox', 'a', 1100, 1000)
+        self.leases.release('repository/blox', 'b')
+        self.assertFalse(self.leases.acquire('repository/blox', 'b', 1100, 1000))
+
+        self.leases.release('repository/blox', 'a')
+        self.assertTrue(self.leases.acquire('repository/blox', 'b', 1100, 1000))
+
+    def test_holders(self):
+        self.leases.acquire('replica/a', 'a', 1100, 1000)
+        self.leases.acquire('replica/b', 'b', 1050, 1000)
+        self.leases.acquire('repository/blox', 'a', 1100, 1000)
+
+        self.assertEquals(self.leases.holders('replica/', 1000), {'replica/a': 'a', 'replica/b': 'b'})
+        self.assertEquals(self.leases.holders('replica/', 1060), {'replica/a': 'a'})
+
+
+class TestLocalLeases(LeasesTests, unittest.TestCase):
+    def setUp(self):
+        self.leases = LocalLeases()
+
+
+class TestSqliteLeases(LeasesTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.leases = SqliteLeases(os.path.join(self.directory, 'leases.sqlite'))
+
+    def tearDown(self):
+        self.leases.close()
+        shutil.rmtree(self.directory)
+
+    def test_shared(self):
+        other = SqliteLeases(os.path.join(self.directory, 'leases.sqlite'))
+        try:
+            self.assertTrue(self.leases.acquire('repository/blox', 'a', 1100, 1000))
+            self.assertFalse(other.acquire('repository/blox', 'b', 1100, 1000))
+            self.assertEquals(other.holders('repository/', 1000), {'repository/blox': 'a'})
+        finally:
+            other.close()
+
+
+class TestHashRing(unittest.TestCase):
+    def test_owner(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = dict((repository, ring.owner(repository)) for repository in REPOSITORIES)
+
+        self.assertEquals(set(owners.values()), set(['a', 'b', 'c']))
+        self.assertEquals(HashRing(['c', 'b', 'a']).owner(REPOSITORIES[0]), owners[REPOSITORIES[0]])
+        self.assertEquals(HashRing([]).owner(REPOSITORIES[0]), None)
+
+        # Only the repositories of a member which leaves move.
+        ring = HashRing(['a', 'b'])
+        for repository, owner in owners.items():
+            if owner != 'c':
+                self.assertEquals(ring.owner(repository), owner)
+
+
+class TestShardCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.log_handler = logbook.TestHandler()
+        self.log_handler.push_thread()
+
+        self.clock = Clock()
+        self.leases = LocalLeases()
+
+    def tearDown(self):
+        self.log_handler.pop_thread()
+
+    def replica(self, name):
+        return ShardCoordinator(self.leases, name, REPOSITORIES, duration=300, clock=self.clock)
+
+    def held(self, *replicas):
+        return [sorted(replica.held) for replica in replicas]
+
+    def test_shards_split(self):
+        a, b = self.replica('a'), self.replica('b')
+        a.refresh()
+        self.assertEquals(self.held(a), [REPOSITORIES])
+
+        # A new replica gets its share once the replica which had it lets go.
+        b.refresh()
+        self.assertEquals(self.held(b), [[]])
+        a.refresh()
+        b.refresh()
+
+        held_a, held_b = self.held(a, b)
+        self.assertTrue(held_a and held_b)
+        self.assertEquals(sorted(held_a + held_b), REPOSITORIES)
+        self.assertTrue(any('Handing alice_tester/repository-' in record for record in self.log_handler.formatted_records))
+
+    def test_failover(self):
+        a, b = self.replica('a'), self.replica('b')
+        for replica in (a, b, a, b):
+            replica.refresh()
+        held_b = sorted(b.held)
+
+        # b stops. Until its leases run out, its repositories are left alone.
+        self.clock.now += 150
+        a.refresh()
+        self.assertFalse(set(a.held) & set(held_b))
+
+        self.clock.now += 151
+        a.refresh()
+        self.assertEquals(self.held(a), [REPOSITORIES])
+
+        # Once back, b notices that it lost its leases.
+        self.assertFalse(b.holds(held_b[0]))
+
+    def test_holds(self):
+        a = self.replica('a')
+        a.refresh()
+        self.assertTrue(a.holds(REPOSITORIES[0]))
+
+        # Renewed along the way, so a long run keeps its lease.
+        for n in range(5):
+            self.clock.now += 120
+            self.assertTrue(a.holds(REPOSITORIES[0]))
+        self.assertFalse(self.leases.acquire('repository/' + REPOSITORIES[0], 'b', self.clock.now + 300, self.clock.now))
+        self.assertEquals(self.leases.holders('replica/', self.clock.now), {'replica/a': 'a'})
+
+    def test_may_write(self):
+        a = self.replica('a')
+        a.refresh()
+        self.assertTrue(a.may_write(REPOSITORIES[0]))
+
+        # Without renewal, writes stop while a third of the lease is still left.
+        self.clock.now += 199
+        self.assertTrue(a.may_write(REPOSITORIES[0]))
+        self.clock.now += 2
+        self.assertFalse(a.may_write(REPOSITORIES[0]))
+
+        a.renew()
+        self.assertTrue(a.may_write(REPOSITORIES[0]))
+        self.assertFalse(a.may_write('alice_tester/elsewhere'))
+
+    def test_renew(self):
+        a, b = self.replica('a'), self.replica('b')
+        a.refresh()
+
+        # A run held up for longer than the lease keeps it as long as it's renewed.
+        for n in range(5):
+            self.clock.now += 100
+            a.renew()
+        b.refresh()
+        self.assertEquals(self.held(a, b), [REPOSITORIES, []])
+
+        # A lease taken over in the meantime is given up.
+        self.leases.release('repository/' + REPOSITORIES[0], 'a')
+        self.leases.acquire('repository/' + REPOSITORIES[0], 'b', self.clock.now + 300, self.clock.now)
+        self.clock.now += 100
+        a.renew()
+        self.assertFalse(REPOSITORIES[0] in a.held)
+
+    def test_release_all(self):
+        a, b = self.replica('a'), self.replica('b')
+        for replica in (a, b, a, b):
+            replica.refresh()
+
+        a.release_all()
+        b.refresh()
+
+        self.assertEquals(self.held(a, b), [[], REPOSITORIES])
+
+    def test_scheduler(self):
+        log = []
+        a, b = self.replica('a'), self.replica('b')
+        for replica in (a, b, a):
+            replica.refresh()
+        cappbots = [FakeCappBot(repository, 2, log) for repository in REPOSITORIES]
+
+        RepositoryScheduler(cappbots, b).run()
+
+        self.assertEquals(sorted(set(repository for repository, n in log)), sorted(b.held))
+        # Writes are only made while the lease lasts.
+        for cappbot in cappbots:
+            self.assertEquals(cappbot.writes.permit(), cappbot.settings.GITHUB_REPOSITORY in b.held)
+
+    def test_scheduler_lease_lost(self):
+        log = []
+        b = self.replica('b')
+        b.refresh()
+
+        def run_steps():
+            log.append(0)
+            yield
+            # Another replica takes over while this one is busy, which this one finds out when renewing.
+            self.leases.release('repository/' + REPOSITORIES[0], 'b')
+            self.leases.acquire('repository/' + REPOSITORIES[0], 'a', self.clock.now + 300, self.clock.now)
+            self.clock.now += 100
+            log.append(1)
+            yield
+            log.append(2)
+        cappbot = FakeCappBot(REPOSITORIES[0], 0, log)
+        cappbot.run_steps = run_steps
+
+        RepositoryScheduler([cappbot], b).run()
+
+        self.assertEquals(log, [0, 1])
+        self.assertTrue(any('Lost the lease on %s' % REPOSITORIES[0] in record for record in self.log_handler.formatted_records))
@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Storage for what CappBot remembers between runs: a record of each issue it has seen, keyed by issue id, and a
+few named values such as the date of the first run.
+
+`JsonStore` keeps everything in a single JSON file which is rewritten in full whenever it's saved. `SqliteStore`
+keeps each issue record in its own row of an SQLite database, so recording an issue only writes that issue.
+
+Both also keep the writes to GitHub which are still to be made, for the `WriteQueue`, which forgets each one on a
+thread of its own once it has been made. So unlike the rest of CappBot, stores may be used from several threads.
+
+"""
+
+import functools
+import json
+import logbook
+import os
+import shutil
+import sqlite3
+import threading
+
+
+def open_store(path, dry_run=False, shared=False):
+    """Open the store at `path`: a `JsonStore` if the path ends with .json, an `SqliteStore` otherwise.
+
+    With `dry_run`, nothing is ever written back. A `shared` store may be opened by processes on other hosts too.
+
+    DATABASE used to default to a JSON database, so an empty SQLite database next to a JSON database of the same
+    name, like `cappbot-db.sqlite` and `cappbot-db.json`, starts out with everything in it.
+
+    """
+
+    if path.endswith('.json'):
+        return JsonStore.load(path, dry_run=dry_run)
+
+    store = SqliteStore(path, dry_run=dry_run, shared=shared)
+    json_path = os.path.splitext(path)[0] + '.json'
+    if os.path.exists(json_path) and not store.items() and not store.issues():
+        logbook.warning(u"Copying everything in %s into the new database %s." % (json_path, path))
+        migrate(JsonStore.load(json_path), store)
+    return store
+
+
+def migrate(source, destination):
+    """Copy every issue record, value and pending write of the `source` store into the `destination` store."""
+
+    for key, value in source.items():
+        destination.set(key, value)
+    for issue_id, record in source.issues():
+        destination.put_issue(issue_id, record)
+    for write in source.pending_writes():
+        del write['id']
+        destination.add_pending_write(write)
+    destination.save()
+
+
+def synchronised(method):
+    """Make `method` hold the lock of the store while it runs."""
+
+    @functools.wraps(method)
+    def synchronised_method(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return synchronised_method
+
+
+class JsonStore(object):
+    """A store kept in memory as a dict, like `{'first_run': ..., 'issues': {'<issue id>': {...}}}`, and saved to
+    a JSON file at `path`, if any.
+
+    """
+
+    def __init__(self, database=None, path=None, dry_run=False):
+        self.database = database if database is not None else {}
+        self.path = path
+        self.dry_run = dry_run
+        self._lock = threading.RLock()
+        # Ids aren't used again by this process, even once every write with a higher one has been removed.
+        self._last_pending_write_id = 0
+
+    @classmethod
+    def load(cls, path, dry_run=False):
+        new_path = path + ".new"
+
+        if os.path.exists(new_path):
+            # If we failed to mv the new database to the old name, that might have been because we crashed while writing the
+            # new one, in which case the old database might be better to preserve. Or it might be that we wrote .new but
+            # failed to mv() in which case the new is better to preserve. So this error situation requires manual
+            # intervention.
+            raise Exception("{} exists. Manually resolve if {} or {} is less bad and then mv and rm by hand to resolve.".format(new_path, path, new_path))
+
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                database = json.load(f)
+        else:
+            database = {}
+
+        return cls(database, path, dry_run=dry_run)
+
+    @synchronised
+    def get(self, key, default=None):
+        return self.database.get(key, default)
+
+    @synchronised
+    def set(self, key, value):
+        self.database[key] = value
+
+    @synchronised
+    def items(self):
+        return [(key, value) for key, value in self.database.items() if key not in ('issues', 'pending_writes')]
+
+    @synchronised
+    def get_issue(self, issue_id):
+        # Note we need to use string keys for our JSON database's sake.
+        return self.database.get('issues', {}).get(unicode(issue_id))
+
+    @synchronised
+    def put_issue(self, issue_id, record):
+        if not 'issues' in self.database:
+            self.database['issues'] = {}
+        self.database['issues'][unicode(issue_id)] = record
+
+    @synchronised
+    def delete_issue(self, issue_id):
+        self.database.get('issues', {}).pop(unicode(issue_id), None)
+
+    @synchronised
+    def issues(self):
+        return [(int(issue_id), record) for issue_id, record in self.database.get('issues', {}).items()]
+
+    @synchronised
+    def add_pending_write(self, write):
+        """Keep `write` until it's removed, and return the id it's kept under."""
+
+        pending = self.database.get('pending_writes') or []
+        write = dict(write, id=max([self._last_pending_write_id] + [pending_write['id'] for pending_write in pending]) + 1)
+        self.database['pending_writes'] = pending + [write]
+        self._last_pending_write_id = write['id']
+        return write['id']
+
+    @synchronised
+    def pending_writes(self):
+        """Return the writes kept, with their ids, in the order they were added."""
+
+        return [dict(write) for write in self.database.get('pending_writes') or []]
+
+    @synchronised
+    def update_pending_write(self, write):
+        """Keep `write`, with the id of a write kept already, in place of that write."""
+
+        self.database['pending_writes'] = [dict(write) if pending_write['id'] == write['id'] else pending_write for pending_write in self.database.get('pending_writes') or []]
+
+    @synchronised
+    def remove_pending_write(self, write_id):
+        self.database['pending_writes'] = [write for write in self.database.get('pending_writes') or [] if write['id'] != write_id]
+
+    @synchronised
+    def save(self):
+        if self.dry_run or not self.path:
+            return
+
+        new_path = self.path + ".new"
+        with open(new_path, 'wb') as f:
+            json.dump(self.database, f, indent=1, sort_keys=True)
+        shutil.move(new_path, self.path)
+
+    def close(self):
+        pass
+
+
+class SqliteStore(object):
+    """A store kept in an SQLite database at `path`.
+
+    Every change is committed right away, and since the database is in write-ahead log mode, committing a single
+    issue record is cheap. The write-ahead log only works for processes on one host though, so a `shared` database
+    uses a rollback journal instead. Each pending write is a row of its own, so a write added or removed by one process is
+    never lost to another process sharing the database. With `dry_run`, changes are only visible until the store is
+    closed.
+
+    """
+
+    def __init__(self, path, dry_run=False, shared=False):
+        self.path = path
+        self.dry_run = dry_run
+        self._lock = threading.RLock()
+
+        # Used by whichever thread holds the lock.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if shared:
+            self.connection.execute('PRAGMA journal_mode=DELETE')
+        else:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # Durable as of the last checkpoint rather than the last commit, which is plenty for us.
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS issue (id INTEGER PRIMARY KEY, record TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS value (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pending_write (id INTEGER PRIMARY KEY AUTOINCREMENT, write TEXT NOT NULL)')
+
+        # Pending writes used to be kept together in a single value.
+        row = self.connection.execute("SELECT value FROM value WHERE key = 'pending_writes'").fetchone()
+        if row:
+            for write in json.loads(row[0]) or []:
+                write_id = write.pop('id')
+                self.connection.execute('INSERT INTO pending_write (id, write) VALUES (?, ?)', (write_id, json.dumps(write)))
+            self.connection.execute("DELETE FROM value WHERE key = 'pending_writes'")
+        self.connection.commit()
+
+    def _commit(self):
+        if not self.dry_run:
+            self.connection.commit()
+
+    @synchronised
+    def get(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM value WHERE key = ?', (key, )).fetchone()
+        return json.loads(row[0]) if row else default
+
+    @synchronised
+    def set(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO value (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+        self._commit()
+
+    @synchronised
+    def items(self):
+        return [(key, json.loads(value)) for key, value in self.connection.execute('SELECT key, value FROM value')]
+
+    @synchronised
+    def get_issue(self, issue_id):
+        row = self.connection.execute('SELECT record FROM issue WHERE id = ?', (int(issue_id), )).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @synchronised
+    def put_issue(self, issue_id, record):
+        self.connection.execute('INSERT OR REPLACE INTO issue (id, record) VALUES (?, ?)', (int(issue_id), json.dumps(record, sort_keys=True)))
+        self._commit()
+
+    @synchronised
+    def delete_issue(self, issue_id):
+        self.connection.execute('DELETE FROM issue WHERE id = ?', (int(issue_id), ))
+        self._commit()
+
+    @synchronised
+    def issues(self):
+        return [(issue_id, json.loads(record)) for issue_id, record in self.connection.execute('SELECT id, record FROM issue')]
+
+    @synchronised
+    def add_pending_write(self, write):
+        write_id = self.connection.execute('INSERT INTO pending_write (write) VALUES (?)', (json.dumps(write), )).lastrowid
+        self._commit()
+        return write_id
+
+    @synchronised
+    def pending_writes(self):
+        return [dict(json.loads(write), id=write_id) for write_id, write in self.connection.execute('SELECT id, write FROM pending_write ORDER BY id')]
+
+    @synchronised
+    def update_pending_write(self, write):
+        write = dict(write)
+        self.connection.execute('UPDATE pending_write SET write = ? WHERE id = ?', (json.dumps(write), write.pop('id')))
+        self._commit()
+
+    @synchronised
+    def remove_pending_write(self, write_id):
+        self.connection.execute('DELETE FROM pending_write WHERE id = ?', (write_id, ))
+        self._commit()
+
+    @synchronised
+    def save(self):
+        self._commit()
+
+    @synchronised
+    def close(self):
+        if self.dry_run:
+            self.connection.rollback()
+        self.connection.close()
+
+
+class LazyStore(object):
+    """A store which isn't opened, by calling `open`, until it's first used, such as the database of a repository
+    which another replica may be looking after.
+
+    """
+
+    def __init__(self, open):
+        self._open = open
+        self._store = None
+        self._lock = threading.Lock()
+
+    def _get_store(self):
+        with self._lock:
+            if self._store is None:
+                self._store = self._open()
+            return self._store
+
+    def __getattr__(self, name):
+        return getattr(self._get_store(), name)
+
+    def save(self):
+        if self._store is not None:
+            self._store.save()
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
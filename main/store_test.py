@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2011-12, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from store import JsonStore, LazyStore, SqliteStore, migrate, open_store
+
+
+class StoreTests(object):
+    """Tests which every kind of store should pass."""
+
+    def test_issues(self):
+        self.assertEquals(self.store.get_issue(5), None)
+
+        self.store.put_issue(5, {'number': 1, 'votes': None})
+        self.store.put_issue(6, {'number': 2, 'votes': 3})
+        self.store.put_issue(5, {'number': 1, 'votes': 1})
+
+        self.assertEquals(self.store.get_issue(5), {'number': 1, 'votes': 1})
+        self.assertEquals(sorted(self.store.issues()), [(5, {'number': 1, 'votes': 1}), (6, {'number': 2, 'votes': 3})])
+
+    def test_values(self):
+        self.assertEquals(self.store.get('first_run'), None)
+        self.assertEquals(self.store.get('first_run', 'never'), 'never')
+
+        self.store.set('first_run', '2012-01-01T22:06:51Z')
+
+        self.assertEquals(self.store.get('first_run'), '2012-01-01T22:06:51Z')
+        self.assertEquals(self.store.items(), [('first_run', '2012-01-01T22:06:51Z')])
+
+    def test_pending_writes(self):
+        first = self.store.add_pending_write({'method': 'PATCH', 'url': 'issues/1', 'body': {'state': 'closed'}})
+        second = self.store.add_pending_write({'method': 'POST', 'url': 'issues/1', 'body': {'body': 'Closed.'}})
+        self.store.remove_pending_write(first)
+
+        self.assertEquals(self.store.pending_writes(), [{'id': second, 'method': 'POST', 'url': 'issues/1', 'body': {'body': 'Closed.'}}])
+        self.assertEquals(self.store.items(), [])
+
+        self.store.update_pending_write({'id': second, 'method': 'POST', 'url': 'issues/1', 'body': {'body': 'Closed.'}, 'attempts': 4})
+        self.assertEquals(self.store.pending_writes(), [{'id': second, 'method': 'POST', 'url': 'issues/1', 'body': {'body': 'Closed.'}, 'attempts': 4}])
+
+    def test_persistence(self):
+        self.store.put_issue(5, {'number': 1})
+        self.store.set('first_run', '2012-01-01T22:06:51Z')
+        self.store.save()
+        self.store.close()
+
+        self.store = open_store(self.path)
+        self.assertEquals(self.store.get_issue(5), {'number': 1})
+        self.assertEquals(self.store.get('first_run'), '2012-01-01T22:06:51Z')
+
+    def test_dry_run(self):
+        self.store.put_issue(5, {'number': 1})
+        self.store.save()
+        self.store.close()
+
+        self.store = open_store(self.path, dry_run=True)
+        self.store.put_issue(5, {'number': 2})
+        self.assertEquals(self.store.get_issue(5), {'number': 2})
+        self.store.save()
+        self.store.close()
+
+        self.store = open_store(self.path)
+        self.assertEquals(self.store.get_issue(5), {'number': 1})
+
+
+class TestJsonStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cappbot-db.json')
+        self.store = open_store(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_format(self):
+        self.store.put_issue(5, {'number': 1})
+        self.store.set('first_run', '2012-01-01T22:06:51Z')
+        self.store.save()
+
+        with open(self.path, 'rb') as f:
+            self.assertEquals(json.load(f), {'first_run': '2012-01-01T22:06:51Z', 'issues': {'5': {'number': 1}}})
+
+
+class TestSqliteStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cappbot-db.sqlite')
+        self.store = open_store(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_migration(self):
+        json_path = os.path.join(self.directory, 'cappbot-db.json')
+        with open(json_path, 'wb') as f:
+            json.dump({'first_run': '2012-01-01T22:06:51Z', 'issues': {'5': {'number': 1, 'labels': ['#new']}}}, f)
+
+        migrate(JsonStore.load(json_path), self.store)
+
+        self.assertTrue(isinstance(self.store, SqliteStore))
+        self.assertEquals(self.store.get('first_run'), '2012-01-01T22:06:51Z')
+        self.assertEquals(self.store.issues(), [(5, {'number': 1, 'labels': ['#new']})])
+
+    def test_migration_from_default(self):
+        # Where DATABASE used to point by default, with the new default not created yet.
+        path = os.path.join(self.directory, 'cappbot-cappuccino-db.sqlite')
+        with open(os.path.join(self.directory, 'cappbot-cappuccino-db.json'), 'wb') as f:
+            json.dump({'first_run': '2012-01-01T22:06:51Z', 'issues': {'5': {'number': 1}}}, f)
+
+        # A dry run sees everything but leaves nothing behind, so the next run still finds the database empty.
+        for dry_run in (True, False):
+            store = open_store(path, dry_run=dry_run)
+            self.assertEquals(store.get('first_run'), '2012-01-01T22:06:51Z')
+            self.assertEquals(store.issues(), [(5, {'number': 1})])
+            store.close()
+
+        os.remove(os.path.join(self.directory, 'cappbot-cappuccino-db.json'))
+        store = open_store(path)
+        self.assertEquals(store.issues(), [(5, {'number': 1})])
+        store.close()
+
+    def test_pending_writes_shared(self):
+        # Another process sharing the database, such as a replica which just lost the lease on the repository.
+        other = open_store(self.path)
+        self.store.add_pending_write({'method': 'PATCH', 'url': 'issues/1', 'body': {}})
+        written = other.add_pending_write({'method': 'PATCH', 'url': 'issues/2', 'body': {}})
+        other.remove_pending_write(written)
+        other.close()
+
+        self.assertEquals([write['url'] for write in self.store.pending_writes()], ['issues/1'])
+
+    def test_shared(self):
+        self.store.close()
+
+        self.store = open_store(self.path, shared=True)
+        self.assertEquals(self.store.connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_lazy(self):
+        lazy = LazyStore(lambda: open_store(self.path))
+        lazy.save()
+        lazy.close()
+        self.store.put_issue(5, {'number': 1})
+
+        self.assertEquals(lazy.get_issue(5), {'number': 1})
+        lazy.close()
+
+    def test_pending_writes_upgrade(self):
+        self.store.set('pending_writes', [{'id': 3, 'method': 'PATCH', 'url': 'issues/1', 'body': {}}])
+        self.store.close()
+
+        self.store = open_store(self.path)
+        self.assertEquals(self.store.pending_writes(), [{'id': 3, 'method': 'PATCH', 'url': 'issues/1', 'body': {}}])
+        self.assertEquals(self.store.get('pending_writes'), None)
+        self.assertEquals(self.store.add_pending_write({'method': 'PATCH', 'url': 'issues/2', 'body': {}}), 4)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2011-18, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Receive GitHub webhook deliveries so that CappBot can react to a changed issue right away, rather than when the
+next poll comes around.
+
+Configure the repository webhook to send `issues`, `issue_comment` and `label` events (and optionally `milestone`
+events) as `application/json` to the address CappBot listens on, with the same secret as WEBHOOK_SECRET.
+
+"""
+
+import BaseHTTPServer
+import Queue
+import hashlib
+import hmac
+import json
+import logbook
+import threading
+
+# Deliveries of these events name an issue to examine.
+ISSUE_EVENTS = ('issues', 'issue_comment')
+
+# Deliveries of these events mean the known labels and milestones should be reloaded.
+METADATA_EVENTS = ('label', 'milestone')
+
+
+def verify_signature(secret, body, headers):
+    """Return True if the delivery `body` was signed with `secret`, according to its X-Hub-Signature-256 or
+    X-Hub-Signature header.
+
+    """
+
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf8')
+
+    signature = headers.get('X-Hub-Signature-256')
+    prefix, digestmod = 'sha256=', hashlib.sha256
+    if not signature:
+        signature = headers.get('X-Hub-Signature')
+        prefix, digestmod = 'sha1=', hashlib.sha1
+
+    if not signature or not signature.startswith(prefix):
+        return False
+
+    expected = prefix + hmac.new(secret, body, digestmod).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class WebhookRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def respond(self, status, message):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not verify_signature(self.server.secret, body, self.headers):
+            logbook.warning(u"Rejecting webhook delivery %s with a bad signature." % self.headers.get('X-GitHub-Delivery'))
+            self.respond(401, 'Bad signature.\n')
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.respond(400, 'Bad payload.\n')
+            return
+
+        event = self.headers.get('X-GitHub-Event')
+        if self.server.accept(event, payload):
+            self.respond(202, 'Queued.\n')
+        else:
+            self.respond(200, 'Ignored.\n')
+
+    def log_message(self, format, *args):
+        logbook.debug(u"Webhook: %s" % (format % args))
+
+
+class WebhookServer(BaseHTTPServer.HTTPServer):
+    """An HTTP server accepting webhook deliveries for `repository` signed with `secret`.
+
+    Each accepted delivery is turned into a piece of work on `work_queue`: `('issue', number)` to examine an issue,
+    or `('metadata', None)` to reload the labels and milestones. Work already waiting in the queue isn't queued
+    twice, so a burst of deliveries about the same issue is handled once.
+
+    """
+
+    def __init__(self, server_address, secret, repository):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, WebhookRequestHandler)
+
+        self.secret = secret
+        self.repository = repository.lower()
+        self.work_queue = Queue.Queue()
+
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def accept(self, event, payload):
+        """Queue the work a delivery calls for. Return True if there was any."""
+
+        repository = (payload.get('repository') or {}).get('full_name') or ''
+        if repository.lower() != self.repository:
+            return False
+
+        if event in ISSUE_EVENTS and payload.get('issue'):
+            work = ('issue', int(payload['issue']['number']))
+        elif event in METADATA_EVENTS:
+            work = ('metadata', None)
+        else:
+            return False
+
+        with self._lock:
+            if work in self._pending:
+                return True
+            self._pending.add(work)
+
+        logbook.debug(u"Queueing %s %s due to %s event." % (work[0], work[1] or '', event))
+        self.work_queue.put(work)
+        return True
+
+    def next_work(self, timeout=None):
+        """Return the next piece of work, or None if there was none within `timeout` seconds."""
+
+        try:
+            work = self.work_queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+        with self._lock:
+            self._pending.discard(work)
+
+        return work
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2011-12, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import hashlib
+import hmac
+import httplib
+import os
+import threading
+import unittest
+
+from webhook import WebhookServer
+
+
+def load_fixture_data(name):
+    with open(os.path.join(os.path.dirname(__file__), 'test_fixtures', name), 'rb') as inf:
+        return inf.read()
+
+
+class TestWebhookServer(unittest.TestCase):
+    def setUp(self):
+        self.server = WebhookServer(('127.0.0.1', 0), 'sekrit', 'alice_tester/blox')
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deliver(self, event, body, secret='sekrit', header='X-Hub-Signature-256'):
+        digestmod, prefix = (hashlib.sha256, 'sha256=') if header == 'X-Hub-Signature-256' else (hashlib.sha1, 'sha1=')
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': '72d3162e-cc78-11e3-81ab-4c9367dc0958',
+            header: prefix + hmac.new(secret, body, digestmod).hexdigest(),
+        }
+
+        connection = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            connection.request('POST', '/', body, headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def test_issue_comment(self):
+        status, content = self.deliver('issue_comment', load_fixture_data('webhook_issue_comment.json'))
+
+        self.assertEquals(status, 202)
+        self.assertEquals(self.server.next_work(timeout=1), ('issue', 8))
+        self.assertEquals(self.server.next_work(timeout=0), None)
+
+    def test_legacy_signature(self):
+        status, content = self.deliver('issue_comment', load_fixture_data('webhook_issue_comment.json'), header='X-Hub-Signature')
+
+        self.assertEquals(status, 202)
+        self.assertEquals(self.server.next_work(timeout=1), ('issue', 8))
+
+    def test_bad_signature(self):
+        status, content = self.deliver('issue_comment', load_fixture_data('webhook_issue_comment.json'), secret='wrong')
+
+        self.assertEquals(status, 401)
+        self.assertEquals(self.server.next_work(timeout=0), None)
+
+    def test_label(self):
+        status, content = self.deliver('label', load_fixture_data('webhook_label.json'))
+
+        self.assertEquals(status, 202)
+        self.assertEquals(self.server.next_work(timeout=1), ('metadata', None))
+
+    def test_other_repository(self):
+        body = load_fixture_data('webhook_issue_comment.json').replace('"alice_tester/blox"', '"alice_tester/other"')
+        status, content = self.deliver('issue_comment', body)
+
+        self.assertEquals(status, 200)
+        self.assertEquals(self.server.next_work(timeout=0), None)
+
+    def test_queued_once(self):
+        for n in range(3):
+            self.deliver('issues', load_fixture_data('webhook_issue_comment.json'))
+
+        self.assertEquals(self.server.next_work(timeout=1), ('issue', 8))
+        self.assertEquals(self.server.next_work(timeout=0), None)
+
+        # Once the work has been taken it can be queued again.
+        self.deliver('issues', load_fixture_data('webhook_issue_comment.json'))
+        self.assertEquals(self.server.next_work(timeout=1), ('issue', 8))
@@ -0,0 +1,354 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Changes to GitHub made in the background, paced to stay within GitHub's limits on how quickly content may be
+created.
+
+"""
+
+import Queue
+import logbook
+import threading
+import time
+
+from mini_github3 import TRANSIENT_ERRORS, RateLimited
+
+# The method of a write which stores the record of an issue rather than changing anything on GitHub.
+RECORD = 'RECORD'
+
+
+class WritePacer(object):
+    """When writes may be made, for every `WriteQueue` writing with the same GitHub user, since GitHub limits how
+    quickly a user may create content however many repositories it's spread over.
+
+    Writes start out `min_interval` seconds apart. When GitHub asks for requests to slow down, no write is made
+    until the time it asked for has passed, and the interval is doubled up to `max_interval`. Every write which goes
+    through brings the interval back down a little.
+
+    """
+
+    def __init__(self, min_interval=1, max_interval=60, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+
+        self.interval = min_interval
+        self._next_write_at = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Return the time at which the next write may be made, which is then taken."""
+
+        with self._lock:
+            at = max(self._next_write_at, self.clock())
+            self._next_write_at = at + self.interval
+            return at
+
+    def written(self, succeeded):
+        """Note that a write has been made, and whether it `succeeded`, so that the next one is an interval after
+        it.
+
+        """
+
+        with self._lock:
+            if succeeded:
+                self.interval = max(self.min_interval, self.interval * 0.9)
+            self._next_write_at = max(self._next_write_at, self.clock() + self.interval)
+
+    def slow_down(self, retry_after=None):
+        """Note that GitHub asked to slow down, and to wait `retry_after` seconds, if given, before writing again.
+        Return the number of seconds until the next write.
+
+        """
+
+        with self._lock:
+            self.interval = min(self.max_interval, max(1, self.interval * 2))
+            if retry_after is None:
+                retry_after = self.interval
+            self._next_write_at = max(self._next_write_at, self.clock() + retry_after)
+            return retry_after
+
+
+class WriteQueue(object):
+    """Make writes to GitHub one at a time, in the order they were queued, on a thread of their own, so that
+    whoever queues them can carry on reading in the meantime.
+
+    A write is a dict like `{'method': 'PATCH', 'url': ..., 'body': {...}}` which `perform` knows how to make. Writes
+    are paced by `pacer`, which may be shared with other queues, or else by a `WritePacer` of the queue's own
+    starting out `min_interval` seconds apart. When GitHub asks for requests to slow down, the write is retried
+    once the pacer allows.
+
+    A write which fails for a reason that says nothing about the write itself, like a server error or a connection
+    which was reset, is tried again up to `retries` times, `retry_interval` seconds later and twice as long each
+    time after. If it still fails it's left pending, along with every write after it so that they stay in order,
+    until the queue is resumed, unless it has been tried `max_attempts` times in all by then, over however many
+    runs, in which case it's dropped. A write which GitHub rejects for any other reason is logged and dropped. The
+    writes dropped either way are handed out by `take_dropped`.
+
+    Writes may make up a change, such as everything done to an issue on one look at it: every write after the
+    first has the id of the first as its `change`. Once one write of a change is dropped, the rest of the change is
+    too. The last write of a change is usually a RECORD write, `{'method': RECORD, 'issue_id': ..., 'record':
+    {...}}`, which stores the record of the issue once the rest of the change has been made. So the record of an
+    issue never says more has been done than has.
+
+    Each write is kept in `store` from when it's queued until it has been made, so that writes still pending when
+    the process stops are made by `resume` when it starts again. It's forgotten by the store on the writing thread
+    as soon as it has been made, so that whoever resumes the writes never makes it again.
+
+    With `permit`, a function which returns False while writes may not be made, such as when the lease on the
+    repository is about to run out, each write is only made if `permit` allows it right before. Writes which aren't
+    are left pending, to be resumed by whoever may make them.
+
+    Once `stop` has been called no more writes are made, and those not made yet are left pending.
+
+    """
+
+    def __init__(self, store, perform, min_interval=1, max_interval=60, clock=time.time, permit=None, retries=3, retry_interval=5, max_attempts=20, pacer=None):
+        self.store = store
+        self.perform = perform
+        self.permit = permit
+        self.pacer = pacer or WritePacer(min_interval, max_interval, clock)
+        self.max_interval = max_interval
+        self.clock = clock
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+
+        self._queue = Queue.Queue()
+        self._done = Queue.Queue()
+        self._worker = None
+        # The ids of the writes queued by this process and not yet collected, whether made or left pending.
+        self._queued = set()
+        # Set once a write has been left pending, after which every write is until the queue is resumed.
+        self._stalled = False
+        self._stopped = False
+        # The changes with a dropped write, whose remaining writes are dropped too.
+        self._dropped_changes = set()
+        self._dropped = Queue.Queue()
+        # The issue of each write kept in the store, and how many writes each issue has there, so that telling
+        # whether an issue has any doesn't take going through them all.
+        self._pending_lock = threading.Lock()
+        self._pending = {}
+        self._pending_issues = {}
+        # Waiting on an event rather than sleeping lets waits be cut short in tests.
+        self._wakeup = threading.Event()
+
+    def put(self, write, perform=None):
+        """Queue `write`, to be made by calling `perform` if given, or else by passing it to the `perform` the
+        queue was created with. Return the id of the write.
+
+        """
+
+        write = dict(write, id=self.store.add_pending_write(write))
+        self._track(write)
+        self._enqueue(write, perform)
+        return write['id']
+
+    def resume(self):
+        """Queue the writes left pending, by this process or another: a previous one, or another replica which
+        looked after the repository until now.
+
+        """
+
+        self._stalled = False
+        pending = [write for write in self.store.pending_writes() if write['id'] not in self._queued]
+        if pending:
+            logbook.info(u"Resuming %d pending write(s)." % len(pending))
+        for write in pending:
+            self._track(write)
+            self._enqueue(write, None)
+
+    def is_pending(self, issue_id):
+        """Return True if any write to the issue with the id `issue_id` is still to be made."""
+
+        return issue_id in self._pending_issues
+
+    def take_dropped(self):
+        """Return the writes dropped since the last call, other than those dropped along with an earlier write of
+        the same change.
+
+        """
+
+        dropped = []
+        while True:
+            try:
+                dropped.append(self._dropped.get_nowait())
+            except Queue.Empty:
+                return dropped
+
+    def collect(self):
+        """Forget the writes which have been made, dropped or left pending since the last call, so that those left
+        pending can be resumed.
+
+        """
+
+        done = set()
+        while True:
+            try:
+                done.add(self._done.get_nowait())
+            except Queue.Empty:
+                break
+
+        self._queued -= done
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for every queued write to be made. Return True if they have been."""
+
+        queue = self._queue
+        with queue.all_tasks_done:
+            if queue.unfinished_tasks:
+                queue.all_tasks_done.wait(timeout)
+            return not queue.unfinished_tasks
+
+    def join(self):
+        """Wait for every queued write to be made."""
+
+        self._queue.join()
+        self.collect()
+
+    def stop(self, timeout=None):
+        """Make no more writes, leaving the rest pending, and wait up to `timeout` seconds for the write being made,
+        if any, to be done with. Return True if it is, and so nothing is being written any longer.
+
+        """
+
+        self._stopped = True
+        # Cut any wait between writes short.
+        self._wakeup.set()
+        if self._worker is None:
+            return True
+        self._queue.put(None)
+        self._worker.join(timeout)
+        return not self._worker.is_alive()
+
+    def _track(self, write):
+        with self._pending_lock:
+            if write['id'] in self._pending:
+                return
+            issue_id = self._pending[write['id']] = write.get('issue_id')
+            self._pending_issues[issue_id] = self._pending_issues.get(issue_id, 0) + 1
+
+    def _untrack(self, write_id):
+        with self._pending_lock:
+            if write_id not in self._pending:
+                return
+            issue_id = self._pending.pop(write_id)
+            self._pending_issues[issue_id] -= 1
+            if not self._pending_issues[issue_id]:
+                del self._pending_issues[issue_id]
+
+    def _enqueue(self, write, perform):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work)
+            self._worker.daemon = True
+            self._worker.start()
+
+        self._queued.add(write['id'])
+        self._queue.put((write, perform))
+
+    def _wait_until(self, t):
+        delay = t - self.clock()
+        if delay > 0:
+            self._wakeup.wait(delay)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # Stopped.
+                self._queue.task_done()
+                return
+            write, perform = item
+            try:
+                if self._make(write, perform):
+                    self.store.remove_pending_write(write['id'])
+                    self._untrack(write['id'])
+            except Exception:
+                logbook.exception(u"Unable to make write %s %s." % (write['method'], write.get('url')))
+            finally:
+                self._done.put(write['id'])
+                self._queue.task_done()
+
+    def _make(self, write, perform):
+        """Make `write`. Return True if it's done with, whether it was made or dropped, or False if it's left
+        pending.
+
+        """
+
+        if self._stalled or self._stopped:
+            return False
+
+        change = write.get('change', write['id'])
+        if change in self._dropped_changes:
+            logbook.warning(u"Dropping write %s %s since an earlier write of the same change was dropped." % (write['method'], write.get('url')))
+            if write['method'] == RECORD:
+                # Nothing more of the change is to come.
+                self._dropped_changes.discard(change)
+            return True
+
+        if write['method'] == RECORD:
+            self.store.put_issue(write['issue_id'], write['record'])
+            return True
+
+        attempt = 0
+        retry_at = 0
+        while True:
+            self._wait_until(retry_at)
+            self._wait_until(self.pacer.reserve())
+            if self._stopped:
+                return False
+            if self.permit is not None and not self.permit():
+                logbook.warning(u"Leaving write %s %s and those after it pending since writes are not permitted right now." % (write['method'], write['url']))
+                self._stalled = True
+                return False
+            try:
+                if perform is not None:
+                    perform()
+                else:
+                    self.perform(write)
+            except RateLimited as e:
+                retry_after = self.pacer.slow_down(e.retry_after)
+                logbook.warning(u"GitHub asked to slow down. Retrying %s %s in %ds, and writing every %.1fs from then on." % (write['method'], write['url'], retry_after, self.pacer.interval))
+                continue
+            except TRANSIENT_ERRORS as e:
+                write['attempts'] = write.get('attempts', 0) + 1
+                if write['attempts'] >= self.max_attempts:
+                    logbook.error(u"Unable to make write %s %s: %s. Dropping it after %d attempts." % (write['method'], write['url'], e, write['attempts']))
+                    self._drop(write, change)
+                    self.pacer.written(False)
+                elif attempt >= self.retries:
+                    logbook.error(u"Unable to make write %s %s: %s. Leaving it and those after it pending until the next run." % (write['method'], write['url'], e))
+                    self.store.update_pending_write(write)
+                    self._stalled = True
+                    return False
+                else:
+                    retry_after = min(self.max_interval, self.retry_interval * 2 ** attempt)
+                    attempt += 1
+                    logbook.warning(u"Unable to make write %s %s: %s. Retrying in %ds." % (write['method'], write['url'], e, retry_after))
+                    retry_at = self.clock() + retry_after
+                    continue
+            except Exception:
+                logbook.exception(u"Unable to make write %s %s with %r. Dropping it." % (write['method'], write['url'], write.get('body')))
+                self._drop(write, change)
+                self.pacer.written(False)
+            else:
+                self.pacer.written(True)
+            return True
+
+    def _drop(self, write, change):
+        self._dropped_changes.add(change)
+        self._dropped.put(write)
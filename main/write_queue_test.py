@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#
+# BSD License
+#
+# Copyright (c) 2012, Alexander Ljungberg
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from mock import Mock
+import errno
+import logbook
+import socket
+import threading
+import time
+import unittest
+
+from mini_github3 import RateLimited, Unavailable
+from store import JsonStore
+from write_queue import RECORD, WritePacer, WriteQueue
+
+
+def write(n):
+    return {'method': 'PATCH', 'url': 'https://api.github.com/repos/alice_tester/blox/issues/%d' % n, 'body': {'state': 'closed'}}
+
+
+class TestWriteQueue(unittest.TestCase):
+    def setUp(self):
+        self.log_handler = logbook.TestHandler()
+        # Writes are made, and logged, on a thread of their own.
+        self.log_handler.push_application()
+
+        self.database = {}
+        self.store = JsonStore(self.database)
+        self.perform = Mock()
+        self.writes = WriteQueue(self.store, self.perform, min_interval=0, retry_interval=0)
+
+    def tearDown(self):
+        self.log_handler.pop_application()
+
+    def test_writes_in_order(self):
+        made = []
+        # Hold up the writes until they have all been queued.
+        queued = threading.Event()
+        self.writes.put(write(0), lambda: (queued.wait(), made.append(0)))
+        for n in range(1, 5):
+            self.writes.put(write(n), lambda n=n: made.append(n))
+        self.assertEquals(len(self.database['pending_writes']), 5)
+        queued.set()
+
+        self.writes.join()
+
+        self.assertEquals(made, range(5))
+        self.assertEquals(self.database['pending_writes'], [])
+        self.assertFalse(self.perform.called)
+
+    def test_resume(self):
+        # Writes left pending by a process which stopped before making them.
+        self.database['pending_writes'] = [dict(write(n), id=n + 1) for n in range(2)]
+
+        self.writes.resume()
+        self.writes.resume()
+        self.writes.join()
+
+        self.assertEquals([args[0]['url'] for args, kwargs in self.perform.call_args_list], [write(0)['url'], write(1)['url']])
+        self.assertEquals(self.database['pending_writes'], [])
+
+        # Left pending by another replica which looked after the repository in the meantime.
+        self.database['pending_writes'] = [dict(write(2), id=1)]
+        self.writes.resume()
+        self.writes.join()
+
+        self.assertEquals(self.perform.call_args[0][0]['url'], write(2)['url'])
+
+    def test_stop(self):
+        made = []
+        writing = threading.Event()
+        written = threading.Event()
+        self.writes.put(write(1), lambda: (writing.set(), written.wait(), made.append(1)))
+        self.writes.put(write(2), lambda: made.append(2))
+        writing.wait(5)
+
+        # The write being made is waited for, and then nothing more is written.
+        self.assertFalse(self.writes.stop(0.05))
+        written.set()
+        self.assertTrue(self.writes.stop(5))
+
+        self.assertEquals(made, [1])
+        self.assertEquals([each['url'] for each in self.store.pending_writes()], [write(2)['url']])
+
+    def test_not_permitted(self):
+        made = []
+        permitted = [True]
+        self.writes.permit = lambda: permitted[0]
+
+        self.writes.put(write(1), lambda: made.append(1))
+        self.writes.join()
+        permitted[0] = False
+        self.writes.put(write(2), lambda: made.append(2))
+        self.writes.join()
+
+        # Left pending for whoever may make it.
+        self.assertEquals(made, [1])
+        self.assertEquals([pending['url'] for pending in self.database['pending_writes']], [write(2)['url']])
+
+        permitted[0] = True
+        self.writes.resume()
+        self.writes.join()
+        self.assertEquals(self.perform.call_args[0][0]['url'], write(2)['url'])
+        self.assertEquals(self.database['pending_writes'], [])
+
+    def test_slow_down(self):
+        perform = Mock(side_effect=[RateLimited('403 Forbidden', retry_after=0), None])
+
+        self.writes.put(write(1), perform)
+        self.writes.join()
+
+        self.assertEquals(perform.call_count, 2)
+        # The next writes are further apart, for a while.
+        self.assertTrue(self.writes.pacer.interval > 0)
+        self.assertTrue(any('GitHub asked to slow down' in record for record in self.log_handler.formatted_records))
+
+    def test_shared_pacer(self):
+        # Writes for different repositories are spaced out together.
+        pacer = WritePacer(min_interval=0.1)
+        other_writes = WriteQueue(JsonStore({}), Mock(), pacer=pacer, retry_interval=0)
+        self.writes = WriteQueue(self.store, self.perform, pacer=pacer, retry_interval=0)
+        made = []
+        self.writes.put(write(1), lambda: made.append(time.time()))
+        other_writes.put(write(2), lambda: made.append(time.time()))
+        self.writes.join()
+        other_writes.join()
+
+        self.assertEquals(len(made), 2)
+        self.assertTrue(abs(made[1] - made[0]) >= 0.09)
+
+    def test_failed_write_dropped(self):
+        made = []
+        self.writes.put(write(1), Mock(side_effect=ValueError))
+        self.writes.put(write(2), lambda: made.append(2))
+        self.writes.join()
+
+        self.assertEquals(made, [2])
+        self.assertEquals(self.database['pending_writes'], [])
+        self.assertTrue(any('Unable to make write PATCH' in record for record in self.log_handler.formatted_records))
+
+
+    def test_transient_failure_retried(self):
+        perform = Mock(side_effect=[Unavailable('502 Bad Gateway'), socket.error(errno.ECONNRESET, 'Connection reset by peer'), None])
+
+        self.writes.put(write(1), perform)
+        self.writes.join()
+
+        self.assertEquals(perform.call_count, 3)
+        self.assertEquals(self.database['pending_writes'], [])
+
+    def test_transient_failure_left_pending(self):
+        self.writes.retries = 1
+        made = []
+        self.writes.put(write(1), Mock(side_effect=socket.timeout('timed out')))
+        self.writes.put(write(2), lambda: made.append(2))
+        self.writes.join()
+
+        # Both are left, in order, for the next run.
+        self.assertEquals(made, [])
+        self.assertEquals([pending['url'] for pending in self.database['pending_writes']], [write(1)['url'], write(2)['url']])
+        self.assertTrue(any('Leaving it and those after it pending' in record for record in self.log_handler.formatted_records))
+
+        self.writes.resume()
+        self.writes.join()
+        self.assertEquals([args[0]['url'] for args, kwargs in self.perform.call_args_list], [write(1)['url'], write(2)['url']])
+        self.assertEquals(self.database['pending_writes'], [])
+
+    def test_transient_failure_given_up(self):
+        self.writes.retries = 1
+        self.writes.max_attempts = 3
+        made = []
+
+        def perform(pending):
+            if pending['issue_id'] == 1:
+                raise socket.timeout('timed out')
+            made.append(pending['issue_id'])
+        self.perform.side_effect = perform
+        self.writes.put(dict(write(1), issue_id=1))
+        self.writes.put(dict(write(2), issue_id=2))
+        self.writes.join()
+
+        # The attempts are counted from one run to the next.
+        self.assertEquals([pending.get('attempts') for pending in self.database['pending_writes']], [2, None])
+        self.assertTrue(self.writes.is_pending(1))
+
+        # Once they have all been used up, the write is dropped rather than holding up those after it for good.
+        self.writes.resume()
+        self.writes.join()
+
+        self.assertEquals(made, [2])
+        self.assertEquals(self.database['pending_writes'], [])
+        self.assertFalse(self.writes.is_pending(1))
+        self.assertEquals([dropped['url'] for dropped in self.writes.take_dropped()], [write(1)['url']])
+        self.assertEquals(self.writes.take_dropped(), [])
+
+    def test_change_dropped(self):
+        made = []
+        change = self.writes.put(write(1), Mock(side_effect=ValueError))
+        self.writes.put(dict(write(1), change=change), lambda: made.append(1))
+        self.writes.put({'method': RECORD, 'url': write(1)['url'], 'issue_id': 1, 'record': {'number': 1}, 'change': change})
+        other = self.writes.put(write(2), lambda: made.append(2))
+        self.writes.put({'method': RECORD, 'url': write(2)['url'], 'issue_id': 2, 'record': {'number': 2}, 'change': other})
+        self.writes.join()
+
+        # Neither the rest of the first change is made, nor is it recorded.
+        self.assertEquals(made, [2])
+        self.assertEquals([dropped['id'] for dropped in self.writes.take_dropped()], [change])
+        self.assertEquals(self.store.get_issue(1), None)
+        self.assertEquals(self.store.get_issue(2), {'number': 2})
+        self.assertEquals(self.database['pending_writes'], [])
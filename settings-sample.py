@@ -7,3 +7,4 @@ GITHUB_TOKEN = "12345678901234567890"
 GITHUB_REPOSITORY = "aljungberg/bottest2"
 
 DATABASE = "bottest2-db.json"
+RESPONSE_CACHE = "bottest2-cache"